@@ -2,8 +2,13 @@ import logging
 from typing import Any, Dict, List, Optional, Type
 
 from app.agents.tools.base import BaseTool
+from app.context_selection import select_context
 from app.repositories.models.custom_bot import BotModel
-from app.vector_search import SearchResult, search_related_docs
+from app.vector_search import (
+    SearchResult,
+    search_related_docs,
+    search_related_docs_many,
+)
 from langchain_core.callbacks import CallbackManagerForToolRun
 from langchain_core.language_models import BaseLanguageModel
 from langchain_core.prompts import PromptTemplate
@@ -104,6 +109,10 @@ dummy_search_results = [
 
 class AnswerWithKnowledgeInput(BaseModel):
     query: str = Field(description="User's original question string.")
+    sub_queries: Optional[List[str]] = Field(
+        default=None,
+        description="Optional sub-questions of a complex question, searched along with the question.",
+    )
 
 
 class AnswerWithKnowledgeTool(BaseTool):
@@ -126,17 +135,29 @@ class AnswerWithKnowledgeTool(BaseTool):
         return values
 
     def _run(
-        self, query: str, run_manager: Optional[CallbackManagerForToolRun] = None
+        self,
+        query: str,
+        sub_queries: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> dict:
-        logger.info(f"Running AnswerWithKnowledgeTool with query: {query}")
+        logger.info(
+            f"Running AnswerWithKnowledgeTool with query: {query}, sub queries: {sub_queries}"
+        )
+        queries = [query] + [q for q in sub_queries or [] if q.strip() and q != query]
         if self.bot.id == "dummy":
             # For testing purpose
             search_results = dummy_search_results
+        elif len(queries) > 1:
+            # All the queries are searched in one round trip and the results are fused
+            search_results = select_context(
+                search_related_docs_many(self.bot, queries=queries).fused,
+                self.bot.search_params.max_context_tokens,
+            ).results
         else:
-            search_results = search_related_docs(
-                self.bot,
-                query=query,
-            )
+            search_results = select_context(
+                search_related_docs(self.bot, query=query),
+                self.bot.search_params.max_context_tokens,
+            ).results
 
         context_prompt = self._format_search_results(search_results)
         output = self.llm_chain.invoke({"context": context_prompt, "query": query})
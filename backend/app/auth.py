@@ -1,20 +1,136 @@
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
 
 import requests
+from app.metrics import metrics
 from jose import jwt
+from jose.exceptions import JWTError
 
 REGION = os.environ.get("REGION", "ap-northeast-1")
 USER_POOL_ID = os.environ.get("USER_POOL_ID", "")
 CLIENT_ID = os.environ.get("CLIENT_ID", "")
 
+JWKS_TTL_SECONDS = 60 * 60
+# Minimum interval between refreshes triggered by an unknown `kid`,
+# so that tokens with random key ids cannot hammer the JWKS endpoint.
+JWKS_MIN_REFRESH_INTERVAL_SECONDS = 30
+VERIFIED_TOKEN_CACHE_SIZE = 1024
+
+
+def fetch_jwks() -> list[dict]:
+    url = f"https://cognito-idp.{REGION}.amazonaws.com/{USER_POOL_ID}/.well-known/jwks.json"
+    with metrics.timer("auth.jwks_fetch_latency"):
+        response = requests.get(url, timeout=10)
+    response.raise_for_status()
+    return response.json()["keys"]
+
+
+class JwksCache:
+    """Signing keys of the user pool, indexed by `kid`.
+    Keys are refetched after `ttl` seconds, or when a token refers to an unknown `kid`
+    (i.e. the keys were rotated).
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[], list[dict]] = fetch_jwks,
+        ttl: float = JWKS_TTL_SECONDS,
+        min_refresh_interval: float = JWKS_MIN_REFRESH_INTERVAL_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+        self._keys: dict[str, dict] = {}
+        self._fetched_at: float | None = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        self._keys = {k["kid"]: k for k in self.fetch()}
+        self._fetched_at = self.clock()
+
+    def get_key(self, kid: str) -> dict:
+        with self._lock:
+            now = self.clock()
+            if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+                self._refresh()
+            elif (
+                kid not in self._keys
+                and now - self._fetched_at >= self.min_refresh_interval
+            ):
+                metrics.incr("auth.jwks_unknown_kid")
+                self._refresh()
+            key = self._keys.get(kid)
+        if key is None:
+            raise JWTError(f"Unknown key id: {kid}")
+        return key
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of verified claims keyed by the SHA-256 hash of the token.
+    Entries are valid until the `exp` claim of the token.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = VERIFIED_TOKEN_CACHE_SIZE,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> dict | None:
+        key = self._key(token)
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is None:
+                return None
+            if claims["exp"] <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dict(claims)
+
+    def put(self, token: str, claims: dict):
+        if "exp" not in claims:
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = dict(claims)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+jwks_cache = JwksCache()
+verified_token_cache = VerifiedTokenCache()
+
 
 def verify_token(token: str) -> dict:
+    start = time.perf_counter()
+    decoded = verified_token_cache.get(token)
+    if decoded is not None:
+        metrics.timing(
+            "auth.verify_latency",
+            (time.perf_counter() - start) * 1000,
+            {"cache": "hit"},
+        )
+        return decoded
+
     # Verify JWT token
-    url = f"https://cognito-idp.{REGION}.amazonaws.com/{USER_POOL_ID}/.well-known/jwks.json"
-    response = requests.get(url)
-    keys = response.json()["keys"]
     header = jwt.get_unverified_header(token)
-    key = [k for k in keys if k["kid"] == header["kid"]][0]
+    key = jwks_cache.get_key(header["kid"])
     # The JWT returned from the Identity Provider may contain an at_hash
     # jose jwt.decode verifies id_token with access_token by default if it contains at_hash
     # See : https://github.com/mpdavis/python-jose/blob/4b0701b46a8d00988afcc5168c2b3a1fd60d15d8/jose/jwt.py#L59
@@ -27,4 +143,8 @@ def verify_token(token: str) -> dict:
         options={"verify_at_hash": False},
         audience=CLIENT_ID,
     )
+    verified_token_cache.put(token, decoded)
+    metrics.timing(
+        "auth.verify_latency", (time.perf_counter() - start) * 1000, {"cache": "miss"}
+    )
     return decoded
@@ -3,16 +3,31 @@ import json
 import logging
 import os
 import re
+import threading
+import time
 from pathlib import Path
-from typing import TypedDict, no_type_check
+from typing import Any, Callable, TypedDict, TypeVar, get_args, no_type_check
 
 from app.config import BEDROCK_PRICING, DEFAULT_EMBEDDING_CONFIG
 from app.config import DEFAULT_GENERATION_CONFIG as DEFAULT_CLAUDE_GENERATION_CONFIG
 from app.config import DEFAULT_MISTRAL_GENERATION_CONFIG
+from app.embedding_cache import get_embedding_cache
+from app.metrics import metrics
 from app.repositories.models.conversation import MessageModel
 from app.repositories.models.custom_bot import GenerationParamsModel, GuardrailConfig
+from app.resilience import (
+    CircuitOpenError,
+    call_with_retries,
+    get_circuit_breaker,
+    is_retryable_error,
+    is_throttling_error,
+)
 from app.routes.schemas.conversation import type_model_name
-from app.utils import convert_dict_keys_to_camel_case, get_bedrock_client
+from app.utils import (
+    LazyClient,
+    convert_dict_keys_to_camel_case,
+    get_bedrock_client,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -20,7 +35,13 @@ logger.setLevel(logging.INFO)
 GUARDRAIL_ID = os.environ.get("GUARDRAIL_ID", "gszoxoq81ovo")
 GUARDRAIL_VERSION = os.environ.get("GUARDRAIL_VERSION", "1")
 BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "ap-southeast-2")
-BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "ap-southeast-2")
+# Comma separated regions to fail over to when `BEDROCK_REGION` is throttled or unavailable.
+# A region is only used for a model if `BEDROCK_PRICING` lists the model in the region.
+BEDROCK_FALLBACK_REGIONS = [
+    r.strip()
+    for r in os.environ.get("BEDROCK_FALLBACK_REGIONS", "").split(",")
+    if r.strip()
+]
 ENABLE_MISTRAL = os.environ.get("ENABLE_MISTRAL", "") == "true"
 DEFAULT_GENERATION_CONFIG = (
     DEFAULT_MISTRAL_GENERATION_CONFIG
@@ -28,7 +49,13 @@ DEFAULT_GENERATION_CONFIG = (
     else DEFAULT_CLAUDE_GENERATION_CONFIG
 )
 
-client = get_bedrock_client()
+client = LazyClient(get_bedrock_client)
+
+# Cohere embed v3 accepts up to 96 texts per request
+# Ref: https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters-embed.html
+COHERE_MAX_TEXTS_PER_REQUEST = 96
+
+T = TypeVar("T")
 
 
 class ConverseApiRequest(TypedDict):
@@ -65,6 +92,8 @@ class ConverseApiResponse(TypedDict):
     output: ConverseApiResponseOutput
     stopReason: str
     usage: ConverseApiResponseUsage
+    # Region which actually served the request. Use this for price calculation.
+    region: str
 
 
 def compose_args(
@@ -232,21 +261,194 @@ def compose_args_for_converse_api(
     return args
 
 
+class RouteTarget:
+    """A (region, model id) pair which can serve a logical model."""
+
+    def __init__(self, region: str, model_id: str, endpoint_url: str | None = None):
+        self.region = region
+        self.model_id = model_id
+        # For testing against local stub endpoints
+        self.endpoint_url = endpoint_url
+        # Exponentially weighted moving average of the latency in milliseconds
+        self.latency_ms: float | None = None
+        # Monotonic time until which the target is deprioritized after throttling
+        self.throttled_until = 0.0
+        self.last_probe = 0.0
+
+    @property
+    def key(self) -> str:
+        return f"{self.region}/{self.model_id}"
+
+    def __repr__(self) -> str:
+        return f"RouteTarget({self.key})"
+
+
+class BedrockRouter:
+    """Route Converse calls for a logical model to an ordered list of targets.
+    Targets whose circuit is open or which were throttled in the last
+    `THROTTLE_COOLDOWN_SECONDS` are tried last.
+    Among healthy targets, traffic goes to the lowest observed latency; unobserved
+    fallback targets are only used after failover. While the primary target is not
+    preferred, one request every `PROBE_INTERVAL_SECONDS` is sent to it first, so that
+    it is preferred again once it recovers.
+    """
+
+    LATENCY_SMOOTHING = 0.2
+    THROTTLE_COOLDOWN_SECONDS = 30.0
+    PROBE_INTERVAL_SECONDS = 10.0
+
+    def __init__(
+        self,
+        routes: dict[str, list[RouteTarget]],
+        client_factory: Callable[[RouteTarget], Any] | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.routes = routes
+        self.client_factory = client_factory or (
+            lambda target: get_bedrock_client(target.region, target.endpoint_url)
+        )
+        self.clock = clock
+        self._clients: dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(
+        cls,
+        primary_region: str = BEDROCK_REGION,
+        fallback_regions: list[str] = BEDROCK_FALLBACK_REGIONS,
+    ) -> "BedrockRouter":
+        routes: dict[str, list[RouteTarget]] = {}
+        for model in get_args(type_model_name):
+            model_id = get_model_id(model)
+            targets = [RouteTarget(primary_region, model_id)]
+            for region in fallback_regions:
+                if region != primary_region and model in BEDROCK_PRICING.get(
+                    region, {}
+                ):
+                    targets.append(RouteTarget(region, model_id))
+            routes[model] = targets
+        return cls(routes)
+
+    def get_client(self, target: RouteTarget) -> Any:
+        with self._lock:
+            if target.key not in self._clients:
+                self._clients[target.key] = self.client_factory(target)
+            return self._clients[target.key]
+
+    def ordered_targets(self, model: type_model_name) -> list[RouteTarget]:
+        targets = self.routes.get(model) or [
+            RouteTarget(BEDROCK_REGION, get_model_id(model))
+        ]
+
+        now = self.clock()
+
+        def sort_key(indexed: tuple[int, RouteTarget]):
+            index, target = indexed
+            available = get_circuit_breaker(target.key).is_available()
+            throttled = now < target.throttled_until
+            if target.latency_ms is not None:
+                latency = target.latency_ms
+            else:
+                latency = 0.0 if index == 0 else float("inf")
+            return (not available, throttled, latency, index)
+
+        ordered = [t for _, t in sorted(enumerate(targets), key=sort_key)]
+        primary = targets[0]
+        with self._lock:
+            probe = (
+                ordered[0] is not primary
+                and now - primary.last_probe >= self.PROBE_INTERVAL_SECONDS
+                and get_circuit_breaker(primary.key).is_available()
+            )
+            if probe:
+                primary.last_probe = now
+        if probe:
+            metrics.incr("bedrock.probe", dimensions={"key": primary.key})
+            ordered.remove(primary)
+            ordered.insert(0, primary)
+        return ordered
+
+    def record_latency(self, target: RouteTarget, latency_ms: float):
+        if target.latency_ms is None:
+            target.latency_ms = latency_ms
+        else:
+            target.latency_ms += self.LATENCY_SMOOTHING * (
+                latency_ms - target.latency_ms
+            )
+        metrics.timing("bedrock.latency", latency_ms, {"key": target.key})
+
+    def invoke(
+        self, model: type_model_name, fn: Callable[[Any, RouteTarget], T]
+    ) -> tuple[T, RouteTarget]:
+        """Call `fn(client, target)` on the best target, failing over on throttling,
+        server errors or open circuits. Only the last target uses the full retry budget.
+        """
+        targets = self.ordered_targets(model)
+        for i, target in enumerate(targets):
+            is_last = i == len(targets) - 1
+            target_client = self.get_client(target)
+            start = time.perf_counter()
+            try:
+                result = call_with_retries(
+                    lambda: fn(target_client, target),
+                    key=target.key,
+                    max_attempts=None if is_last else 1,
+                )
+            except CircuitOpenError:
+                if is_last:
+                    raise
+            except Exception as e:
+                if is_throttling_error(e):
+                    now = self.clock()
+                    target.throttled_until = now + self.THROTTLE_COOLDOWN_SECONDS
+                    # The next probe is due one interval after the throttling
+                    target.last_probe = now
+                if is_last or not is_retryable_error(e):
+                    raise
+                logger.warning(f"Failing over from {target.key}: {e}")
+            else:
+                target.throttled_until = 0.0
+                self.record_latency(target, (time.perf_counter() - start) * 1000)
+                return result, target
+            metrics.incr("bedrock.failover", dimensions={"key": target.key})
+
+        raise RuntimeError("Unreachable")
+
+
+_router: BedrockRouter | None = None
+
+
+def get_router() -> BedrockRouter:
+    global _router
+    if _router is None:
+        _router = BedrockRouter.from_config()
+    return _router
+
+
+def get_model_name(model_id: str) -> type_model_name:
+    for model in get_args(type_model_name):
+        if get_model_id(model) == model_id:
+            return model
+    raise ValueError(f"Unknown model id: {model_id}")
+
+
 def call_converse_api(args: ConverseApiRequest) -> ConverseApiResponse:
-    client = get_bedrock_client()
     messages = args["messages"]
     inference_config = args["inference_config"]
     additional_model_request_fields = args["additional_model_request_fields"]
-    model_id = args["model_id"]
     system = args["system"]
 
-    response = client.converse(
-        modelId=model_id,
-        messages=messages,
-        inferenceConfig=inference_config,
-        system=system,
-        additionalModelRequestFields=additional_model_request_fields,
+    response, target = get_router().invoke(
+        get_model_name(args["model_id"]),
+        lambda client, target: client.converse(
+            modelId=target.model_id,
+            messages=messages,
+            inferenceConfig=inference_config,
+            system=system,
+            additionalModelRequestFields=additional_model_request_fields,
+        ),
     )
+    response["region"] = target.region
 
     return response
 
@@ -294,48 +496,92 @@ def get_model_id(model: type_model_name) -> str:
 
 
 def calculate_query_embedding(question: str) -> list[float]:
+    """Calculate the embedding of a search query. Results are cached by normalized text."""
+    model_id = DEFAULT_EMBEDDING_CONFIG["model_id"]
+    return get_embedding_cache().get_or_compute(
+        model_id, question, _invoke_query_embedding
+    )
+
+
+def calculate_query_embeddings(questions: list[str]) -> list[list[float]]:
+    """Calculate the embeddings of several search queries.
+    Queries missing from the cache are embedded with a single request.
+    """
+    model_id = DEFAULT_EMBEDDING_CONFIG["model_id"]
+    embeddings: list[list[float]] = []
+    for i in range(0, len(questions), COHERE_MAX_TEXTS_PER_REQUEST):
+        embeddings.extend(
+            get_embedding_cache().get_or_compute_many(
+                model_id,
+                questions[i : i + COHERE_MAX_TEXTS_PER_REQUEST],
+                _invoke_query_embeddings,
+            )
+        )
+    return embeddings
+
+
+def _invoke_query_embedding(question: str) -> list[float]:
+    return _invoke_query_embeddings([question])[0]
+
+
+def _invoke_query_embeddings(questions: list[str]) -> list[list[float]]:
     model_id = DEFAULT_EMBEDDING_CONFIG["model_id"]
 
     # Currently only supports "cohere.embed-multilingual-v3"
     assert model_id == "cohere.embed-multilingual-v3"
 
-    payload = json.dumps({"texts": [question], "input_type": "search_query"})
+    payload = json.dumps({"texts": questions, "input_type": "search_query"})
     accept = "application/json"
     content_type = "application/json"
 
-    response = client.invoke_model(
-        accept=accept, contentType=content_type, body=payload, modelId=model_id
+    response = call_with_retries(
+        lambda: client.invoke_model(
+            accept=accept, contentType=content_type, body=payload, modelId=model_id
+        ),
+        key=model_id,
     )
     output = json.loads(response.get("body").read())
-    embedding = output.get("embeddings")[0]
-
-    return embedding
-
-
-def calculate_document_embeddings(documents: list[str]) -> list[list[float]]:
-    def _calculate_document_embeddings(documents: list[str]) -> list[list[float]]:
-        payload = json.dumps({"texts": documents, "input_type": "search_document"})
-        accept = "application/json"
-        content_type = "application/json"
+    embeddings = output.get("embeddings")
 
-        response = client.invoke_model(
-            accept=accept, contentType=content_type, body=payload, modelId=model_id
-        )
-        output = json.loads(response.get("body").read())
-        embeddings = output.get("embeddings")
+    return embeddings
 
-        return embeddings
 
-    BATCH_SIZE = 10
+def invoke_document_embeddings(
+    texts: list[str], max_attempts: int | None = None
+) -> list[list[float]]:
+    """Calculate embeddings of `texts` in a single request.
+    The caller is responsible for respecting the model limits (see `COHERE_MAX_TEXTS_PER_REQUEST`).
+    """
     model_id = DEFAULT_EMBEDDING_CONFIG["model_id"]
 
     # Currently only supports "cohere.embed-multilingual-v3"
     assert model_id == "cohere.embed-multilingual-v3"
 
+    payload = json.dumps({"texts": texts, "input_type": "search_document"})
+    accept = "application/json"
+    content_type = "application/json"
+
+    response = call_with_retries(
+        lambda: client.invoke_model(
+            accept=accept, contentType=content_type, body=payload, modelId=model_id
+        ),
+        key=model_id,
+        max_attempts=max_attempts,
+    )
+    output = json.loads(response.get("body").read())
+    embeddings = output.get("embeddings")
+
+    return embeddings
+
+
+def calculate_document_embeddings(documents: list[str]) -> list[list[float]]:
+    """Calculate embeddings sequentially.
+    For large number of documents, use `embedding.engine.EmbeddingEngine` instead.
+    """
     embeddings = []
-    for i in range(0, len(documents), BATCH_SIZE):
+    for i in range(0, len(documents), COHERE_MAX_TEXTS_PER_REQUEST):
         # Split documents into batches to avoid exceeding the payload size limit
-        batch = documents[i : i + BATCH_SIZE]
-        embeddings += _calculate_document_embeddings(batch)
+        batch = documents[i : i + COHERE_MAX_TEXTS_PER_REQUEST]
+        embeddings += invoke_document_embeddings(batch)
 
     return embeddings
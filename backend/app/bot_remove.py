@@ -1,50 +1,32 @@
-import json
 import os
-from typing import Any
 
 import boto3
-import pg8000
+from app.pgvector import drop_bot_items
+from app.postgres import pool
 from app.repositories.api_publication import delete_api_key, find_usage_plan_by_id
 from app.repositories.api_publication import (
     delete_stack_by_bot_id,
     find_stack_by_bot_id,
 )
 from app.repositories.common import RecordNotFoundError, decompose_bot_id
-from aws_lambda_powertools.utilities import parameters
 from app.repositories.custom_bot import find_public_bot_by_id
+from app.utils import LazyClient
 
-DB_SECRETS_ARN = os.environ.get("DB_SECRETS_ARN", "")
 DOCUMENT_BUCKET = os.environ.get("DOCUMENT_BUCKET", "documents")
 
-s3_client = boto3.client("s3")
+s3_client = LazyClient(lambda: boto3.client("s3"))
 
 
 def delete_from_postgres(bot_id: str):
     """Delete data related to `bot_id` from vector store (i.e. PostgreSQL)."""
 
-    secrets: Any = parameters.get_secret(DB_SECRETS_ARN)  # type: ignore
-    db_info = json.loads(secrets)
-
-    conn = pg8000.connect(
-        database=db_info["dbname"],
-        host=db_info["host"],
-        port=db_info["port"],
-        user=db_info["username"],
-        password=db_info["password"],
-    )
-
     try:
-        with conn.cursor() as cursor:
-            delete_query = "DELETE FROM items WHERE botid = %s"
-            cursor.execute(delete_query, (bot_id,))
-        conn.commit()
+        with pool.connection() as pooled:
+            drop_bot_items(pooled.conn, bot_id)
         print(f"Successfully deleted records for bot_id: {bot_id}")
     except Exception as e:
-        conn.rollback()
         print(f"Error deleting records for bot_id: {bot_id}")
         print(e)
-    finally:
-        conn.close()
 
 
 def delete_kb_stack_by_bot_id(bot_id: str):
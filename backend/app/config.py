@@ -16,6 +16,148 @@ class EmbeddingConfig(TypedDict):
     enable_partition_pdf: bool
 
 
+class RetryConfig(TypedDict):
+    max_attempts: int
+    # Base delay (seconds) for exponential backoff on transient errors
+    base_delay: float
+    # Base delay (seconds) for exponential backoff on throttling errors
+    throttling_base_delay: float
+    max_delay: float
+    # Number of consecutive failures to open the circuit
+    failure_threshold: int
+    # Seconds to wait before allowing a probe request on an open circuit
+    recovery_timeout: float
+
+
+class EmbeddingCacheConfig(TypedDict):
+    # Maximum number of embeddings kept in process memory
+    max_entries: int
+    # Time to live (seconds) of the entries in the persistent tier
+    ttl_seconds: int
+
+
+class RetrievalCacheConfig(TypedDict):
+    # Maximum number of results kept in process memory
+    max_entries: int
+    # Time to live (seconds) of the entries. Entries are invalidated by the knowledge
+    # version of the bot, so this only bounds how long unused entries are kept.
+    ttl_seconds: int
+
+
+class PresignedUrlCacheConfig(TypedDict):
+    # Maximum number of presigned download URLs kept in process memory
+    max_entries: int
+    # Expiration (seconds) of the cached URLs
+    expiration_seconds: int
+    # Cached URLs are replaced once less than this many seconds of validity remain,
+    # so that clients always get a URL usable for at least this long
+    refresh_margin_seconds: int
+
+
+class RetrievalSnapshotConfig(TypedDict):
+    # How long (seconds) the search results of a chat turn are kept
+    ttl_seconds: int
+    # How long (seconds) the related documents endpoint waits for the snapshot of a turn
+    # which is still retrieving, before searching by itself
+    wait_seconds: float
+    poll_interval_seconds: float
+
+
+class StreamingConfig(TypedDict):
+    # Buffered tokens are sent once the oldest one has waited this long (milliseconds).
+    # Set 0 to send every token as its own frame.
+    flush_interval_ms: int
+    # Buffered tokens are sent once their total size reaches this many bytes
+    max_frame_bytes: int
+    # Maximum number of frames waiting for the sender thread. When the queue is full,
+    # the stream reader blocks until the sender catches up.
+    sender_queue_size: int
+    # Minimum interval between checks whether the client cancelled the generation (milliseconds).
+    # Cancellation is checked when a frame is sent.
+    cancellation_check_interval_ms: int
+
+
+class PostgresPoolConfig(TypedDict):
+    # Maximum number of connections (both in use and idle) per process
+    max_connections: int
+    # Idle connections older than this (seconds) are closed instead of reused
+    max_idle_seconds: int
+    # Idle connections unused for this long (seconds) are checked with `SELECT 1` before reuse
+    health_check_interval_seconds: int
+    # How long (seconds) the database secret is cached
+    secret_max_age_seconds: int
+
+
+class VectorIndexConfig(TypedDict):
+    # ANN index method of the `items.embedding` column: "hnsw" or "ivfflat"
+    method: str
+    # HNSW build parameters
+    m: int
+    ef_construction: int
+    # Number of IVFFlat lists
+    lists: int
+    # Dimension of the stored embeddings
+    dimensions: int
+    # Vectors indexed by the ANN index: "none" (full precision `vector`), "halfvec"
+    # (half precision) or "binary" (one bit per dimension, Hamming distance).
+    # The table always keeps full precision vectors for re-ranking.
+    quantization: str
+    # With quantization, the ANN index fetches `limit * rerank_factor` candidates which
+    # are re-ranked by full precision distance. Set 1 to disable re-ranking.
+    rerank_factor: int
+    # Default search breadth, overridable per bot with `SearchParams`
+    ef_search: int
+    probes: int
+
+
+class LocalIndexConfig(TypedDict):
+    # Bots with at most this many chunks get a local index snapshot
+    max_chunks: int
+    # Maximum total size (bytes) of the local indexes kept by a process. Least recently
+    # used indexes are evicted and their files removed when exceeded.
+    max_cache_bytes: int
+    # How long (seconds) a missing snapshot is remembered before it is looked up again
+    absent_ttl_seconds: int
+
+
+class EmbeddingPipelineConfig(TypedDict):
+    # Maximum number of items waiting between two stages
+    queue_size: int
+    # Worker processes loading (parsing) files. None for the number of CPUs.
+    loader_workers: int | None
+    splitter_workers: int
+    # Concurrent embedding requests are also limited by the engine
+    embedding_workers: int
+    # Chunks per embedding request
+    embedding_batch_size: int
+    # Rows per write to the staging table
+    write_batch_size: int
+
+
+class ContextSelectionConfig(TypedDict):
+    # Estimated tokens of retrieved chunks inserted into the prompt, overridable per
+    # bot with `SearchParams`
+    max_context_tokens: int
+    # Chunks sharing at least this fraction of their text with a higher ranked chunk
+    # are dropped as duplicates
+    duplicate_threshold: float
+    # Trade-off of maximal marginal relevance between relevance (1) and diversity (0)
+    mmr_lambda: float
+    # Chunks less similar to the query than this are dropped. None to keep all chunks.
+    # Vector store scores are cosine similarities; knowledge base scores are relevance scores.
+    min_score: float | None
+
+
+class FederatedSearchConfig(TypedDict):
+    # Results of the sources which answered within this many seconds are returned
+    deadline_seconds: float
+    # Maximum number of sources searched concurrently per process
+    max_workers: int
+    # A source is skipped while this many of its searches are still running past their
+    # deadline, so that a slow source cannot take over all the workers
+    max_stragglers_per_source: int
+
+
 # Configure generation parameter for Claude chat response.
 # Adjust the values according to your application.
 # See: https://docs.anthropic.com/claude/reference/complete_post
@@ -46,6 +188,115 @@ DEFAULT_EMBEDDING_CONFIG: EmbeddingConfig = {
     "enable_partition_pdf": False,
 }
 
+# Configure retry and circuit breaker behavior for Bedrock calls.
+# NOTE: botocore retries are disabled for Bedrock clients, so these values control all retries.
+DEFAULT_BEDROCK_RETRY_CONFIG: RetryConfig = {
+    "max_attempts": 4,
+    "base_delay": 0.5,
+    "throttling_base_delay": 2.0,
+    "max_delay": 20.0,
+    "failure_threshold": 5,
+    "recovery_timeout": 30.0,
+}
+
+# Configure query embedding cache.
+# The persistent tier is enabled only if `QUERY_EMBEDDING_CACHE_TABLE_NAME` is set.
+DEFAULT_EMBEDDING_CACHE_CONFIG: EmbeddingCacheConfig = {
+    "max_entries": 1024,
+    "ttl_seconds": 7 * 24 * 60 * 60,
+}
+
+# Configure retrieval result cache.
+# The persistent tier is enabled only if `RETRIEVAL_CACHE_TABLE_NAME` is set.
+DEFAULT_RETRIEVAL_CACHE_CONFIG: RetrievalCacheConfig = {
+    "max_entries": 512,
+    "ttl_seconds": 24 * 60 * 60,
+}
+
+# Configure the cache of presigned URLs of cited S3 sources.
+DEFAULT_PRESIGNED_URL_CACHE_CONFIG: PresignedUrlCacheConfig = {
+    "max_entries": 1024,
+    "expiration_seconds": 60 * 60,
+    "refresh_margin_seconds": 5 * 60,
+}
+
+# Configure the snapshots of the search results of chat turns (see `app/retrieval_snapshot.py`).
+# Enabled only if `RETRIEVAL_SNAPSHOT_TABLE_NAME` is set.
+DEFAULT_RETRIEVAL_SNAPSHOT_CONFIG: RetrievalSnapshotConfig = {
+    "ttl_seconds": 24 * 60 * 60,
+    "wait_seconds": 10.0,
+    "poll_interval_seconds": 0.5,
+}
+
+# Configure how streamed tokens are coalesced into websocket frames.
+# NOTE: API Gateway websocket frames are limited to 32KB.
+DEFAULT_STREAMING_CONFIG: StreamingConfig = {
+    "flush_interval_ms": 50,
+    "max_frame_bytes": 4096,
+    "sender_queue_size": 64,
+    "cancellation_check_interval_ms": 1000,
+}
+
+# Configure the PostgreSQL (pgvector) connection pool.
+DEFAULT_POSTGRES_POOL_CONFIG: PostgresPoolConfig = {
+    "max_connections": 4,
+    "max_idle_seconds": 300,
+    "health_check_interval_seconds": 30,
+    "secret_max_age_seconds": 300,
+}
+
+# Configure the ANN index of the pgvector `items` table.
+# Higher `ef_search` / `probes` improve recall at the cost of latency.
+# Run `python -m app.pgvector report --bot-id <bot_id>` to measure the trade-off.
+DEFAULT_VECTOR_INDEX_CONFIG: VectorIndexConfig = {
+    "method": "hnsw",
+    "m": 16,
+    "ef_construction": 64,
+    "lists": 100,
+    "dimensions": 1024,
+    "quantization": "none",
+    "rerank_factor": 4,
+    "ef_search": 40,
+    "probes": 10,
+}
+
+# Configure the in-process vector index of small bots (see `app/local_index.py`).
+# Larger bots search pgvector.
+# NOTE: Lambda `/tmp` is 512MB by default, which bounds `max_cache_bytes`.
+DEFAULT_LOCAL_INDEX_CONFIG: LocalIndexConfig = {
+    "max_chunks": 20000,
+    "max_cache_bytes": 256 * 1024 * 1024,
+    "absent_ttl_seconds": 300,
+}
+
+# Configure the streaming pipeline of the embedding job (see `embedding/main.py`).
+# Memory is bounded by about `queue_size` items per stage.
+DEFAULT_EMBEDDING_PIPELINE_CONFIG: EmbeddingPipelineConfig = {
+    "queue_size": 8,
+    "loader_workers": None,
+    "splitter_workers": 2,
+    "embedding_workers": 8,
+    "embedding_batch_size": 96,
+    "write_batch_size": 500,
+}
+
+# Configure the selection of the retrieved chunks inserted into the prompt.
+# See `app/context_selection.py`.
+DEFAULT_CONTEXT_SELECTION_CONFIG: ContextSelectionConfig = {
+    "max_context_tokens": 6000,
+    "duplicate_threshold": 0.8,
+    "mmr_lambda": 0.7,
+    "min_score": None,
+}
+
+# Configure search of bots with several knowledge sources, e.g. federated knowledge
+# bases or a knowledge base and the vector store. Results are merged by reciprocal rank fusion.
+DEFAULT_FEDERATED_SEARCH_CONFIG: FederatedSearchConfig = {
+    "deadline_seconds": 5.0,
+    "max_workers": 8,
+    "max_stragglers_per_source": 2,
+}
+
 # Configure search parameter to fetch relevant documents from vector store.
 DEFAULT_SEARCH_CONFIG = {
     "max_results": 20,
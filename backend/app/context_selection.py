@@ -0,0 +1,147 @@
+"""Selection of the retrieved chunks inserted into the prompt.
+Search results often contain near duplicates, e.g. the same passage found by several
+queries or sources, or documents uploaded twice. Before the RAG prompt is built the
+results are:
+1. filtered by a minimum similarity to the query, if configured,
+2. deduplicated: chunks mostly contained in a higher ranked chunk are dropped,
+3. reordered by maximal marginal relevance (MMR) to favor diverse chunks,
+4. packed into the token budget of the bot.
+The selected results are re-ranked from 0, so that `[^rank]` citations of the answer
+refer to the selected list.
+"""
+
+import logging
+import re
+
+from app.config import DEFAULT_CONTEXT_SELECTION_CONFIG, ContextSelectionConfig
+from app.metrics import metrics
+from app.vector_search import SearchResult
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Length (characters) of the shingles compared between chunks
+SHINGLE_SIZE = 8
+
+
+class ContextSelection(BaseModel):
+    results: list[SearchResult]
+    # Estimated tokens of all the retrieved chunks and of the selected ones
+    retrieved_tokens: int
+    selected_tokens: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.retrieved_tokens - self.selected_tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: about 4 characters per token for ASCII text, and one token
+    per character for other scripts (e.g. Japanese).
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def _shingles(text: str) -> set[int]:
+    normalized = re.sub(r"\s+", " ", text).strip().lower()
+    if len(normalized) <= SHINGLE_SIZE:
+        return {hash(normalized)} if normalized else set()
+    return {
+        hash(normalized[i : i + SHINGLE_SIZE])
+        for i in range(len(normalized) - SHINGLE_SIZE + 1)
+    }
+
+
+def _containment(a: set[int], b: set[int]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _jaccard(a: set[int], b: set[int]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _relevances(results: list[SearchResult]) -> list[float]:
+    """Relevance in [0, 1]: normalized scores if every result has one, else by rank."""
+    scores = [r.score for r in results]
+    if all(score is not None for score in scores):
+        low, high = min(scores), max(scores)  # type: ignore
+        if high > low:
+            return [(score - low) / (high - low) for score in scores]  # type: ignore
+        return [1.0] * len(results)
+    return [1 - i / len(results) for i in range(len(results))]
+
+
+def select_context(
+    results: list[SearchResult],
+    max_context_tokens: int | None = None,
+    config: ContextSelectionConfig = DEFAULT_CONTEXT_SELECTION_CONFIG,
+) -> ContextSelection:
+    """Select the chunks to insert into the prompt. `results` must be in rank order.
+    `max_context_tokens` overrides the budget of the config. The top chunk is always
+    selected, even if it alone exceeds the budget.
+    """
+    budget = max_context_tokens or config["max_context_tokens"]
+    retrieved_tokens = sum(estimate_tokens(r.content) for r in results)
+
+    min_score = config["min_score"]
+    candidates = [
+        r
+        for r in results
+        if min_score is None or r.score is None or r.score >= min_score
+    ]
+
+    shingles: list[set[int]] = []
+    unique: list[SearchResult] = []
+    for result in candidates:
+        result_shingles = _shingles(result.content)
+        if any(
+            _containment(result_shingles, kept) >= config["duplicate_threshold"]
+            for kept in shingles
+        ):
+            continue
+        shingles.append(result_shingles)
+        unique.append(result)
+
+    relevances = _relevances(unique)
+    mmr_lambda = config["mmr_lambda"]
+    remaining = list(range(len(unique)))
+    max_similarities = [0.0] * len(unique)
+    selected: list[SearchResult] = []
+    selected_tokens = 0
+    while remaining:
+        best = max(
+            remaining,
+            key=lambda i: mmr_lambda * relevances[i]
+            - (1 - mmr_lambda) * max_similarities[i],
+        )
+        remaining.remove(best)
+        tokens = estimate_tokens(unique[best].content)
+        if selected and selected_tokens + tokens > budget:
+            # Smaller chunks ranked lower may still fit
+            continue
+        selected.append(unique[best].model_copy(update={"rank": len(selected)}))
+        selected_tokens += tokens
+        for i in remaining:
+            max_similarities[i] = max(
+                max_similarities[i], _jaccard(shingles[i], shingles[best])
+            )
+
+    selection = ContextSelection(
+        results=selected,
+        retrieved_tokens=retrieved_tokens,
+        selected_tokens=selected_tokens,
+    )
+    metrics.incr("context_selection.tokens_saved", selection.tokens_saved)
+    metrics.incr("context_selection.dropped", len(results) - len(selected))
+    logger.info(
+        f"Selected {len(selected)} of {len(results)} chunks "
+        f"({selected_tokens} of {retrieved_tokens} estimated tokens, "
+        f"{selection.tokens_saved} saved)."
+    )
+    return selection
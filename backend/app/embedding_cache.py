@@ -0,0 +1,204 @@
+"""Cache of query embeddings.
+Entries are keyed by the embedding model id and the normalized query text, which is
+also the text that gets embedded. The first
+tier is an in-process LRU which survives across invocations of a warm Lambda. The
+optional second tier is a DynamoDB table shared by all processes, where embeddings are
+stored compactly as float32 bytes.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Callable
+
+import boto3
+from app.config import DEFAULT_EMBEDDING_CACHE_CONFIG, EmbeddingCacheConfig
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+QUERY_EMBEDDING_CACHE_TABLE_NAME = os.environ.get(
+    "QUERY_EMBEDDING_CACHE_TABLE_NAME", ""
+)
+
+
+def normalize_query(text: str) -> str:
+    """Normalize unicode and whitespace so that trivially different queries share an entry.
+    Case is kept, as it can change the embedding.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def compose_cache_key(model_id: str, text: str) -> str:
+    digest = hashlib.sha256(normalize_query(text).encode("utf-8")).hexdigest()
+    return f"{model_id}#{digest}"
+
+
+def encode_embedding(embedding: list[float]) -> bytes:
+    # Stored in little-endian float32 regardless of the platform
+    values = array("f", embedding)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def decode_embedding(data: bytes) -> list[float]:
+    values = array("f")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tolist()
+
+
+class DynamoDBEmbeddingStore:
+    """Persistent tier storing float32 embeddings in a DynamoDB table.
+    The table must have a string partition key `CacheKey` and TTL enabled on `expire`.
+    """
+
+    def __init__(self, table_name: str, ttl_seconds: int):
+        self.table = boto3.resource("dynamodb").Table(table_name)
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key: str) -> list[float] | None:
+        item = self.table.get_item(Key={"CacheKey": key}).get("Item")
+        if not item or int(item.get("expire", 0)) < time.time():
+            return None
+        return decode_embedding(item["Embedding"].value)
+
+    def put(self, key: str, embedding: list[float]):
+        self.table.put_item(
+            Item={
+                "CacheKey": key,
+                "Embedding": encode_embedding(embedding),
+                "expire": int(time.time()) + self.ttl_seconds,
+            }
+        )
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        config: EmbeddingCacheConfig = DEFAULT_EMBEDDING_CACHE_CONFIG,
+        store: DynamoDBEmbeddingStore | None = None,
+    ):
+        self.max_entries = config["max_entries"]
+        self.store = store
+        self._entries: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_local(self, key: str) -> list[float] | None:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+            return embedding
+
+    def _put_local(self, key: str, embedding: list[float]):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, key: str) -> list[float] | None:
+        embedding = self._get_local(key)
+        if embedding is not None:
+            metrics.incr("embedding_cache.hit", dimensions={"tier": "memory"})
+            return embedding
+
+        if self.store is not None:
+            try:
+                with metrics.timer("embedding_cache.store_latency"):
+                    embedding = self.store.get(key)
+            except Exception as e:
+                logger.warning(f"Failed to read embedding cache: {e}")
+            if embedding is not None:
+                metrics.incr("embedding_cache.hit", dimensions={"tier": "store"})
+                self._put_local(key, embedding)
+                return embedding
+
+        metrics.incr("embedding_cache.miss")
+        return None
+
+    def _save(self, key: str, embedding: list[float]):
+        self._put_local(key, embedding)
+        if self.store is not None:
+            try:
+                self.store.put(key, embedding)
+            except Exception as e:
+                logger.warning(f"Failed to write embedding cache: {e}")
+
+    def get_or_compute(
+        self, model_id: str, text: str, compute: Callable[[str], list[float]]
+    ) -> list[float]:
+        """Return the cached embedding of `text`, or compute and cache the embedding of
+        its normalized form. Errors of the persistent tier are logged and treated as a
+        miss.
+        """
+        key = compose_cache_key(model_id, text)
+        embedding = self._lookup(key)
+        if embedding is not None:
+            return embedding
+
+        with metrics.timer("embedding_cache.compute_latency"):
+            embedding = compute(normalize_query(text))
+        self._save(key, embedding)
+        return embedding
+
+    def get_or_compute_many(
+        self,
+        model_id: str,
+        texts: list[str],
+        compute: Callable[[list[str]], list[list[float]]],
+    ) -> list[list[float]]:
+        """Like `get_or_compute`, but computes all the missing embeddings with a single call."""
+        keys = [compose_cache_key(model_id, text) for text in texts]
+        found: dict[str, list[float]] = {}
+        missing: dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key in found or key in missing:
+                continue
+            embedding = self._lookup(key)
+            if embedding is not None:
+                found[key] = embedding
+            else:
+                missing[key] = normalize_query(text)
+
+        if missing:
+            with metrics.timer("embedding_cache.compute_latency"):
+                embeddings = compute(list(missing.values()))
+            for key, embedding in zip(missing, embeddings):
+                self._save(key, embedding)
+                found[key] = embedding
+        return [found[key] for key in keys]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache: EmbeddingCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            store = None
+            if QUERY_EMBEDDING_CACHE_TABLE_NAME:
+                store = DynamoDBEmbeddingStore(
+                    QUERY_EMBEDDING_CACHE_TABLE_NAME,
+                    DEFAULT_EMBEDDING_CACHE_CONFIG["ttl_seconds"],
+                )
+            _cache = EmbeddingCache(store=store)
+        return _cache
@@ -0,0 +1,299 @@
+"""In-process vector index of small bots.
+The embedding job writes a snapshot of the knowledge of bots with at most `max_chunks`
+chunks to the document bucket, under `<user_id>/<bot_id>/vector_index/<exec_id>/`:
+the embeddings as a float32 `.npy` matrix and the chunks as gzipped JSON.
+Chat processes download the snapshot of the last sync once, memory-map the matrix and
+search it exactly (L2 distance, like pgvector) without a database round trip.
+Larger bots and bots without a snapshot search pgvector.
+"""
+
+import gzip
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import boto3
+import numpy as np
+from app.config import DEFAULT_LOCAL_INDEX_CONFIG, LocalIndexConfig
+from app.metrics import metrics
+from app.utils import LazyClient, compose_vector_index_s3_prefix
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DOCUMENT_BUCKET = os.environ.get("DOCUMENT_BUCKET", "")
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "local_index")
+
+EMBEDDINGS_FILENAME = "embeddings.npy"
+CHUNKS_FILENAME = "chunks.json.gz"
+SNAPSHOT_VERSION = 1
+
+s3_client = LazyClient(lambda: boto3.client("s3"))
+
+# (bot_id, content, source, score) of each result, in rank order
+type_results = list[tuple[str, str, str, float]]
+
+
+def is_available() -> bool:
+    return bool(DOCUMENT_BUCKET)
+
+
+def compose_snapshot_prefix(user_id: str, bot_id: str, exec_id: str) -> str:
+    return f"{compose_vector_index_s3_prefix(user_id, bot_id)}{exec_id}/"
+
+
+def encode_chunks(chunks: list[tuple[str, str]]) -> bytes:
+    return gzip.compress(
+        json.dumps(
+            {"version": SNAPSHOT_VERSION, "chunks": [list(c) for c in chunks]},
+            separators=(",", ":"),
+        ).encode("utf-8")
+    )
+
+
+def decode_chunks(data: bytes) -> list[tuple[str, str]]:
+    body = json.loads(gzip.decompress(data))
+    if body.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version: {body.get('version')}")
+    return [tuple(c) for c in body["chunks"]]  # type: ignore
+
+
+def delete_snapshots(bucket: str, user_id: str, bot_id: str, keep: str | None = None):
+    """Delete the snapshots of the bot, except the one under the prefix `keep`."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    prefix = compose_vector_index_s3_prefix(user_id, bot_id)
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [
+            obj["Key"]
+            for obj in page.get("Contents", [])
+            if keep is None or not obj["Key"].startswith(keep)
+        ]
+        if keys:
+            s3_client.delete_objects(
+                Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys]}
+            )
+
+
+def write_snapshot(
+    bucket: str,
+    user_id: str,
+    bot_id: str,
+    exec_id: str,
+    embeddings: "np.ndarray",
+    chunks: list[tuple[str, str]],
+):
+    """Upload the snapshot of the bot and delete its older snapshots.
+    `chunks` are the `(content, source)` of each row of `embeddings`.
+    """
+    if len(embeddings) != len(chunks):
+        raise ValueError(f"Got {len(embeddings)} embeddings for {len(chunks)} chunks")
+    prefix = compose_snapshot_prefix(user_id, bot_id, exec_id)
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(embeddings, dtype=np.float32))
+    # The chunks are written last, readers treat a snapshot without them as missing
+    s3_client.put_object(
+        Bucket=bucket, Key=f"{prefix}{EMBEDDINGS_FILENAME}", Body=buffer.getvalue()
+    )
+    s3_client.put_object(
+        Bucket=bucket, Key=f"{prefix}{CHUNKS_FILENAME}", Body=encode_chunks(chunks)
+    )
+    delete_snapshots(bucket, user_id, bot_id, keep=prefix)
+
+
+class LocalIndex:
+    """Exact nearest neighbor search over a memory-mapped float32 matrix."""
+
+    def __init__(self, bot_id: str, path: str, chunks: list[tuple[str, str]]):
+        embeddings = np.load(path, mmap_mode="r")
+        if embeddings.ndim != 2 or len(embeddings) != len(chunks):
+            raise ValueError(
+                f"Snapshot has {embeddings.shape} embeddings for {len(chunks)} chunks"
+            )
+        self.bot_id = bot_id
+        self.path = path
+        self.embeddings = embeddings
+        self.chunks = chunks
+        # Squared norms of the rows, so that a search is a single matrix product
+        self.norms = np.einsum("ij,ij->i", embeddings, embeddings)
+        self.nbytes = os.path.getsize(path) + sum(
+            len(content) + len(source) for content, source in chunks
+        )
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def search_many(
+        self, query_embeddings: list[list[float]], limit: int
+    ) -> list[type_results]:
+        """Return the `limit` nearest chunks of each query, nearest first."""
+        k = min(limit, len(self.chunks))
+        if k <= 0:
+            return [[] for _ in query_embeddings]
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2, where |q|^2 is added to the top k only
+        distances = self.norms[np.newaxis, :] - 2 * (queries @ self.embeddings.T)
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+        results: list[type_results] = []
+        for query, row, candidates in zip(queries, distances, top):
+            ordered = candidates[np.argsort(row[candidates], kind="stable")]
+            squared = np.maximum(row[ordered] + float(query @ query), 0.0)
+            results.append(
+                [
+                    (self.bot_id, *self.chunks[i], 1 - float(d) / 2)  # type: ignore
+                    for i, d in zip(ordered.tolist(), squared.tolist())
+                ]
+            )
+        return results
+
+    def search(self, query_embedding: list[float], limit: int) -> type_results:
+        return self.search_many([query_embedding], limit)[0]
+
+    def remove_file(self):
+        """Remove the downloaded snapshot from the disk. The matrix stays mapped until
+        the index is garbage collected, so callers still holding it can search it.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def load_snapshot(bot_id: str, prefix: str) -> LocalIndex | None:
+    """Download the snapshot under `prefix`. Returns None if there is no snapshot."""
+    try:
+        response = s3_client.get_object(
+            Bucket=DOCUMENT_BUCKET, Key=f"{prefix}{CHUNKS_FILENAME}"
+        )
+    except ClientError as e:
+        # Without `s3:ListBucket`, S3 answers 403 for missing keys
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404", "403", "AccessDenied"):
+            return None
+        raise
+    chunks = decode_chunks(response["Body"].read())
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, prefix.strip("/").replace("/", "_") + ".npy")
+    s3_client.download_file(DOCUMENT_BUCKET, f"{prefix}{EMBEDDINGS_FILENAME}", path)
+    return LocalIndex(bot_id, path, chunks)
+
+
+class LocalIndexCache:
+    """Loaded indexes of a process, evicted in least recently used order once their
+    total size exceeds `max_cache_bytes`. Missing snapshots are remembered for
+    `absent_ttl_seconds` so that bots without a snapshot do not hit S3 on every turn.
+    Loads of a snapshot are serialized so that concurrent requests download it only
+    once, while the indexes of other bots are still served and loaded meanwhile.
+    """
+
+    def __init__(
+        self,
+        config: LocalIndexConfig = DEFAULT_LOCAL_INDEX_CONFIG,
+        load: Callable[[str, str], LocalIndex | None] = load_snapshot,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_cache_bytes = config["max_cache_bytes"]
+        self.absent_ttl_seconds = config["absent_ttl_seconds"]
+        self.load = load
+        self.clock = clock
+        self.size = 0
+        self._indexes: OrderedDict[str, LocalIndex] = OrderedDict()
+        self._absent: dict[str, float] = {}
+        self._loading: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        # The most recently loaded index is kept even if it alone exceeds the budget.
+        # Evicted indexes may still be searched by the callers holding them, so only
+        # their file is removed.
+        while self.size > self.max_cache_bytes and len(self._indexes) > 1:
+            _, index = self._indexes.popitem(last=False)
+            self.size -= index.nbytes
+            index.remove_file()
+            metrics.incr("local_index.evicted")
+
+    def _lookup(self, key: str) -> tuple[bool, LocalIndex | None]:
+        """Return whether `key` is cached, as loaded or as absent, and its index.
+        Must be called with the lock held.
+        """
+        index = self._indexes.get(key)
+        if index is not None:
+            self._indexes.move_to_end(key)
+            metrics.incr("local_index.hit")
+            return True, index
+
+        now = self.clock()
+        expire = self._absent.get(key)
+        if expire is not None and expire > now:
+            return True, None
+        self._absent = {k: e for k, e in self._absent.items() if e > now}
+        return False, None
+
+    def get(
+        self, user_id: str, bot_id: str, exec_id: str, knowledge_version: int
+    ) -> LocalIndex | None:
+        prefix = compose_snapshot_prefix(user_id, bot_id, exec_id)
+        # The knowledge version changes when the sync succeeds, so a snapshot found
+        # missing while the sync was running is looked up again right away
+        key = f"{prefix}#{knowledge_version}"
+        with self._lock:
+            cached, index = self._lookup(key)
+            if cached:
+                return index
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            # Another request may have loaded it while this one was waiting
+            with self._lock:
+                cached, index = self._lookup(key)
+            if cached:
+                return index
+
+            try:
+                with metrics.timer("local_index.load_latency"):
+                    index = self.load(bot_id, prefix)
+            except Exception as e:
+                logger.warning(f"Failed to load local index {prefix}: {e}")
+                index = None
+
+            with self._lock:
+                self._loading.pop(key, None)
+                if index is None:
+                    metrics.incr("local_index.absent")
+                    self._absent[key] = self.clock() + self.absent_ttl_seconds
+                    return None
+
+                metrics.incr("local_index.load")
+                self._indexes[key] = index
+                self.size += index.nbytes
+                self._evict()
+                metrics.gauge("local_index.bytes", self.size)
+                return index
+
+    def clear(self):
+        with self._lock:
+            for index in self._indexes.values():
+                index.remove_file()
+            self._indexes.clear()
+            self._absent.clear()
+            self.size = 0
+
+
+_cache: LocalIndexCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_local_index_cache() -> LocalIndexCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LocalIndexCache()
+        return _cache
@@ -1,9 +1,13 @@
+# Must be imported first to profile the imports of this entry point
+from app import profiling  # isort: skip
+
 import logging
 import os
 import traceback
 from typing import Callable
 
 from app.dependencies import get_current_user
+from app.metrics import metrics
 from app.repositories.common import (
     RecordAccessNotAllowedError,
     RecordNotFoundError,
@@ -125,5 +129,9 @@ async def add_log_requests(request: Request, call_next: ASGIApp):
     logger.info(f"Request body: {body.decode('utf-8')[:100]}...")
 
     response = await call_next(request)  # type: ignore
+    metrics.flush()
 
     return response
+
+
+profiling.report_cold_start("app.main")
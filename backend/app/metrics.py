@@ -0,0 +1,94 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Generator
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _compose_key(name: str, dimensions: dict[str, str] | None) -> str:
+    if not dimensions:
+        return name
+    dims = ",".join(f"{k}={v}" for k, v in sorted(dimensions.items()))
+    return f"{name}[{dims}]"
+
+
+class Metrics:
+    """Process-wide registry of counters, gauges and timings.
+    Values live for the lifetime of the (warm) process and are emitted with `flush`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        self.timings: dict[str, dict[str, float]] = {}
+
+    def incr(
+        self, name: str, value: float = 1, dimensions: dict[str, str] | None = None
+    ):
+        key = _compose_key(name, dimensions)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, dimensions: dict[str, str] | None = None):
+        key = _compose_key(name, dimensions)
+        with self._lock:
+            self.gauges[key] = value
+
+    def timing(
+        self, name: str, millis: float, dimensions: dict[str, str] | None = None
+    ):
+        key = _compose_key(name, dimensions)
+        with self._lock:
+            stat = self.timings.setdefault(
+                key, {"count": 0, "sum": 0.0, "max": 0.0, "min": float("inf")}
+            )
+            stat["count"] += 1
+            stat["sum"] += millis
+            stat["max"] = max(stat["max"], millis)
+            stat["min"] = min(stat["min"], millis)
+
+    @contextmanager
+    def timer(
+        self, name: str, dimensions: dict[str, str] | None = None
+    ) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, (time.perf_counter() - start) * 1000, dimensions)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": {
+                    k: {**v, "avg": v["sum"] / v["count"] if v["count"] else 0.0}
+                    for k, v in self.timings.items()
+                },
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timings.clear()
+
+    def flush(self):
+        """Log the current values as a single JSON line and reset counters and timings.
+        Gauges are kept since they represent the latest state.
+        """
+        snapshot = self.snapshot()
+        if snapshot["counters"] or snapshot["gauges"] or snapshot["timings"]:
+            logger.info(f"Metrics: {json.dumps(snapshot)}")
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+metrics = Metrics()
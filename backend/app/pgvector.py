@@ -0,0 +1,623 @@
+"""Management of the pgvector `items` table.
+`items` is list-partitioned by bot id with one partition per bot, so that a search
+only touches the partition (and ANN index) of its bot. A sync builds the new rows of a
+bot in a staging table, indexes it, and swaps it in for the old partition in a single
+transaction; removing a bot drops its partition. An incremental sync instead deletes
+the rows of the changed sources and inserts the staged rows in place (see
+`embedding/sync.py`).
+Run as a module to manage the index or to measure the recall-versus-latency trade-off
+of the search settings:
+    python -m app.pgvector report --bot-id <bot_id>
+    python -m app.pgvector ensure-index
+"""
+
+import argparse
+import io
+import json
+import logging
+import re
+import secrets
+import statistics
+import struct
+import time
+from typing import Any, Callable, Iterable
+
+from app.config import DEFAULT_VECTOR_INDEX_CONFIG, VectorIndexConfig
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TABLE_NAME = "items"
+INDEX_PREFIX = "idx_items_embedding"
+COLUMNS = ("id", "botid", "content", "source", "embedding", "source_hash", "chunk_hash")
+
+QUANTIZATIONS = ("none", "halfvec", "binary")
+
+
+def _quantized_expressions(
+    config: VectorIndexConfig, vector: str = ":embedding"
+) -> tuple[str, str, str]:
+    """Indexed expression, distance operator and query expression of the quantization.
+    The search must use exactly the indexed expression, otherwise the index is not used.
+    `vector` is the text representation of the query vector (a parameter or a column).
+    """
+    quantization = config["quantization"]
+    dimensions = int(config["dimensions"])
+    if quantization == "none":
+        return "embedding", "<->", f"CAST({vector} AS vector)"
+    if quantization == "halfvec":
+        return (
+            f"(embedding::halfvec({dimensions}))",
+            "<->",
+            f"CAST({vector} AS halfvec({dimensions}))",
+        )
+    if quantization == "binary":
+        return (
+            f"(binary_quantize(embedding)::bit({dimensions}))",
+            "<~>",
+            f"binary_quantize(CAST({vector} AS vector))",
+        )
+    raise ValueError(f"Unsupported quantization: {quantization}")
+
+
+def _compose_knn_query(config: VectorIndexConfig, vector: str) -> str:
+    expression, operator, query = _quantized_expressions(config, vector)
+    if config["quantization"] == "none" or config["rerank_factor"] <= 1:
+        return f"""
+SELECT id, botid, content, source, {expression} {operator} {query} AS distance
+FROM items
+WHERE botid = :bot_id
+ORDER BY distance
+LIMIT :limit
+"""
+    return f"""
+SELECT id, botid, content, source, embedding <-> CAST({vector} AS vector) AS distance
+FROM (
+    SELECT id, botid, content, source, embedding
+    FROM items
+    WHERE botid = :bot_id
+    ORDER BY {expression} {operator} {query}
+    LIMIT :candidates
+) AS candidates
+ORDER BY distance
+LIMIT :limit
+"""
+
+
+def compose_search_query(
+    config: VectorIndexConfig = DEFAULT_VECTOR_INDEX_CONFIG,
+) -> str:
+    """Query for the top `:limit` rows of `:bot_id` nearest to `:embedding`.
+    Only the columns needed to build `SearchResult` (and the distance) are returned,
+    since the embedding itself is not used by the caller. The `botid` condition prunes
+    the scan to the partition of the bot. With quantization, the index scan fetches
+    `:candidates` rows which are re-ranked by the full precision distance.
+    """
+    return _compose_knn_query(config, ":embedding")
+
+
+def compose_multi_search_query(
+    config: VectorIndexConfig = DEFAULT_VECTOR_INDEX_CONFIG,
+) -> str:
+    """Query running the search of `compose_search_query` for every vector of
+    `:embeddings` (text array) in a single statement, with a `LATERAL` join.
+    Rows are ordered by the (zero based) index of the query, then by distance.
+    """
+    knn = (
+        _compose_knn_query(config, "queries.query_vector")
+        .strip()
+        .replace("\n", "\n    ")
+    )
+    return f"""
+SELECT queries.query_index - 1, results.id, results.botid, results.content, results.source, results.distance
+FROM unnest(CAST(:embeddings AS text[])) WITH ORDINALITY AS queries(query_vector, query_index)
+CROSS JOIN LATERAL (
+    {knn}
+) AS results
+ORDER BY queries.query_index, results.distance
+"""
+
+
+def count_candidates(
+    limit: int, config: VectorIndexConfig = DEFAULT_VECTOR_INDEX_CONFIG
+) -> int:
+    """Number of rows fetched from the ANN index for `limit` results."""
+    if config["quantization"] == "none":
+        return limit
+    return limit * max(1, config["rerank_factor"])
+
+
+def distance_to_similarity(distance: float) -> float:
+    """Cosine similarity of two unit vectors at L2 `distance` (embeddings are normalized)."""
+    return 1 - distance * distance / 2
+
+
+def format_vector(values: Iterable[float]) -> str:
+    """Text representation of a vector, as accepted by `CAST(... AS vector)`.
+    `pg8000` sends parameters as text, so this is the wire encoding of the vector.
+    9 significant digits round-trip float32 exactly, which is about half the size of
+    `json.dumps` of the same values widened to float64.
+    """
+    return "[" + ",".join(f"{v:.9g}" for v in values) + "]"
+
+
+def index_name(config: VectorIndexConfig) -> str:
+    name = f"{INDEX_PREFIX}_{config['method']}"
+    if config["quantization"] != "none":
+        name = f"{name}_{config['quantization']}"
+    return name
+
+
+def partition_name(bot_id: str) -> str:
+    # Bot ids are ULIDs. Validate them since they are interpolated into DDL.
+    if not re.fullmatch(r"[0-9A-Za-z]{26}", bot_id):
+        raise ValueError(f"Invalid bot id: {bot_id}")
+    return f"{TABLE_NAME}_{bot_id.lower()}"
+
+
+def compose_index_ddl(
+    config: VectorIndexConfig, table: str = TABLE_NAME, name: str | None = None
+) -> str:
+    """`CREATE INDEX` statement of the configured ANN index.
+    Without `name`, PostgreSQL generates a unique one (used for partitions).
+    """
+    method = config["method"]
+    if method == "hnsw":
+        options = f"m = {int(config['m'])}, ef_construction = {int(config['ef_construction'])}"
+    elif method == "ivfflat":
+        options = f"lists = {int(config['lists'])}"
+    else:
+        raise ValueError(f"Unsupported index method: {method}")
+    expression, _, _ = _quantized_expressions(config)
+    # L2 distance for vectors, which must match the operator (`<->`) used by the search
+    # query, and Hamming distance (`<~>`) for binary quantized vectors
+    operator_class = {
+        "none": "vector_l2_ops",
+        "halfvec": "halfvec_l2_ops",
+        "binary": "bit_hamming_ops",
+    }[config["quantization"]]
+    target = f"IF NOT EXISTS {name} ON {table}" if name else f"ON {table}"
+    return (
+        f"CREATE INDEX {target} "
+        f"USING {method} ({expression} {operator_class}) WITH ({options})"
+    )
+
+
+def search_settings(
+    limit: int,
+    ef_search: int | None = None,
+    probes: int | None = None,
+    config: VectorIndexConfig = DEFAULT_VECTOR_INDEX_CONFIG,
+) -> dict[str, int]:
+    """Run-time parameters of the configured index method for a single search.
+    `ef_search` is at least the number of candidates, since HNSW never returns more
+    than `ef_search` rows.
+    """
+    if config["method"] == "hnsw":
+        candidates = count_candidates(limit, config)
+        return {"hnsw.ef_search": max(ef_search or config["ef_search"], candidates)}
+    return {"ivfflat.probes": probes or config["probes"]}
+
+
+def _existing_indexes(conn: Any) -> list[str]:
+    rows = conn.run(
+        "SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexname LIKE :prefix",
+        table=TABLE_NAME,
+        prefix=f"{INDEX_PREFIX}%",
+    )
+    return [r[0] for r in rows]
+
+
+def ensure_index(
+    conn: Any, config: VectorIndexConfig = DEFAULT_VECTOR_INDEX_CONFIG
+) -> bool:
+    """Create the configured ANN index on `items` and drop indexes of the other method.
+    The index of a partitioned table is built on every existing partition and is
+    inherited by partitions attached later.
+    Returns True if the index was created.
+    """
+    target = index_name(config)
+    existing = _existing_indexes(conn)
+    created = False
+    if target not in existing:
+        logger.info(f"Creating index {target}.")
+        start = time.perf_counter()
+        conn.run(compose_index_ddl(config, name=target))
+        logger.info(f"Created index {target} in {time.perf_counter() - start:.1f}s.")
+        created = True
+    for name in existing:
+        if name != target:
+            logger.info(f"Dropping index {name}.")
+            conn.run(f"DROP INDEX IF EXISTS {name}")
+    conn.commit()
+    return created
+
+
+def staging_name(bot_id: str) -> str:
+    """Name of a new staging table of `bot_id`. It is unique per sync, so that
+    overlapping syncs of the bot do not write to or drop each other's table.
+    """
+    return f"{partition_name(bot_id)}_staging_{secrets.token_hex(4)}"
+
+
+def _create_staging(conn: Any, bot_id: str, staging: str):
+    conn.run(f"CREATE TABLE {staging} (LIKE {TABLE_NAME} INCLUDING DEFAULTS)")
+    # Matches the partition constraint, so attaching does not scan the table
+    conn.run(
+        f"ALTER TABLE {staging} ADD CONSTRAINT {staging}_botid "
+        f"CHECK (botid IS NOT NULL AND botid = '{bot_id}')"
+    )
+
+
+# Header of the binary `COPY` format: signature, flags and header extension length
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+
+
+def _encode_copy_vector(embedding: str | Iterable[float]) -> bytes:
+    # Binary format of pgvector: dimensions, unused, then big-endian float4 values
+    if isinstance(embedding, str):
+        values = [float(v) for v in embedding.strip("[]").split(",")]
+    else:
+        values = [float(v) for v in embedding]
+    return struct.pack(f">hh{len(values)}f", len(values), 0, *values)
+
+
+def encode_copy_rows(rows: list[tuple]) -> bytes:
+    """Encode rows for `COPY ... FROM STDIN WITH (FORMAT binary)`.
+    Args:
+        rows (list[tuple]): Values of `COLUMNS`. The embedding is vector text or a
+            sequence of floats.
+    """
+    embedding_index = COLUMNS.index("embedding")
+    field_count = struct.pack(">h", len(COLUMNS))
+    parts = [COPY_HEADER]
+    for row in rows:
+        parts.append(field_count)
+        for i, value in enumerate(row):
+            if value is None:
+                parts.append(struct.pack(">i", -1))
+                continue
+            data = (
+                _encode_copy_vector(value)
+                if i == embedding_index
+                else str(value).encode("utf-8")
+            )
+            parts.append(struct.pack(">i", len(data)))
+            parts.append(data)
+    parts.append(COPY_TRAILER)
+    return b"".join(parts)
+
+
+def _copy_rows(conn: Any, table: str, rows: list[tuple]):
+    # Much faster than an `INSERT` per row: a single statement streams all the rows,
+    # and the binary format skips parsing the vector text on the server
+    conn.run(
+        f"COPY {table} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT binary)",
+        stream=io.BytesIO(encode_copy_rows(rows)),
+    )
+
+
+def _swap_staging(conn: Any, bot_id: str, staging: str, config: VectorIndexConfig):
+    partition = partition_name(bot_id)
+    # Indexes are built once after loading, which is faster than maintaining them per row
+    conn.run(f"ALTER TABLE {staging} ADD PRIMARY KEY (botid, id)")
+    conn.run(compose_index_ddl(config, table=staging))
+    conn.run(f"ANALYZE {staging}")
+
+    conn.run(f"DROP TABLE IF EXISTS {partition}")
+    conn.run(f"ALTER TABLE {staging} RENAME TO {partition}")
+    conn.run(
+        f"ALTER TABLE {TABLE_NAME} ATTACH PARTITION {partition} "
+        f"FOR VALUES IN ('{bot_id}')"
+    )
+
+
+def replace_bot_items(
+    conn: Any,
+    bot_id: str,
+    rows: list[tuple],
+    config: VectorIndexConfig = DEFAULT_VECTOR_INDEX_CONFIG,
+):
+    """Atomically replace the partition of `bot_id` with `rows`.
+    The rows are loaded into a staging table and indexed before any lock is taken on
+    `items`; the old partition is then dropped and the staging table attached in its
+    place, so searches see either the old or the new rows.
+    Args:
+        rows (list[tuple]): Values of `COLUMNS` (see `encode_copy_rows`).
+    """
+    start = time.perf_counter()
+    try:
+        staging = staging_name(bot_id)
+        _create_staging(conn, bot_id, staging)
+        _copy_rows(conn, staging, rows)
+        _swap_staging(conn, bot_id, staging, config)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info(
+        f"Replaced {partition_name(bot_id)} with {len(rows)} rows "
+        f"in {time.perf_counter() - start:.1f}s."
+    )
+
+
+class BotItemsStaging:
+    """Rows of a sync of `bot_id`, written in batches to a staging table while they are
+    produced and applied to `items` at once at the end:
+    - `replace` swaps the staging table in for the partition, like `replace_bot_items`.
+    - `merge` deletes the rows of the given sources and inserts the staged rows in a
+      single transaction, maintaining the ANN index row by row. It suits syncs
+      changing a small part of the bot; the partition of the bot must exist.
+    Every batch is committed, so a failed batch can be retried on a new connection by
+    replacing `conn`.
+    """
+
+    def __init__(
+        self,
+        conn: Any,
+        bot_id: str,
+        config: VectorIndexConfig = DEFAULT_VECTOR_INDEX_CONFIG,
+    ):
+        self.conn = conn
+        self.bot_id = bot_id
+        self.config = config
+        self.table = staging_name(bot_id)
+        self.rows = 0
+
+    def _commit(self, apply: Callable[[], Any]) -> Any:
+        try:
+            result = apply()
+            self.conn.commit()
+            return result
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def create(self):
+        self._commit(lambda: _create_staging(self.conn, self.bot_id, self.table))
+
+    def write(self, rows: list[tuple]):
+        """Args:
+        rows (list[tuple]): Values of `COLUMNS` (see `encode_copy_rows`).
+        """
+        self._commit(lambda: _copy_rows(self.conn, self.table, rows))
+        self.rows += len(rows)
+
+    def replace(self):
+        start = time.perf_counter()
+        self._commit(
+            lambda: _swap_staging(self.conn, self.bot_id, self.table, self.config)
+        )
+        logger.info(
+            f"Replaced {partition_name(self.bot_id)} with {self.rows} rows "
+            f"in {time.perf_counter() - start:.1f}s."
+        )
+
+    def merge(self, delete_sources: list[str]) -> int:
+        """Returns the number of deleted rows."""
+
+        def apply() -> int:
+            rows = conn.run(
+                "WITH deleted AS ("
+                f"DELETE FROM {TABLE_NAME} WHERE botid = :bot_id "
+                "AND source = ANY(CAST(:sources AS text[])) RETURNING 1"
+                ") SELECT count(*) FROM deleted",
+                bot_id=self.bot_id,
+                sources=delete_sources,
+            )
+            conn.run(
+                f"INSERT INTO {TABLE_NAME} ({', '.join(COLUMNS)}) "
+                f"SELECT {', '.join(COLUMNS)} FROM {self.table}"
+            )
+            conn.run(f"DROP TABLE {self.table}")
+            return int(rows[0][0]) if rows else 0
+
+        conn = self.conn
+        start = time.perf_counter()
+        deleted = self._commit(apply)
+        logger.info(
+            f"Deleted {deleted} and inserted {self.rows} rows of bot {self.bot_id} "
+            f"in {time.perf_counter() - start:.1f}s."
+        )
+        return deleted
+
+    def drop(self):
+        self._commit(lambda: self.conn.run(f"DROP TABLE IF EXISTS {self.table}"))
+
+
+def fetch_source_hashes(conn: Any, bot_id: str) -> dict[str, str]:
+    """Hash of each source stored for `bot_id`. Sources of rows without a hash (written
+    before hashes were recorded) map to an empty hash, so they are synced again.
+    """
+    hashes: dict[str, str] = {}
+    for source, source_hash in conn.run(
+        "SELECT DISTINCT source, source_hash FROM items WHERE botid = :bot_id",
+        bot_id=bot_id,
+    ):
+        # Several hashes mean the source is partially synced, so it is synced again
+        hashes[source] = "" if source in hashes else (source_hash or "")
+    return hashes
+
+
+def fetch_chunk_embeddings(
+    conn: Any, bot_id: str, sources: list[str]
+) -> dict[str, dict[str, str]]:
+    """Stored embedding (vector text) of each chunk hash, keyed by source."""
+    embeddings: dict[str, dict[str, str]] = {}
+    if not sources:
+        return embeddings
+    for source, chunk_hash, embedding in conn.run(
+        "SELECT source, chunk_hash, embedding::text FROM items "
+        "WHERE botid = :bot_id AND source = ANY(CAST(:sources AS text[])) "
+        "AND chunk_hash IS NOT NULL",
+        bot_id=bot_id,
+        sources=sources,
+    ):
+        embeddings.setdefault(source, {})[chunk_hash] = embedding
+    return embeddings
+
+
+def count_bot_items(conn: Any, bot_id: str) -> int:
+    rows = conn.run("SELECT count(*) FROM items WHERE botid = :bot_id", bot_id=bot_id)
+    return int(rows[0][0]) if rows else 0
+
+
+def fetch_bot_items(conn: Any, bot_id: str) -> list[tuple[str, str, str]]:
+    """`(content, source, embedding)` of every row of `bot_id`, with the embedding as
+    vector text.
+    """
+    return [
+        tuple(r)  # type: ignore
+        for r in conn.run(
+            "SELECT content, source, embedding::text FROM items "
+            "WHERE botid = :bot_id ORDER BY id",
+            bot_id=bot_id,
+        )
+    ]
+
+
+def drop_bot_items(conn: Any, bot_id: str):
+    """Remove all rows of `bot_id` by dropping its partition, and the staging tables
+    left over by its failed syncs.
+    """
+    partition = partition_name(bot_id)
+    try:
+        rows = conn.run(
+            "SELECT tablename FROM pg_tables WHERE tablename LIKE :pattern",
+            pattern=f"{partition}_staging_%",
+        )
+        for (table,) in rows:
+            conn.run(f"DROP TABLE IF EXISTS {table}")
+        conn.run(f"DROP TABLE IF EXISTS {partition}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def recall_at_k(expected: list[str], actual: list[str]) -> float:
+    if not expected:
+        return 1.0
+    return len(set(expected) & set(actual)) / len(expected)
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _search_ids(conn: Any, query: str, settings: dict, **params) -> list[str]:
+    """Run the search query in its own transaction with the given settings."""
+    conn.run("BEGIN")
+    try:
+        for name, value in settings.items():
+            conn.run(f"SET LOCAL {name} = {value}")
+        return [r[0] for r in conn.run(query, **params)]
+    finally:
+        conn.run("ROLLBACK")
+
+
+def report(
+    conn: Any,
+    bot_id: str,
+    samples: int,
+    k: int,
+    values: list[int],
+    config: VectorIndexConfig = DEFAULT_VECTOR_INDEX_CONFIG,
+) -> list[dict]:
+    """Measure recall@k and latency of the ANN search for each `ef_search` (HNSW) or
+    `probes` (IVFFlat) value. Stored embeddings of the bot are used as queries, and the
+    exact nearest neighbors are computed by full precision distance with index scans
+    disabled, so the loss of recall by quantization is included.
+    """
+    conn.autocommit = True
+    queries = [
+        r[0]
+        for r in conn.run(
+            "SELECT embedding::text FROM items WHERE botid = :bot_id ORDER BY random() LIMIT :n",
+            bot_id=bot_id,
+            n=samples,
+        )
+    ]
+    if not queries:
+        raise ValueError(f"No items found for bot {bot_id}.")
+
+    exact_query = compose_search_query({**config, "quantization": "none"})
+    exact = [
+        _search_ids(
+            conn,
+            exact_query,
+            {"enable_indexscan": "off"},
+            bot_id=bot_id,
+            embedding=q,
+            limit=k,
+        )
+        for q in queries
+    ]
+    search_query = compose_search_query(config)
+    candidates = count_candidates(k, config)
+    param = "hnsw.ef_search" if config["method"] == "hnsw" else "ivfflat.probes"
+
+    rows = []
+    for value in values:
+        settings = search_settings(k, ef_search=value, probes=value, config=config)
+        recalls = []
+        latencies = []
+        for query, expected in zip(queries, exact):
+            start = time.perf_counter()
+            actual = _search_ids(
+                conn,
+                search_query,
+                settings,
+                bot_id=bot_id,
+                embedding=query,
+                limit=k,
+                candidates=candidates,
+            )
+            latencies.append((time.perf_counter() - start) * 1000)
+            recalls.append(recall_at_k(expected, actual))
+        rows.append(
+            {
+                param: settings[param],
+                f"recall@{k}": round(statistics.mean(recalls), 4),
+                "p50_ms": round(percentile(latencies, 50), 2),
+                "p95_ms": round(percentile(latencies, 95), 2),
+            }
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    from app.postgres import connect
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("ensure-index", help="Create the configured ANN index.")
+    report_parser = subparsers.add_parser(
+        "report", help="Report recall versus latency of the search settings."
+    )
+    report_parser.add_argument("--bot-id", required=True)
+    report_parser.add_argument("--samples", type=int, default=50)
+    report_parser.add_argument("--k", type=int, default=10)
+    report_parser.add_argument(
+        "--values",
+        default="10,20,40,80,160",
+        help="Comma separated ef_search (HNSW) or probes (IVFFlat) values.",
+    )
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        if args.command == "ensure-index":
+            ensure_index(conn)
+        else:
+            values = [int(v) for v in args.values.split(",")]
+            for row in report(conn, args.bot_id, args.samples, args.k, values):
+                print(json.dumps(row))
+    finally:
+        conn.close()
@@ -0,0 +1,171 @@
+"""Process-wide pool of PostgreSQL (pgvector) connections.
+Opening a connection requires TLS setup and authentication, which dominates the latency
+of small queries such as the vector search. Connections are therefore kept open and
+reused across requests of a warm process. The database secret is cached as well, and
+refetched when authentication fails (i.e. the secret was rotated).
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Generator
+
+import pg8000
+from app.config import DEFAULT_POSTGRES_POOL_CONFIG, PostgresPoolConfig
+from app.metrics import metrics
+from aws_lambda_powertools.utilities import parameters
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DB_SECRETS_ARN = os.environ.get("DB_SECRETS_ARN", "")
+# SQLSTATE of `invalid_password`
+INVALID_PASSWORD = "28P01"
+
+
+def is_authentication_error(e: Exception) -> bool:
+    return bool(
+        e.args
+        and isinstance(e.args[0], dict)
+        and e.args[0].get("C") == INVALID_PASSWORD
+    )
+
+
+def connect(
+    secret_max_age: int = DEFAULT_POSTGRES_POOL_CONFIG["secret_max_age_seconds"],
+) -> pg8000.Connection:
+    """Open a new connection with the (cached) database secret.
+    If authentication fails, the secret is refetched once in case it was rotated.
+    """
+
+    def _connect(force_fetch: bool) -> pg8000.Connection:
+        secrets: Any = parameters.get_secret(  # type: ignore
+            DB_SECRETS_ARN, max_age=secret_max_age, force_fetch=force_fetch
+        )
+        db_info = json.loads(secrets)
+        return pg8000.connect(
+            database=db_info["dbname"],
+            host=db_info["host"],
+            port=db_info["port"],
+            user=db_info["username"],
+            password=db_info["password"],
+        )
+
+    with metrics.timer("postgres.connect_latency"):
+        try:
+            return _connect(force_fetch=False)
+        except pg8000.DatabaseError as e:
+            if not is_authentication_error(e):
+                raise
+            logger.info("Authentication failed. Refetching the database secret.")
+            metrics.incr("postgres.secret_refreshed")
+            return _connect(force_fetch=True)
+
+
+class PooledConnection:
+    """Connection with its cache of server-side prepared statements."""
+
+    def __init__(self, conn: Any, created_at: float):
+        self.conn = conn
+        self.created_at = created_at
+        self.last_used_at = created_at
+        self._statements: dict[str, Any] = {}
+
+    def prepare(self, sql: str) -> Any:
+        """Return the prepared statement for `sql`, preparing it on first use.
+        `sql` uses the `:name` placeholders of `pg8000`.
+        """
+        statement = self._statements.get(sql)
+        if statement is None:
+            statement = self.conn.prepare(sql)
+            self._statements[sql] = statement
+        return statement
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception as e:
+            logger.debug(f"Failed to close connection: {e}")
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        connect: Callable[[], Any] = connect,
+        config: PostgresPoolConfig = DEFAULT_POSTGRES_POOL_CONFIG,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.connect = connect
+        self.max_idle_seconds = config["max_idle_seconds"]
+        self.health_check_interval = config["health_check_interval_seconds"]
+        self.clock = clock
+        self._idle: list[PooledConnection] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(config["max_connections"])
+
+    def _is_healthy(self, pooled: PooledConnection) -> bool:
+        try:
+            pooled.conn.run("SELECT 1")
+            return True
+        except Exception as e:
+            logger.info(f"Discarding unhealthy connection: {e}")
+            return False
+
+    def _acquire(self) -> PooledConnection:
+        while True:
+            with self._lock:
+                # Most recently used connections are at the end
+                pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                break
+            idle = self.clock() - pooled.last_used_at
+            if idle >= self.max_idle_seconds:
+                metrics.incr("postgres.evicted")
+                pooled.close()
+                continue
+            if idle >= self.health_check_interval and not self._is_healthy(pooled):
+                pooled.close()
+                continue
+            metrics.incr("postgres.reused")
+            return pooled
+
+        metrics.incr("postgres.opened")
+        return PooledConnection(self.connect(), self.clock())
+
+    def _release(self, pooled: PooledConnection):
+        # Discard uncommitted work, so the next user starts outside of a transaction
+        pooled.conn.rollback()
+        pooled.last_used_at = self.clock()
+        with self._lock:
+            self._idle.append(pooled)
+
+    @contextmanager
+    def connection(self) -> Generator[PooledConnection, None, None]:
+        """Borrow a connection. It is closed instead of returned if an error occurs."""
+        self._slots.acquire()
+        try:
+            pooled = self._acquire()
+            try:
+                yield pooled
+            except Exception:
+                pooled.close()
+                raise
+            try:
+                self._release(pooled)
+            except Exception as e:
+                logger.info(f"Discarding connection which failed to reset: {e}")
+                pooled.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            pooled.close()
+
+
+pool = ConnectionPool()
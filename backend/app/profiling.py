@@ -0,0 +1,105 @@
+"""Cold start profiling.
+Set `COLD_START_PROFILING=true` to record the time spent importing each module and
+the duration of the module initialization of an entry point (`app.main`,
+`app.websocket` or `app.sqs_consumer`).
+This module must be imported before any other module of the entry point so that
+the imports are recorded, and the entry point calls `report_cold_start` at the end
+of its initialization.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+from importlib.abc import MetaPathFinder
+from importlib.machinery import ModuleSpec
+from typing import Any
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+COLD_START_PROFILING = os.environ.get("COLD_START_PROFILING", "") == "true"
+# Number of modules to report, sorted by cumulative import time
+REPORT_TOP_N = 30
+
+_started_at = time.perf_counter()
+_reported = False
+
+
+class ImportTimer(MetaPathFinder):
+    """Meta path finder which wraps the loader of every found module to time `exec_module`.
+    Records both the cumulative time (including nested imports) and the self time.
+    """
+
+    def __init__(self):
+        self.cumulative: dict[str, float] = {}
+        self.self_time: dict[str, float] = {}
+        self._stack: list[float] = []
+
+    def find_spec(self, fullname: str, path: Any, target: Any = None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec: ModuleSpec | None = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            loader = spec.loader
+            # Builtin and frozen importers are shared classes, which must not be patched
+            if loader is not None and not isinstance(loader, type):
+                exec_module = getattr(loader, "exec_module", None)
+                if exec_module is not None:
+                    loader.exec_module = self._wrap(fullname, exec_module)  # type: ignore
+            return spec
+        return None
+
+    def _wrap(self, fullname: str, exec_module):
+        def timed_exec_module(module):
+            self._stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = self._stack.pop()
+                if self._stack:
+                    self._stack[-1] += elapsed
+                self.cumulative[fullname] = elapsed
+                self.self_time[fullname] = elapsed - children
+
+        return timed_exec_module
+
+    def report(self, top_n: int = REPORT_TOP_N) -> list[dict]:
+        names = sorted(self.cumulative, key=lambda n: -self.cumulative[n])[:top_n]
+        return [
+            {
+                "module": name,
+                "cumulative_ms": round(self.cumulative[name] * 1000, 2),
+                "self_ms": round(self.self_time[name] * 1000, 2),
+            }
+            for name in names
+        ]
+
+
+import_timer: ImportTimer | None = None
+if COLD_START_PROFILING:
+    import_timer = ImportTimer()
+    sys.meta_path.insert(0, import_timer)
+
+
+def report_cold_start(entry_point: str):
+    """Log the init duration and the slowest imports once per process."""
+    global _reported
+    if not COLD_START_PROFILING or _reported:
+        return
+    _reported = True
+
+    init_duration = (time.perf_counter() - _started_at) * 1000
+    report = {
+        "entry_point": entry_point,
+        "init_duration_ms": round(init_duration, 2),
+        "imports": import_timer.report() if import_timer else [],
+    }
+    logger.info(f"Cold start profile: {json.dumps(report)}")
+    if import_timer is not None:
+        sys.meta_path.remove(import_timer)
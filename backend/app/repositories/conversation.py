@@ -21,13 +21,13 @@ from app.repositories.models.conversation import (
     FeedbackModel,
     MessageModel,
 )
-from app.utils import get_current_time
+from app.utils import LazyClient, get_current_time
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-s3_client = boto3.client("s3")
+s3_client = LazyClient(lambda: boto3.client("s3"))
 
 THRESHOLD_LARGE_MESSAGE = 300 * 1024  # 300KB
 LARGE_MESSAGE_BUCKET = os.environ.get("LARGE_MESSAGE_BUCKET")
@@ -34,7 +34,7 @@ from app.repositories.models.custom_bot import (
 )
 from app.repositories.models.custom_bot_kb import BedrockKnowledgeBaseModel
 from app.routes.schemas.bot import type_sync_status
-from app.utils import get_current_time
+from app.utils import LazyClient, get_current_time
 from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
 
@@ -48,7 +48,7 @@ DEFAULT_GENERATION_CONFIG = (
 )
 
 logger = logging.getLogger(__name__)
-sts_client = boto3.client("sts")
+sts_client = LazyClient(lambda: boto3.client("sts"))
 
 
 def store_bot(user_id: str, custom_bot: BotModel):
@@ -439,7 +439,10 @@ def find_private_bot_by_id(user_id: str, bot_id: str) -> BotModel:
                 item["SearchParams"]["max_results"]
                 if "SearchParams" in item
                 else DEFAULT_SEARCH_CONFIG["max_results"]
-            )
+            ),
+            ef_search=item.get("SearchParams", {}).get("ef_search"),
+            probes=item.get("SearchParams", {}).get("probes"),
+            max_context_tokens=item.get("SearchParams", {}).get("max_context_tokens"),
         ),
         agent=(
             AgentModel(**item["AgentData"])
@@ -452,6 +455,7 @@ def find_private_bot_by_id(user_id: str, bot_id: str) -> BotModel:
         sync_status=item["SyncStatus"],
         sync_status_reason=item["SyncStatusReason"],
         sync_last_exec_id=item["LastExecId"],
+        knowledge_version=item.get("KnowledgeVersion", 0),
         published_api_stack_name=(
             None
             if "ApiPublishmentStackName" not in item
@@ -537,7 +541,10 @@ def find_public_bot_by_id(bot_id: str) -> BotModel:
                 item["SearchParams"]["max_results"]
                 if "SearchParams" in item
                 else DEFAULT_SEARCH_CONFIG["max_results"]
-            )
+            ),
+            ef_search=item.get("SearchParams", {}).get("ef_search"),
+            probes=item.get("SearchParams", {}).get("probes"),
+            max_context_tokens=item.get("SearchParams", {}).get("max_context_tokens"),
         ),
         agent=(
             AgentModel(**item["AgentData"])
@@ -550,6 +557,7 @@ def find_public_bot_by_id(bot_id: str) -> BotModel:
         sync_status=item["SyncStatus"],
         sync_status_reason=item["SyncStatusReason"],
         sync_last_exec_id=item["LastExecId"],
+        knowledge_version=item.get("KnowledgeVersion", 0),
         published_api_stack_name=(
             None
             if "ApiPublishmentStackName" not in item
@@ -48,6 +48,11 @@ class GuardrailConfig(BaseModel):
 
 class SearchParamsModel(BaseModel):
     max_results: int
+    # Overrides the ANN index search breadth (`hnsw.ef_search` / `ivfflat.probes`)
+    ef_search: int | None = None
+    probes: int | None = None
+    # Overrides the token budget of the retrieved chunks inserted into the prompt
+    max_context_tokens: int | None = None
 
 
 class AgentToolModel(BaseModel):
@@ -83,6 +88,8 @@ class BotModel(BaseModel):
     sync_status: type_sync_status
     sync_status_reason: str
     sync_last_exec_id: str
+    # Incremented on every successful sync. Used to invalidate cached retrieval results.
+    knowledge_version: int = 0
     published_api_stack_name: str | None
     published_api_datetime: int | None
     published_api_codebuild_id: str | None
@@ -33,3 +33,7 @@ class BedrockKnowledgeBaseModel(BaseModel):
     overlap_percentage: int | None = None
     knowledge_base_id: str | None = None
     data_source_ids: list[str] | None = None
+    # Other knowledge bases searched together with the one of the bot
+    federated_knowledge_base_ids: list[str] | None = None
+    # Also search the pgvector items of the bot, e.g. while migrating from the vector store
+    include_vector_store: bool = False
@@ -9,6 +9,7 @@ from functools import partial
 import boto3
 from app.repositories.custom_bot import find_public_bots_by_ids
 from app.repositories.models.usage_analysis import UsagePerBot, UsagePerUser
+from app.utils import LazyClient
 
 REGION = os.environ.get("REGION", "ap-southeast-2")
 USAGE_ANALYSIS_DATABASE = os.environ.get(
@@ -26,7 +27,7 @@ QUERY_LIMIT = 1000
 
 
 logger = logging.getLogger(__name__)
-athena = boto3.client("athena")
+athena = LazyClient(lambda: boto3.client("athena"))
 
 
 def _find_cognito_user_by_id(user_id: str) -> dict | None:
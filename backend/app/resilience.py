@@ -0,0 +1,360 @@
+"""Resilience layer for Bedrock calls.
+Provides error classification, jittered exponential backoff, a client-side adaptive
+token bucket which learns the sustainable request rate from throttling, and a circuit
+breaker per model. All Bedrock calls should go through `call_with_retries`.
+"""
+
+import logging
+import random
+import threading
+import time
+from typing import Callable, Literal, TypeVar
+
+from app.config import DEFAULT_BEDROCK_RETRY_CONFIG, RetryConfig
+from app.metrics import metrics
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from botocore.exceptions import HTTPClientError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+T = TypeVar("T")
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "SlowDown",
+}
+TRANSIENT_ERROR_CODES = {
+    "InternalServerException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+    "ModelStreamErrorException",
+    "RequestTimeout",
+    "RequestTimeoutException",
+}
+
+type_circuit_state = Literal["CLOSED", "OPEN", "HALF_OPEN"]
+CIRCUIT_STATE_VALUE: dict[type_circuit_state, int] = {
+    "CLOSED": 0,
+    "HALF_OPEN": 1,
+    "OPEN": 2,
+}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def get_error_code(e: Exception) -> str | None:
+    """Extract the error code from botocore `ClientError` or stream error events."""
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code")
+    return None
+
+
+def get_status_code(e: Exception) -> int | None:
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return None
+
+
+def is_throttling_error(e: Exception) -> bool:
+    return get_error_code(e) in THROTTLING_ERROR_CODES or get_status_code(e) == 429
+
+
+def is_retryable_error(e: Exception) -> bool:
+    if isinstance(e, (BotocoreConnectionError, HTTPClientError)):
+        return True
+    if is_throttling_error(e) or get_error_code(e) in TRANSIENT_ERROR_CODES:
+        return True
+    status_code = get_status_code(e)
+    return status_code is not None and status_code >= 500
+
+
+def backoff_delay(
+    attempt: int,
+    base_delay: float,
+    max_delay: float,
+    rand: Callable[[], float] = random.random,
+) -> float:
+    """Exponential backoff with full jitter.
+    Ref: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    """
+    return rand() * min(max_delay, base_delay * (2**attempt))
+
+
+class AdaptiveRateLimiter:
+    """Client-side token bucket which is enabled on the first throttling error.
+    The fill rate starts from the measured send rate (at least `initial_rate`)
+    multiplied by `beta`, shrinks by `beta` on every throttling error and grows by
+    `growth` on every success. Once the rate recovers to `max_rate`, the bucket is
+    disabled again.
+    """
+
+    def __init__(
+        self,
+        min_rate: float = 0.5,
+        max_rate: float = 50.0,
+        initial_rate: float = 5.0,
+        beta: float = 0.7,
+        growth: float = 1.05,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.initial_rate = initial_rate
+        self.beta = beta
+        self.growth = growth
+        self.clock = clock
+        self.sleep = sleep
+
+        self.enabled = False
+        self.rate = max_rate
+        self.tokens = 0.0
+        self.last_refill = clock()
+        self.measured_rate = 0.0
+        self._window_start = clock()
+        self._window_count = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def _measure(self, now: float):
+        self._window_count += 1
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            current = self._window_count / elapsed
+            self.measured_rate = 0.8 * self.measured_rate + 0.2 * current
+            self._window_start = now
+            self._window_count = 0
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            with self._lock:
+                now = self.clock()
+                if not self.enabled:
+                    self._measure(now)
+                    return
+                self._refill(now)
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    self._measure(now)
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def on_throttle(self):
+        with self._lock:
+            now = self.clock()
+            if not self.enabled:
+                self.enabled = True
+                # A low measured rate (e.g. a burst after idling) would pin the limit
+                # near `min_rate` for a long time
+                self.rate = max(self.measured_rate, self.initial_rate)
+                self.tokens = 0.0
+                self.last_refill = now
+            self.rate = max(self.min_rate, self.rate * self.beta)
+
+    def on_success(self):
+        with self._lock:
+            if not self.enabled:
+                return
+            # Multiplicative, so that recovering from `min_rate` takes tens of calls
+            self.rate = min(self.max_rate, self.rate * self.growth)
+            if self.rate >= self.max_rate:
+                self.enabled = False
+
+
+class CircuitBreaker:
+    """Circuit breaker which opens after `failure_threshold` consecutive server-side failures.
+    After `recovery_timeout` seconds a single probe request is allowed (half open);
+    its result decides whether the circuit closes or opens again.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.clock = clock
+
+        self.state: type_circuit_state = "CLOSED"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == "CLOSED":
+                return True
+            if self.state == "OPEN":
+                if self.clock() - self.opened_at < self.recovery_timeout:
+                    return False
+                self.state = "HALF_OPEN"
+                self._probe_in_flight = False
+            # Half open: allow only one probe at a time
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "CLOSED"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == "HALF_OPEN" or self.failures >= self.failure_threshold:
+                self.state = "OPEN"
+                self.opened_at = self.clock()
+
+    def is_available(self) -> bool:
+        """Whether a request would currently be allowed, without reserving a probe."""
+        with self._lock:
+            if self.state == "OPEN":
+                return self.clock() - self.opened_at >= self.recovery_timeout
+            return not (self.state == "HALF_OPEN" and self._probe_in_flight)
+
+
+_registry_lock = threading.Lock()
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+_rate_limiters: dict[str, AdaptiveRateLimiter] = {}
+
+
+def get_circuit_breaker(
+    key: str, config: RetryConfig = DEFAULT_BEDROCK_RETRY_CONFIG
+) -> CircuitBreaker:
+    with _registry_lock:
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = CircuitBreaker(
+                failure_threshold=config["failure_threshold"],
+                recovery_timeout=config["recovery_timeout"],
+            )
+        return _circuit_breakers[key]
+
+
+def get_rate_limiter(
+    key: str,
+    clock: Callable[[], float] = time.monotonic,
+    sleep: Callable[[float], None] = time.sleep,
+) -> AdaptiveRateLimiter:
+    with _registry_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = AdaptiveRateLimiter(clock=clock, sleep=sleep)
+        return _rate_limiters[key]
+
+
+def reset_resilience_state():
+    """Forget all circuit breakers and rate limiters. Mainly for testing."""
+    with _registry_lock:
+        _circuit_breakers.clear()
+        _rate_limiters.clear()
+
+
+def _publish_state(key: str, breaker: CircuitBreaker, limiter: AdaptiveRateLimiter):
+    dimensions = {"key": key}
+    metrics.gauge(
+        "bedrock.circuit_state", CIRCUIT_STATE_VALUE[breaker.state], dimensions
+    )
+    metrics.gauge(
+        "bedrock.rate_limit", limiter.rate if limiter.enabled else 0, dimensions
+    )
+
+
+def call_with_retries(
+    fn: Callable[[], T],
+    key: str,
+    config: RetryConfig = DEFAULT_BEDROCK_RETRY_CONFIG,
+    max_attempts: int | None = None,
+    sleep: Callable[[float], None] = time.sleep,
+    clock: Callable[[], float] = time.monotonic,
+) -> T:
+    """Call `fn` with retries, client-side rate limiting and a circuit breaker.
+    Args:
+        fn (Callable): The function to call. Must be safe to call multiple times.
+        key (str): Identifies the breaker and rate limiter, typically the model id.
+        config (RetryConfig, optional): Retry configuration.
+        max_attempts (int, optional): Overrides `config["max_attempts"]`.
+        sleep, clock (Callable, optional): Used for the backoff and by the rate limiter
+            created for `key`.
+    Raises:
+        CircuitOpenError: If the circuit for `key` is open.
+    """
+    breaker = get_circuit_breaker(key, config)
+    limiter = get_rate_limiter(key, clock, sleep)
+    attempts = max_attempts if max_attempts is not None else config["max_attempts"]
+    dimensions = {"key": key}
+
+    for attempt in range(attempts):
+        if not breaker.allow_request():
+            metrics.incr("bedrock.circuit_rejected", dimensions=dimensions)
+            _publish_state(key, breaker, limiter)
+            raise CircuitOpenError(f"Circuit for {key} is open.")
+
+        limiter.acquire()
+        metrics.incr("bedrock.calls", dimensions=dimensions)
+        try:
+            result = fn()
+        except Exception as e:
+            if not is_retryable_error(e):
+                # Client errors (e.g. validation) say nothing about the health of the model
+                breaker.record_success()
+                raise
+
+            code = get_error_code(e) or type(e).__name__
+            throttled = is_throttling_error(e)
+            if throttled:
+                # Throttling means the model is healthy but overloaded, which is
+                # handled by the rate limiter rather than the circuit breaker.
+                limiter.on_throttle()
+                breaker.record_success()
+                metrics.incr("bedrock.throttled", dimensions=dimensions)
+            else:
+                breaker.record_failure()
+            _publish_state(key, breaker, limiter)
+
+            if attempt + 1 >= attempts:
+                metrics.incr("bedrock.failures", dimensions=dimensions)
+                raise
+            delay = backoff_delay(
+                attempt,
+                (
+                    config["throttling_base_delay"]
+                    if throttled
+                    else config["base_delay"]
+                ),
+                config["max_delay"],
+            )
+            logger.warning(
+                f"Retrying {key} after {code} (attempt {attempt + 1}/{attempts}) in {delay:.2f}s"
+            )
+            metrics.incr("bedrock.retries", dimensions={**dimensions, "code": code})
+            sleep(delay)
+            continue
+
+        limiter.on_success()
+        breaker.record_success()
+        _publish_state(key, breaker, limiter)
+        return result
+
+    raise RuntimeError("Unreachable")
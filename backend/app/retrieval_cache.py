@@ -0,0 +1,207 @@
+"""Cache of retrieval results.
+Entries are keyed by the bot id, the knowledge version of the bot, its search
+parameters and the normalized query. The knowledge version is incremented whenever a
+sync of the bot succeeds (see `update_sync_status` of the embedding job and the
+knowledge base state machine), so entries of the previous knowledge are never served
+again and simply expire. Results are stored as zlib compressed JSON in an in-process
+LRU and, optionally, in a DynamoDB table shared by all processes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable
+
+import boto3
+from app.config import DEFAULT_RETRIEVAL_CACHE_CONFIG, RetrievalCacheConfig
+from app.embedding_cache import normalize_query
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RETRIEVAL_CACHE_TABLE_NAME = os.environ.get("RETRIEVAL_CACHE_TABLE_NAME", "")
+
+# (bot_id, content, source, score) of each result, in rank order
+type_results = list[tuple]
+
+
+class PartialResults(list):
+    """Results missing some of the sources of the bot, e.g. because a source did not
+    answer in time. They are returned but not cached.
+    """
+
+
+def compose_cache_key(
+    bot_id: str, knowledge_version: int, search_params: dict, query: str
+) -> str:
+    params = json.dumps(search_params, sort_keys=True, default=str)
+    digest = hashlib.sha256(
+        f"{params}\n{normalize_query(query)}".encode("utf-8")
+    ).hexdigest()
+    return f"{bot_id}#{knowledge_version}#{digest}"
+
+
+def encode_results(results: type_results) -> bytes:
+    return zlib.compress(
+        json.dumps([list(r) for r in results], separators=(",", ":")).encode("utf-8")
+    )
+
+
+def decode_results(data: bytes) -> type_results:
+    return [tuple(r) for r in json.loads(zlib.decompress(data))]  # type: ignore
+
+
+class DynamoDBRetrievalStore:
+    """Persistent tier storing compressed results in a DynamoDB table.
+    The table must have a string partition key `CacheKey` and TTL enabled on `expire`.
+    """
+
+    # DynamoDB items are limited to 400KB
+    MAX_ITEM_BYTES = 350 * 1024
+
+    def __init__(self, table_name: str, ttl_seconds: int):
+        self.table = boto3.resource("dynamodb").Table(table_name)
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key: str) -> bytes | None:
+        item = self.table.get_item(Key={"CacheKey": key}).get("Item")
+        if not item or int(item.get("expire", 0)) < time.time():
+            return None
+        return item["Results"].value
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.MAX_ITEM_BYTES:
+            return
+        self.table.put_item(
+            Item={
+                "CacheKey": key,
+                "Results": data,
+                "expire": int(time.time()) + self.ttl_seconds,
+            }
+        )
+
+
+class RetrievalCache:
+    def __init__(
+        self,
+        config: RetrievalCacheConfig = DEFAULT_RETRIEVAL_CACHE_CONFIG,
+        store: DynamoDBRetrievalStore | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = config["max_entries"]
+        self.ttl_seconds = config["ttl_seconds"]
+        self.store = store
+        self.clock = clock
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_local(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expire, data = entry
+            if expire <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def _put_local(self, key: str, data: bytes):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl_seconds, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, key: str) -> type_results | None:
+        data = self._get_local(key)
+        if data is not None:
+            metrics.incr("retrieval_cache.hit", dimensions={"tier": "memory"})
+            return decode_results(data)
+
+        if self.store is not None:
+            try:
+                with metrics.timer("retrieval_cache.store_latency"):
+                    data = self.store.get(key)
+            except Exception as e:
+                logger.warning(f"Failed to read retrieval cache: {e}")
+            if data is not None:
+                metrics.incr("retrieval_cache.hit", dimensions={"tier": "store"})
+                self._put_local(key, data)
+                return decode_results(data)
+
+        metrics.incr("retrieval_cache.miss")
+        return None
+
+    def _save(self, key: str, results: type_results):
+        data = encode_results(results)
+        metrics.incr("retrieval_cache.stored_bytes", len(data))
+        self._put_local(key, data)
+        if self.store is not None:
+            try:
+                self.store.put(key, data)
+            except Exception as e:
+                logger.warning(f"Failed to write retrieval cache: {e}")
+
+    def get_or_compute(
+        self, key: str, compute: Callable[[], type_results]
+    ) -> type_results:
+        """Return the cached results for `key`, or compute and cache them.
+        Errors of the persistent tier are logged and treated as a miss.
+        `PartialResults` are returned without being cached.
+        """
+        results = self._lookup(key)
+        if results is not None:
+            return results
+
+        with metrics.timer("retrieval_cache.compute_latency"):
+            results = compute()
+        if not isinstance(results, PartialResults):
+            self._save(key, results)
+        return results
+
+    def get_or_compute_many(
+        self, keys: list[str], compute: Callable[[list[int]], list[type_results]]
+    ) -> list[type_results]:
+        """Like `get_or_compute` for several keys. `compute` receives the indices of
+        the missing keys and returns their results in the same order.
+        """
+        results: list[type_results | None] = [self._lookup(key) for key in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            with metrics.timer("retrieval_cache.compute_latency"):
+                computed = compute(missing)
+            for i, r in zip(missing, computed):
+                if not isinstance(r, PartialResults):
+                    self._save(keys[i], r)
+                results[i] = r
+        return results  # type: ignore
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache: RetrievalCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_retrieval_cache() -> RetrievalCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            store = None
+            if RETRIEVAL_CACHE_TABLE_NAME:
+                store = DynamoDBRetrievalStore(
+                    RETRIEVAL_CACHE_TABLE_NAME,
+                    DEFAULT_RETRIEVAL_CACHE_CONFIG["ttl_seconds"],
+                )
+            _cache = RetrievalCache(store=store)
+        return _cache
@@ -0,0 +1,117 @@
+"""Snapshots of the search results of chat turns.
+A chat turn stores the results inserted into the prompt, keyed by the id of the user
+message, so that the related documents endpoint serves exactly the chunks cited by
+the answer without embedding and searching again. The frontend requests the related
+documents while the turn is still running, so the endpoint waits for the snapshot
+for a while before falling back to a live search.
+Snapshots are stored in the DynamoDB table `RETRIEVAL_SNAPSHOT_TABLE_NAME` (with the
+layout of `DynamoDBRetrievalStore`) and expire after `ttl_seconds`.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from app.config import DEFAULT_RETRIEVAL_SNAPSHOT_CONFIG, RetrievalSnapshotConfig
+from app.metrics import metrics
+from app.retrieval_cache import DynamoDBRetrievalStore, decode_results, encode_results
+from app.vector_search import SearchResult
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RETRIEVAL_SNAPSHOT_TABLE_NAME = os.environ.get("RETRIEVAL_SNAPSHOT_TABLE_NAME", "")
+
+
+def compose_snapshot_key(user_id: str, conversation_id: str, message_id: str) -> str:
+    return f"{user_id}#{conversation_id}#{message_id}"
+
+
+class RetrievalSnapshots:
+    def __init__(
+        self,
+        store: DynamoDBRetrievalStore | None,
+        config: RetrievalSnapshotConfig = DEFAULT_RETRIEVAL_SNAPSHOT_CONFIG,
+        sleep: Callable[[float], None] = time.sleep,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.store = store
+        self.wait_seconds = config["wait_seconds"]
+        self.poll_interval_seconds = config["poll_interval_seconds"]
+        self.sleep = sleep
+        self.clock = clock
+
+    def save(
+        self,
+        user_id: str,
+        conversation_id: str,
+        message_id: str,
+        results: list[SearchResult],
+    ):
+        """Store the results of the turn. Errors are logged, since the related
+        documents endpoint can still search by itself.
+        """
+        if self.store is None:
+            return
+        data = encode_results(
+            [(r.bot_id, r.content, r.source, r.score, r.rank) for r in results]
+        )
+        try:
+            self.store.put(
+                compose_snapshot_key(user_id, conversation_id, message_id), data
+            )
+        except Exception as e:
+            logger.warning(f"Failed to store retrieval snapshot: {e}")
+
+    def load(
+        self, user_id: str, conversation_id: str, message_id: str, wait: bool = False
+    ) -> list[SearchResult] | None:
+        """Return the results of the turn, or None if there is no snapshot.
+        With `wait`, the snapshot is polled for up to `wait_seconds`.
+        """
+        if self.store is None:
+            return None
+        key = compose_snapshot_key(user_id, conversation_id, message_id)
+        deadline = self.clock() + (self.wait_seconds if wait else 0)
+        while True:
+            try:
+                data = self.store.get(key)
+            except Exception as e:
+                logger.warning(f"Failed to read retrieval snapshot: {e}")
+                data = None
+            if data is not None:
+                metrics.incr("retrieval_snapshot.hit")
+                return [
+                    SearchResult(
+                        bot_id=bot_id,
+                        content=content,
+                        source=source,
+                        score=score,
+                        rank=rank,
+                    )
+                    for bot_id, content, source, score, rank in decode_results(data)
+                ]
+            if self.clock() + self.poll_interval_seconds > deadline:
+                metrics.incr("retrieval_snapshot.miss")
+                return None
+            self.sleep(self.poll_interval_seconds)
+
+
+_snapshots: RetrievalSnapshots | None = None
+_snapshots_lock = threading.Lock()
+
+
+def get_retrieval_snapshots() -> RetrievalSnapshots:
+    global _snapshots
+    with _snapshots_lock:
+        if _snapshots is None:
+            store = None
+            if RETRIEVAL_SNAPSHOT_TABLE_NAME:
+                store = DynamoDBRetrievalStore(
+                    RETRIEVAL_SNAPSHOT_TABLE_NAME,
+                    DEFAULT_RETRIEVAL_SNAPSHOT_CONFIG["ttl_seconds"],
+                )
+            _snapshots = RetrievalSnapshots(store)
+        return _snapshots
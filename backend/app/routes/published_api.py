@@ -11,12 +11,13 @@ from app.routes.schemas.published_api import (
 )
 from app.usecases.chat import chat, fetch_conversation
 from app.user import User
+from app.utils import LazyClient
 from fastapi import APIRouter, HTTPException, Request
 from ulid import ULID
 
 router = APIRouter(tags=["published_api"])
 
-sqs_client = boto3.client("sqs")
+sqs_client = LazyClient(lambda: boto3.client("sqs"))
 QUEUE_URL = os.environ.get("QUEUE_URL", "")
 
 
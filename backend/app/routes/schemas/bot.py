@@ -40,6 +40,9 @@ class GenerationParams(BaseSchema):
 
 class SearchParams(BaseSchema):
     max_results: int
+    ef_search: int | None = Field(None, ge=1, le=1000)
+    probes: int | None = Field(None, ge=1, le=1000)
+    max_context_tokens: int | None = Field(None, ge=100, le=100000)
 
 
 class AgentTool(BaseSchema):
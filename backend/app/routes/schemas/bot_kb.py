@@ -45,6 +45,8 @@ class BedrockKnowledgeBaseInput(BaseSchema):
     search_params: SearchParams
     max_tokens: int | None = None
     overlap_percentage: int | None = None
+    federated_knowledge_base_ids: list[str] | None = None
+    include_vector_store: bool = False
 
 
 class BedrockKnowledgeBaseOutput(BaseSchema):
@@ -56,3 +58,5 @@ class BedrockKnowledgeBaseOutput(BaseSchema):
     overlap_percentage: int | None = None
     knowledge_base_id: str | None = None
     data_source_ids: list[str] | None = None
+    federated_knowledge_base_ids: list[str] | None = None
+    include_vector_store: bool = False
@@ -1,3 +1,6 @@
+# Must be imported first to profile the imports of this entry point
+from app import profiling  # isort: skip
+
 import json
 
 from app.routes.schemas.conversation import (
@@ -28,3 +31,6 @@ def handler(event, context):
         print(chat_result)
 
     return {"statusCode": 200, "body": json.dumps("Processing completed")}
+
+
+profiling.report_cold_start("app.sqs_consumer")
@@ -1,12 +1,14 @@
 import logging
-from typing import Any, Callable
+from typing import TYPE_CHECKING, Any, Callable
 
-from app.bedrock import ConverseApiRequest, calculate_price, get_model_id
+from app.bedrock import ConverseApiRequest, RouteTarget, calculate_price, get_router
+from app.context_selection import estimate_tokens
 from app.routes.schemas.conversation import type_model_name
-from app.utils import get_bedrock_client
-from langchain_core.outputs import GenerationChunk
 from pydantic import BaseModel
 
+if TYPE_CHECKING:
+    from langchain_core.outputs import GenerationChunk
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,6 +21,22 @@ class OnStopInput(BaseModel):
     trace: dict | None = None
 
 
+def _block_text(block: dict) -> str:
+    if "text" in block:
+        return block["text"]
+    return block.get("guardContent", {}).get("text", {}).get("text", "")
+
+
+def estimate_input_tokens(args: ConverseApiRequest) -> int:
+    """Rough input token count of the text of a Converse API request.
+    Images and documents are not counted.
+    """
+    blocks = list(args["system"])
+    for message in args["messages"]:
+        blocks.extend(message["content"])
+    return sum(estimate_tokens(text) for text in map(_block_text, blocks) if text)
+
+
 class ConverseApiStreamHandler:
     """Stream handler using Converse API.
     Ref: https://docs.aws.amazon.com/bedrock/latest/userguide/conversation-inference.html
@@ -27,17 +45,21 @@ class ConverseApiStreamHandler:
     def __init__(
         self,
         model: type_model_name,
-        on_stream: Callable[[str], GenerationChunk | None],
-        on_stop: Callable[[OnStopInput], GenerationChunk | None],
+        on_stream: Callable[[str], "GenerationChunk | None"],
+        on_stop: Callable[[OnStopInput], "GenerationChunk | None"],
+        should_cancel: Callable[[], bool] | None = None,
     ):
         """Base class for stream handlers.
         :param model: Model name.
         :param on_stream: Callback function for streaming.
         :param on_stop: Callback function for stopping the stream.
+        :param should_cancel: Called after each streamed token. If it returns True,
+            the stream is closed and `on_stop` is called with the `cancelled` stop reason.
         """
         self.model: type_model_name = model
         self.on_stream = on_stream
         self.on_stop = on_stop
+        self.should_cancel = should_cancel
 
     @classmethod
     def from_model(cls, model: type_model_name):
@@ -53,34 +75,51 @@ class ConverseApiStreamHandler:
         return self
 
     def run(self, args: ConverseApiRequest):
-        client = get_bedrock_client()
-        response = client.converse_stream(
-            modelId=args["model_id"],
+        converse_stream_args = dict(
             messages=args["messages"],
             inferenceConfig=args["inference_config"],
             system=args["system"],
-            guardrailConfig=args["guardrail_config"],
+        )
+        if args.get("guardrail_config"):
+            converse_stream_args["guardrailConfig"] = args["guardrail_config"]
+        # Only opening the stream is retried (or failed over). Once tokens have been
+        # yielded, retrying would duplicate the output.
+        response, target = get_router().invoke(
+            self.model,
+            lambda client, target: client.converse_stream(
+                modelId=target.model_id, **converse_stream_args
+            ),
         )
 
+        stream = response["stream"]
         completions = []
         stop_reason = ""
         trace = None
-        for event in response["stream"]:
+        for event in stream:
             if "contentBlockDelta" in event:
                 text = event["contentBlockDelta"]["delta"]["text"]
                 completions.append(text)
                 response = self.on_stream(text)
                 yield response
+                if self.should_cancel is not None and self.should_cancel():
+                    # Closing the stream stops the generation, so that the remaining
+                    # tokens are not generated (and billed).
+                    stream.close()
+                    yield self._cancel(completions, args, target)
+                    return
             elif "messageStop" in event:
                 stop_reason = event["messageStop"]["stopReason"]
             elif "metadata" in event:
                 metadata = event["metadata"]
                 usage = metadata["usage"]
-                trace = metadata["trace"]
+                trace = metadata.get("trace")
                 input_token_count = usage["inputTokens"]
                 output_token_count = usage["outputTokens"]
                 price = calculate_price(
-                    self.model, input_token_count, output_token_count
+                    self.model,
+                    input_token_count,
+                    output_token_count,
+                    region=target.region,
                 )
                 concatenated = "".join(completions)
                 response = self.on_stop(
@@ -94,3 +133,27 @@ class ConverseApiStreamHandler:
                     )
                 )
                 yield response
+
+    def _cancel(
+        self, completions: list[str], args: ConverseApiRequest, target: RouteTarget
+    ):
+        logger.info("Generation was cancelled.")
+        # Bedrock reports the token usage only at the end of the stream, so the usage
+        # of a cancelled generation is estimated from the request and the completion.
+        concatenated = "".join(completions)
+        input_token_count = estimate_input_tokens(args)
+        output_token_count = estimate_tokens(concatenated)
+        return self.on_stop(
+            OnStopInput(
+                full_token=concatenated.rstrip(),
+                stop_reason="cancelled",
+                input_token_count=input_token_count,
+                output_token_count=output_token_count,
+                price=calculate_price(
+                    self.model,
+                    input_token_count,
+                    output_token_count,
+                    region=target.region,
+                ),
+            )
+        )
@@ -1,7 +1,6 @@
 import logging
 import os
 
-from app.agents.utils import get_available_tools, get_tool_by_name
 from app.config import DEFAULT_EMBEDDING_CONFIG
 from app.config import DEFAULT_GENERATION_CONFIG as DEFAULT_CLAUDE_GENERATION_CONFIG
 from app.config import DEFAULT_MISTRAL_GENERATION_CONFIG, DEFAULT_SEARCH_CONFIG
@@ -103,6 +102,9 @@ def create_new_bot(user_id: str, bot_input: BotInput) -> BotOutput:
     """Create a new bot.
     Bot is created as private and not pinned.
     """
+    # Imported here since loading the agent tools (LangChain) is slow on cold start
+    from app.agents.utils import get_tool_by_name
+
     current_time = get_current_time()
     has_knowledge = bot_input.knowledge and (
         len(bot_input.knowledge.source_urls) > 0
@@ -291,6 +293,9 @@ def modify_owned_bot(
     user_id: str, bot_id: str, modify_input: BotModifyInput
 ) -> BotModifyOutput:
     """Modify owned bot."""
+    # Imported here since loading the agent tools (LangChain) is slow on cold start
+    from app.agents.utils import get_tool_by_name
+
     source_urls = []
     sitemap_urls = []
     filenames = []
@@ -778,6 +783,9 @@ def remove_uploaded_file(user_id: str, bot_id: str, filename: str):
 
 def fetch_available_agent_tools():
     """Fetch available tools for bot."""
+    # Imported here since loading the agent tools (LangChain) is slow on cold start
+    from app.agents.utils import get_available_tools
+
     return get_available_tools()
 
 
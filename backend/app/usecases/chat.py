@@ -2,17 +2,12 @@ import logging
 from copy import deepcopy
 from typing import Literal
 
-from app.agents.agent import AgentExecutor, create_react_agent, format_log_to_str
-from app.agents.handlers.token_count import get_token_count_callback
-from app.agents.handlers.used_chunk import get_used_chunk_callback
-from app.agents.langchain import BedrockLLM
-from app.agents.tools.knowledge import AnswerWithKnowledgeTool
-from app.agents.utils import get_tool_by_name
 from app.bedrock import (
     calculate_price,
     call_converse_api,
     compose_args_for_converse_api,
 )
+from app.context_selection import select_context
 from app.prompt import build_rag_prompt
 from app.repositories.conversation import (
     RecordNotFoundError,
@@ -31,6 +26,7 @@ from app.repositories.models.custom_bot import (
     BotModel,
     ConversationQuickStarterModel,
 )
+from app.retrieval_snapshot import get_retrieval_snapshots
 from app.routes.schemas.conversation import (
     ChatInput,
     ChatOutput,
@@ -255,6 +251,18 @@ def chat(user_id: str, chat_input: ChatInput) -> ChatOutput:
 
     if bot and bot.is_agent_enabled():
         logger.info("Bot has agent tools. Using agent for response.")
+        # Imported here so that the agent stack (LangChain, tools) is loaded only when needed
+        from app.agents.agent import (
+            AgentExecutor,
+            create_react_agent,
+            format_log_to_str,
+        )
+        from app.agents.handlers.token_count import get_token_count_callback
+        from app.agents.handlers.used_chunk import get_used_chunk_callback
+        from app.agents.langchain import BedrockLLM
+        from app.agents.tools.knowledge import AnswerWithKnowledgeTool
+        from app.agents.utils import get_tool_by_name
+
         llm = BedrockLLM.from_model(model=chat_input.message.model)
 
         tools = [get_tool_by_name(t.name) for t in bot.agent.tools]
@@ -319,6 +327,14 @@ def chat(user_id: str, chat_input: ChatInput) -> ChatOutput:
 
             search_results = search_related_docs(bot=bot, query=query)
             logger.info(f"Search results from vector store: {search_results}")
+            search_results = select_context(
+                search_results, bot.search_params.max_context_tokens
+            ).results
+            if bot.display_retrieved_chunks and chat_input.message.message_id:
+                # Served by `fetch_related_documents`
+                get_retrieval_snapshots().save(
+                    user_id, conversation.id, user_msg_id, search_results
+                )
 
             # Insert contexts to instruction
             conversation_with_context = insert_knowledge(
@@ -369,7 +385,12 @@ def chat(user_id: str, chat_input: ChatInput) -> ChatOutput:
         input_tokens = converse_response["usage"]["inputTokens"]
         output_tokens = converse_response["usage"]["outputTokens"]
 
-        price = calculate_price(chat_input.message.model, input_tokens, output_tokens)
+        price = calculate_price(
+            chat_input.message.model,
+            input_tokens,
+            output_tokens,
+            region=converse_response["region"],
+        )
         # Published API does not support continued generation
         conversation.should_continue = False
 
@@ -586,12 +607,30 @@ def fetch_related_documents(
     if not chat_input.bot_id:
         return []
 
-    _, bot = fetch_bot(user_id, chat_input.bot_id)
-    if not bot.display_retrieved_chunks:
-        return None
-
-    query: str = chat_input.message.content[-1].body  # type: ignore[assignment]
-    chunks = search_related_docs(bot=bot, query=query)
+    # Snapshots are stored only for bots displaying the retrieved chunks, so the bot is
+    # fetched only if there is none yet
+    message_id = chat_input.message.message_id
+    snapshots = get_retrieval_snapshots()
+    chunks = None
+    if message_id:
+        chunks = snapshots.load(user_id, chat_input.conversation_id, message_id)
+
+    if chunks is None:
+        _, bot = fetch_bot(user_id, chat_input.bot_id)
+        if not bot.display_retrieved_chunks:
+            return None
+        if message_id and bot.has_knowledge() and not bot.is_agent_enabled():
+            # The chat turn may still be retrieving
+            chunks = snapshots.load(
+                user_id, chat_input.conversation_id, message_id, wait=True
+            )
+        if chunks is None:
+            query: str = chat_input.message.content[-1].body  # type: ignore[assignment]
+            # Selected like in `chat`, so that the ranks match the citations
+            chunks = select_context(
+                search_related_docs(bot=bot, query=query),
+                bot.search_params.max_context_tokens,
+            ).results
 
     documents = []
     for chunk in chunks:
@@ -1,13 +1,16 @@
-import json
 import logging
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any, List, Literal
+from typing import Any, Callable, List, Literal
 
 import boto3
-import pg8000
-from aws_lambda_powertools.utilities import parameters
+from app.config import DEFAULT_PRESIGNED_URL_CACHE_CONFIG, PresignedUrlCacheConfig
+from app.metrics import metrics
+from app.postgres import pool
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
@@ -18,7 +21,6 @@ BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "ap-southeast-2")
 PUBLISH_API_CODEBUILD_PROJECT_NAME = os.environ.get(
     "PUBLISH_API_CODEBUILD_PROJECT_NAME", ""
 )
-DB_SECRETS_ARN = os.environ.get("DB_SECRETS_ARN", "")
 
 
 def snake_to_camel(snake_str):
@@ -40,8 +42,37 @@ def is_running_on_lambda():
     return "AWS_EXECUTION_ENV" in os.environ
 
 
-def get_bedrock_client(region=BEDROCK_REGION):
-    client = boto3.client("bedrock-runtime", region)
+class LazyClient:
+    """Proxy which creates a boto3 client (or resource) on first use.
+    Creating clients takes tens of milliseconds, so module level clients are wrapped
+    with this class to keep them out of the cold start of handlers which don't use them.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._client: Any = None
+        self._lock = threading.Lock()
+
+    def _get_client(self) -> Any:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get_client(), name)
+
+
+def get_bedrock_client(region=BEDROCK_REGION, endpoint_url: str | None = None):
+    # Retries are handled by `app.resilience`, so disable botocore's own retries
+    # to avoid multiplying the number of attempts.
+    client = boto3.client(
+        "bedrock-runtime",
+        region,
+        endpoint_url=endpoint_url,
+        config=Config(retries={"max_attempts": 0, "mode": "standard"}),
+    )
     return client
 
 
@@ -55,6 +86,16 @@ def get_current_time():
     return int(datetime.now().timestamp() * 1000)
 
 
+# See: https://github.com/boto/boto3/issues/421#issuecomment-1849066655
+presign_client = LazyClient(
+    lambda: boto3.client(
+        "s3",
+        region_name=REGION,
+        config=Config(signature_version="v4", s3={"addressing_style": "path"}),
+    )
+)
+
+
 def generate_presigned_url(
     bucket: str,
     key: str,
@@ -62,16 +103,10 @@ def generate_presigned_url(
     expiration=3600,
     client_method: Literal["put_object", "get_object"] = "put_object",
 ):
-    # See: https://github.com/boto/boto3/issues/421#issuecomment-1849066655
-    client = boto3.client(
-        "s3",
-        region_name=REGION,
-        config=Config(signature_version="v4", s3={"addressing_style": "path"}),
-    )
     params = {"Bucket": bucket, "Key": key}
     if content_type:
         params["ContentType"] = content_type
-    response = client.generate_presigned_url(
+    response = presign_client.generate_presigned_url(
         ClientMethod=client_method,
         Params=params,
         ExpiresIn=expiration,
@@ -81,6 +116,62 @@ def generate_presigned_url(
     return response
 
 
+class PresignedUrlCache:
+    """Bounded LRU of presigned download URLs keyed by (bucket, key).
+    A URL is reused until `refresh_margin_seconds` before it expires, so that the same
+    sources cited in every turn are signed only once per expiration period.
+    """
+
+    def __init__(
+        self,
+        config: PresignedUrlCacheConfig = DEFAULT_PRESIGNED_URL_CACHE_CONFIG,
+        presign: Callable[[str, str, int], str] | None = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.max_entries = config["max_entries"]
+        self.expiration_seconds = config["expiration_seconds"]
+        self.refresh_margin_seconds = config["refresh_margin_seconds"]
+        self.presign = presign or (
+            lambda bucket, key, expiration: generate_presigned_url(
+                bucket, key, expiration=expiration, client_method="get_object"
+            )
+        )
+        self.clock = clock
+        self._entries: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, bucket: str, key: str) -> str:
+        cache_key = (bucket, key)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] - self.refresh_margin_seconds > now:
+                self._entries.move_to_end(cache_key)
+                metrics.incr("presigned_url.hit")
+                return entry[1]
+
+        metrics.incr("presigned_url.miss")
+        url = self.presign(bucket, key, self.expiration_seconds)
+        with self._lock:
+            self._entries[cache_key] = (now + self.expiration_seconds, url)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return url
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+presigned_url_cache = PresignedUrlCache()
+
+
+def generate_cached_presigned_download_url(bucket: str, key: str) -> str:
+    """Presigned `get_object` URL, reused while it stays valid for a while."""
+    return presigned_url_cache.get(bucket, key)
+
+
 def compose_upload_temp_s3_prefix(user_id: str, bot_id: str) -> str:
     return f"{user_id}/{bot_id}/_temp/"
 
@@ -100,6 +191,11 @@ def compose_upload_document_s3_path(user_id: str, bot_id: str, filename: str) ->
     return f"{user_id}/{bot_id}/documents/{filename}"
 
 
+def compose_vector_index_s3_prefix(user_id: str, bot_id: str) -> str:
+    """Compose S3 prefix for the local vector index snapshots of the bot."""
+    return f"{user_id}/{bot_id}/vector_index/"
+
+
 def delete_file_from_s3(bucket: str, key: str):
     client = boto3.client("s3")
 
@@ -190,28 +286,16 @@ def query_postgres(
         example: ((1, 'Alice'), (2, 'Bob')) if include_columns is False
                  (('id', 'name'), (1, 'Alice'), (2, 'Bob')) if include_columns is True
     """
-    secrets: Any = parameters.get_secret(DB_SECRETS_ARN)  # type: ignore
-    db_info = json.loads(secrets)
-
-    conn = pg8000.connect(
-        database=db_info["dbname"],
-        host=db_info["host"],
-        port=db_info["port"],
-        user=db_info["username"],
-        password=db_info["password"],
-    )
-
     args = params if params else ()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(query, args=args)
-            res = cursor.fetchall()
-            columns = tuple([desc[0] for desc in cursor.description])
+        with pool.connection() as pooled:
+            with pooled.conn.cursor() as cursor:
+                cursor.execute(query, args=args)
+                res = cursor.fetchall()
+                columns = tuple([desc[0] for desc in cursor.description])
     except Exception as e:
         logger.error(f"Error executing query: {e}")
         raise e
-    finally:
-        conn.close()
 
     logger.debug(f"{len(res)} records found.")
 
@@ -220,11 +304,41 @@ def query_postgres(
     return res
 
 
+def query_postgres_prepared(
+    query: str, settings: dict[str, int] | None = None, **params
+) -> tuple:
+    """Run `query` as a server-side prepared statement and return the rows.
+    Use this for queries executed on every request (e.g. the vector search), since the
+    statement is parsed and planned only once per pooled connection.
+    Args:
+        query (str): The SQL query using `:name` placeholders.
+        settings (dict, optional): Run-time parameters applied with `SET LOCAL` for this query only,
+            e.g. `{"hnsw.ef_search": 100}`.
+        **params: The values of the placeholders.
+    """
+    try:
+        with pool.connection() as pooled:
+            for name, value in (settings or {}).items():
+                # `SET` does not accept bind parameters, so validate the values instead
+                if not re.fullmatch(r"[a-z_]+(\.[a-z_]+)?", name):
+                    raise ValueError(f"Invalid setting name: {name}")
+                pooled.conn.run(f"SET LOCAL {name} = {int(value)}")
+            # The transaction (and the settings) end when the connection is released
+            return pooled.prepare(query).run(**params)
+    except Exception as e:
+        logger.error(f"Error executing query: {e}")
+        raise e
+
+
 def list_guardrails(id: str | None = None) -> List[dict]:
     """List all guardrails. Giving an ID will return all versions of the guardrail with that ID."""
     logger.info(f"Listing guardrails with id: {id}")
     client = boto3.client("bedrock", region_name=REGION)
-    response = client.list_guardrails(guardrailIdentifier=id) if id else client.list_guardrails()
+    response = (
+        client.list_guardrails(guardrailIdentifier=id)
+        if id
+        else client.list_guardrails()
+    )
     logger.info(f"Result: {response}")
     results = response["guardrails"] if "guardrails" in response else []
     logger.info(f"Guardrails: {results}")
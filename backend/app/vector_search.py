@@ -1,18 +1,48 @@
-import json
 import logging
 import re
-from typing import Any, Literal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Literal
 
-from app.bedrock import calculate_query_embedding
+from app.bedrock import calculate_query_embedding, calculate_query_embeddings
+from app.config import DEFAULT_FEDERATED_SEARCH_CONFIG
+from app.local_index import LocalIndex, get_local_index_cache
+from app.local_index import is_available as is_local_index_available
+from app.metrics import metrics
+from app.pgvector import (
+    compose_multi_search_query,
+    compose_search_query,
+    count_candidates,
+    distance_to_similarity,
+    format_vector,
+    search_settings,
+)
 from app.repositories.custom_bot import find_public_bot_by_id
 from app.repositories.models.custom_bot import BotModel
-from app.utils import generate_presigned_url, get_bedrock_agent_client, query_postgres
+from app.retrieval_cache import (
+    PartialResults,
+    compose_cache_key,
+    get_retrieval_cache,
+)
+from app.utils import (
+    LazyClient,
+    generate_cached_presigned_download_url,
+    get_bedrock_agent_client,
+    query_postgres_prepared,
+)
 from botocore.exceptions import ClientError
 from pydantic import BaseModel
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-agent_client = get_bedrock_agent_client()
+agent_client = LazyClient(get_bedrock_agent_client)
+
+_federated_executor: ThreadPoolExecutor | None = None
+_federated_executor_lock = threading.Lock()
+# Searches still running past their deadline, keyed by source label
+_stragglers: dict[str, int] = {}
+_stragglers_lock = threading.Lock()
 
 
 class SearchResult(BaseModel):
@@ -20,6 +50,38 @@ class SearchResult(BaseModel):
     content: str
     source: str
     rank: int
+    # Similarity to the query (higher is more relevant), if the source reports one
+    score: float | None = None
+
+
+class MultiSearchResult(BaseModel):
+    # Results of each query, in the order of the queries
+    results: list[list[SearchResult]]
+    # Results of all the queries fused by reciprocal rank fusion
+    fused: list[SearchResult]
+
+
+class RetrievalSource(BaseModel):
+    type: Literal["knowledge_base", "pgvector"]
+    # Knowledge base id, or bot id of the pgvector items
+    id: str
+
+    @property
+    def label(self) -> str:
+        return f"{self.type}:{self.id}"
+
+
+class FederatedSearchResult(BaseModel):
+    # Results of all the sources fused by reciprocal rank fusion
+    results: list[SearchResult]
+    # Latency (milliseconds) of each source which answered, keyed by label
+    latencies: dict[str, float]
+    # Labels of the sources which failed or missed the deadline
+    missing_sources: list[str]
+
+
+# Constant of reciprocal rank fusion. Ref: https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+RRF_K = 60
 
 
 def filter_used_results(
@@ -54,11 +116,8 @@ def get_source_link(source: str) -> tuple[Literal["s3", "url"], str]:
         bucket_name = path_parts[0]
         object_key = path_parts[1] if len(path_parts) > 1 else ""
 
-        source_link = generate_presigned_url(
-            bucket=bucket_name,
-            key=object_key,
-            client_method="get_object",
-        )
+        # Cached since the same sources are cited over and over
+        source_link = generate_cached_presigned_download_url(bucket_name, object_key)
         return "s3", source_link
     elif source.startswith("http://") or source.startswith("https://"):
         return "url", source
@@ -67,40 +126,59 @@ def get_source_link(source: str) -> tuple[Literal["s3", "url"], str]:
         return "url", f"https://www.youtube.com/watch?v={source}"
 
 
-def _pgvector_search(bot_id: str, limit: int, query: str) -> list[SearchResult]:
+def _pgvector_search(
+    bot_id: str,
+    limit: int,
+    query: str,
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> list[SearchResult]:
     """Search to fetch top n most related documents from pgvector.
     Args:
         bot_id (str): bot id
         limit (int): number of results to return
         query (str): query string
+        ef_search (int, optional): HNSW search breadth. Defaults to the index config.
+        probes (int, optional): Number of IVFFlat lists to probe. Defaults to the index config.
     Returns:
         list[SearchResult]: list of search results
     """
     query_embedding = calculate_query_embedding(query)
     logger.info(f"query_embedding: {query_embedding}")
 
-    search_query = """
-SELECT id, botid, content, source, embedding
-FROM items
-WHERE botid = %s
-ORDER BY embedding <-> %s
-LIMIT %s
-"""
-
-    results = query_postgres(search_query, (bot_id, json.dumps(query_embedding), limit))
+    # Executed as a prepared statement since this runs on every chat turn
+    results = query_postgres_prepared(
+        compose_search_query(),
+        settings=search_settings(limit, ef_search=ef_search, probes=probes),
+        bot_id=bot_id,
+        embedding=format_vector(query_embedding),
+        limit=limit,
+        candidates=count_candidates(limit),
+    )
     # NOTE: results should be:
     # [
-    #     ('123', 'bot_1', 'content_1', 'source_1', [0.123, 0.456, 0.789]),
-    #     ('124', 'bot_1', 'content_2', 'source_2', [0.234, 0.567, 0.890]),
+    #     ('123', 'bot_1', 'content_1', 'source_1', 0.123),
+    #     ('124', 'bot_1', 'content_2', 'source_2', 0.234),
     #     ...
     # ]
     return [
-        SearchResult(rank=i, bot_id=r[1], content=r[2], source=r[3])
+        SearchResult(
+            rank=i,
+            bot_id=r[1],
+            content=r[2],
+            source=r[3],
+            score=distance_to_similarity(r[4]),
+        )
         for i, r in enumerate(results)
     ]
 
 
-def _bedrock_knowledge_base_search(bot: BotModel, query: str) -> list[SearchResult]:
+def _bedrock_knowledge_base_search(
+    bot: BotModel, query: str, knowledge_base_id: str | None = None
+) -> list[SearchResult]:
+    """Search the knowledge base of the bot, or the given knowledge base with the
+    search parameters of the bot.
+    """
     assert bot.bedrock_knowledge_base is not None
     if bot.bedrock_knowledge_base.search_params.search_type == "semantic":
         search_type = "SEMANTIC"
@@ -110,7 +188,9 @@ def _bedrock_knowledge_base_search(bot: BotModel, query: str) -> list[SearchResu
         raise ValueError("Invalid search type")
 
     limit = bot.bedrock_knowledge_base.search_params.max_results
-    knowledge_base_id = bot.bedrock_knowledge_base.knowledge_base_id
+    knowledge_base_id = (
+        knowledge_base_id or bot.bedrock_knowledge_base.knowledge_base_id
+    )
 
     try:
         response = agent_client.retrieve(
@@ -134,7 +214,13 @@ def _bedrock_knowledge_base_search(bot: BotModel, query: str) -> list[SearchResu
             )
 
             search_results.append(
-                SearchResult(rank=i, bot_id=bot.id, content=content, source=source)
+                SearchResult(
+                    rank=i,
+                    bot_id=bot.id,
+                    content=content,
+                    source=source,
+                    score=retrieval_result.get("score"),
+                )
             )
 
         return search_results
@@ -144,9 +230,369 @@ def _bedrock_knowledge_base_search(bot: BotModel, query: str) -> list[SearchResu
         raise e
 
 
-def search_related_docs(bot: BotModel, query: str) -> list[SearchResult]:
+def _get_local_index(bot: BotModel) -> LocalIndex | None:
+    """Return the local index of the last sync of the bot, if it has a snapshot.
+    Snapshots are written only for small bots, so this also selects the backend by size.
+    """
+    if (
+        not is_local_index_available()
+        or bot.has_bedrock_knowledge_base()
+        or not bot.sync_last_exec_id
+    ):
+        return None
+    return get_local_index_cache().get(
+        bot.owner_user_id, bot.id, bot.sync_last_exec_id, bot.knowledge_version
+    )
+
+
+def _local_index_search_many(
+    index: LocalIndex, limit: int, queries: list[str]
+) -> list[list[SearchResult]]:
+    query_embeddings = calculate_query_embeddings(queries)
+    with metrics.timer("local_index.search_latency"):
+        results = index.search_many(query_embeddings, limit)
+    return [
+        [
+            SearchResult(
+                rank=i, bot_id=bot_id, content=content, source=source, score=score
+            )
+            for i, (bot_id, content, source, score) in enumerate(query_results)
+        ]
+        for query_results in results
+    ]
+
+
+def _vector_store_search(bot: BotModel, query: str) -> list[SearchResult]:
+    index = _get_local_index(bot)
+    if index is not None:
+        logger.info("Searching related documents using the local index.")
+        limit = bot.search_params.max_results
+        return _local_index_search_many(index, limit, [query])[0]
+    logger.info("Searching related documents using pgvector.")
+    return _pgvector_search(
+        bot.id,
+        bot.search_params.max_results,
+        query,
+        ef_search=bot.search_params.ef_search,
+        probes=bot.search_params.probes,
+    )
+
+
+def compose_retrieval_sources(bot: BotModel) -> list[RetrievalSource]:
+    """List the knowledge sources of the bot."""
+    if bot.bedrock_knowledge_base is None:
+        return [RetrievalSource(type="pgvector", id=bot.id)]
+    knowledge_base = bot.bedrock_knowledge_base
+    sources = [
+        RetrievalSource(
+            type="knowledge_base", id=knowledge_base.knowledge_base_id or ""
+        )
+    ]
+    for knowledge_base_id in knowledge_base.federated_knowledge_base_ids or []:
+        if knowledge_base_id != knowledge_base.knowledge_base_id:
+            sources.append(RetrievalSource(type="knowledge_base", id=knowledge_base_id))
+    if knowledge_base.include_vector_store:
+        sources.append(RetrievalSource(type="pgvector", id=bot.id))
+    return sources
+
+
+def _get_federated_executor() -> ThreadPoolExecutor:
+    # Shared by all requests, so that a source which misses the deadline does not
+    # block the request until it answers
+    global _federated_executor
+    with _federated_executor_lock:
+        if _federated_executor is None:
+            _federated_executor = ThreadPoolExecutor(
+                max_workers=DEFAULT_FEDERATED_SEARCH_CONFIG["max_workers"],
+                thread_name_prefix="federated-search",
+            )
+        return _federated_executor
+
+
+def _release_straggler(label: str):
+    with _stragglers_lock:
+        _stragglers[label] -= 1
+        if _stragglers[label] == 0:
+            del _stragglers[label]
+
+
+def _search_source(
+    bot: BotModel, source: RetrievalSource, query: str
+) -> list[SearchResult]:
+    if source.type == "knowledge_base":
+        return _bedrock_knowledge_base_search(bot, query, knowledge_base_id=source.id)
+    return _vector_store_search(bot, query)
+
+
+def federated_search(
+    bot: BotModel,
+    query: str,
+    sources: list[RetrievalSource] | None = None,
+    deadline_seconds: float = DEFAULT_FEDERATED_SEARCH_CONFIG["deadline_seconds"],
+    search_source: Callable[
+        [BotModel, RetrievalSource, str], list[SearchResult]
+    ] = _search_source,
+    max_stragglers_per_source: int = DEFAULT_FEDERATED_SEARCH_CONFIG[
+        "max_stragglers_per_source"
+    ],
+) -> FederatedSearchResult:
+    """Search several knowledge sources concurrently and fuse their results by
+    reciprocal rank fusion. Sources which fail or do not answer within
+    `deadline_seconds` are left out of the results. Searches which have not started by
+    the deadline are cancelled, and a source with `max_stragglers_per_source` searches
+    still running past their deadline is skipped until they finish. Raises the error of
+    the first source if all of them fail.
+    """
+    if sources is None:
+        sources = compose_retrieval_sources(bot)
+
+    def search(source: RetrievalSource) -> tuple[list[SearchResult], float]:
+        start = time.perf_counter()
+        try:
+            source_results = search_source(bot, source, query)
+        finally:
+            # Recorded also for sources which missed the deadline
+            latency = (time.perf_counter() - start) * 1000
+            metrics.timing(
+                "federated_search.source_latency", latency, {"source": source.type}
+            )
+        return source_results, latency
+
+    results: list[list[SearchResult]] = []
+    latencies: dict[str, float] = {}
+    missing_sources: list[str] = []
+    errors: list[Exception] = []
+
+    with _stragglers_lock:
+        skipped = [
+            source
+            for source in sources
+            if _stragglers.get(source.label, 0) >= max_stragglers_per_source
+        ]
+    for source in skipped:
+        logger.warning(f"{source.label} is still busy with earlier searches. Skipping.")
+        metrics.incr("federated_search.skipped", dimensions={"source": source.type})
+        missing_sources.append(source.label)
+    sources = [source for source in sources if source not in skipped]
+
+    executor = _get_federated_executor()
+    futures = [executor.submit(search, source) for source in sources]
+    _, not_done = wait(futures, timeout=deadline_seconds)
+    for source, future in zip(sources, futures):
+        if future in not_done and not future.cancel():
+            with _stragglers_lock:
+                _stragglers[source.label] = _stragglers.get(source.label, 0) + 1
+            # Called right away if the search finished in the meantime
+            future.add_done_callback(
+                lambda _, label=source.label: _release_straggler(label)
+            )
+
+    for source, future in zip(sources, futures):
+        if future in not_done:
+            logger.warning(
+                f"{source.label} did not answer within {deadline_seconds}s. Skipping."
+            )
+            metrics.incr("federated_search.timeout", dimensions={"source": source.type})
+            missing_sources.append(source.label)
+            continue
+        try:
+            source_results, latency = future.result()
+        except Exception as e:
+            logger.error(f"Error searching {source.label}: {e}")
+            metrics.incr("federated_search.error", dimensions={"source": source.type})
+            missing_sources.append(source.label)
+            errors.append(e)
+            continue
+        results.append(source_results)
+        latencies[source.label] = latency
+
+    if errors and len(errors) == len(sources):
+        raise errors[0]
+
+    if bot.bedrock_knowledge_base is not None:
+        limit = bot.bedrock_knowledge_base.search_params.max_results
+    else:
+        limit = bot.search_params.max_results
+    return FederatedSearchResult(
+        results=fuse_results(results, limit),
+        latencies=latencies,
+        missing_sources=missing_sources,
+    )
+
+
+def _search_related_docs(bot: BotModel, query: str) -> list[SearchResult]:
+    sources = compose_retrieval_sources(bot)
+    if len(sources) > 1:
+        logger.info(f"Searching related documents using {len(sources)} sources.")
+        result = federated_search(bot, query, sources)
+        if result.missing_sources:
+            return PartialResults(result.results)
+        return result.results
     if bot.has_bedrock_knowledge_base():
         logger.info("Searching related documents using Bedrock Knowledge Base.")
         return _bedrock_knowledge_base_search(bot, query)
-    logger.info("Searching related documents using pgvector.")
-    return _pgvector_search(bot.id, bot.search_params.max_results, query)
+    return _vector_store_search(bot, query)
+
+
+def _compose_search_params(bot: BotModel) -> dict:
+    if bot.bedrock_knowledge_base is not None:
+        return {
+            "sources": [source.label for source in compose_retrieval_sources(bot)],
+            **bot.bedrock_knowledge_base.search_params.model_dump(),
+        }
+    return bot.search_params.model_dump()
+
+
+def _to_rows(results: list[SearchResult]) -> list[tuple]:
+    """Convert results to the cached representation, keeping them partial if they were."""
+    rows = [(r.bot_id, r.content, r.source, r.score) for r in results]
+    return PartialResults(rows) if isinstance(results, PartialResults) else rows
+
+
+def _from_rows(rows: list[tuple]) -> list[SearchResult]:
+    return [
+        SearchResult(
+            rank=i,
+            bot_id=r[0],
+            content=r[1],
+            source=r[2],
+            score=r[3],
+        )
+        for i, r in enumerate(rows)
+    ]
+
+
+def search_related_docs(bot: BotModel, query: str) -> list[SearchResult]:
+    """Search the knowledge of the bot. Results are cached per knowledge version of the bot."""
+    search_params = _compose_search_params(bot)
+    key = compose_cache_key(bot.id, bot.knowledge_version, search_params, query)
+
+    def compute() -> list[tuple]:
+        return _to_rows(_search_related_docs(bot, query))
+
+    return _from_rows(get_retrieval_cache().get_or_compute(key, compute))
+
+
+def _pgvector_search_many(
+    bot_id: str,
+    limit: int,
+    queries: list[str],
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> list[list[SearchResult]]:
+    """Search pgvector for several queries with a single embedding request and a single
+    statement. See `_pgvector_search` for the arguments.
+    """
+    query_embeddings = calculate_query_embeddings(queries)
+    rows = query_postgres_prepared(
+        compose_multi_search_query(),
+        settings=search_settings(limit, ef_search=ef_search, probes=probes),
+        bot_id=bot_id,
+        embeddings=[format_vector(e) for e in query_embeddings],
+        limit=limit,
+        candidates=count_candidates(limit),
+    )
+    # NOTE: rows are ordered by the query index, then by distance:
+    # [
+    #     (0, '123', 'bot_1', 'content_1', 'source_1', 0.123),
+    #     (0, '124', 'bot_1', 'content_2', 'source_2', 0.234),
+    #     (1, '124', 'bot_1', 'content_2', 'source_2', 0.345),
+    #     ...
+    # ]
+    results: list[list[SearchResult]] = [[] for _ in queries]
+    for r in rows:
+        query_results = results[r[0]]
+        query_results.append(
+            SearchResult(
+                rank=len(query_results),
+                bot_id=r[2],
+                content=r[3],
+                source=r[4],
+                score=distance_to_similarity(r[5]),
+            )
+        )
+    return results
+
+
+def fuse_results(
+    results: list[list[SearchResult]], limit: int, k: int = RRF_K
+) -> list[SearchResult]:
+    """Merge ranked result lists with reciprocal rank fusion.
+    Identical chunks (same content and source) found by several lists are merged, and
+    the fused results are re-ranked from 0.
+    """
+    scores: dict[tuple[str, str], float] = {}
+    chunks: dict[tuple[str, str], SearchResult] = {}
+    for query_results in results:
+        for result in query_results:
+            key = (result.source, result.content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + result.rank + 1)
+            chunks.setdefault(key, result)
+    ranked = sorted(scores, key=lambda key: -scores[key])[:limit]
+    return [
+        chunks[key].model_copy(update={"rank": rank}) for rank, key in enumerate(ranked)
+    ]
+
+
+def search_related_docs_many(bot: BotModel, queries: list[str]) -> MultiSearchResult:
+    """Search the knowledge of the bot for several queries at once, e.g. rewritten
+    queries or sub-queries of an agent. For pgvector, all the queries are embedded with
+    one request and searched with one statement; knowledge base queries run concurrently.
+    Results are cached per query like `search_related_docs`.
+    """
+    search_params = _compose_search_params(bot)
+    keys = [
+        compose_cache_key(bot.id, bot.knowledge_version, search_params, query)
+        for query in queries
+    ]
+
+    def compute(missing: list[int]) -> list[list[tuple]]:
+        missing_queries = [queries[i] for i in missing]
+        if len(sources := compose_retrieval_sources(bot)) > 1:
+            logger.info(
+                f"Searching related documents for {len(missing)} queries using {len(sources)} sources."
+            )
+            with ThreadPoolExecutor(max_workers=len(missing_queries)) as executor:
+                results = list(
+                    executor.map(
+                        lambda q: _search_related_docs(bot, q), missing_queries
+                    )
+                )
+        elif bot.has_bedrock_knowledge_base():
+            logger.info(
+                f"Searching related documents for {len(missing)} queries using Bedrock Knowledge Base."
+            )
+            with ThreadPoolExecutor(max_workers=len(missing_queries)) as executor:
+                results = list(
+                    executor.map(
+                        lambda q: _bedrock_knowledge_base_search(bot, q),
+                        missing_queries,
+                    )
+                )
+        elif (index := _get_local_index(bot)) is not None:
+            logger.info(
+                f"Searching related documents for {len(missing)} queries using the local index."
+            )
+            results = _local_index_search_many(
+                index, bot.search_params.max_results, missing_queries
+            )
+        else:
+            logger.info(
+                f"Searching related documents for {len(missing)} queries using pgvector."
+            )
+            results = _pgvector_search_many(
+                bot.id,
+                bot.search_params.max_results,
+                missing_queries,
+                ef_search=bot.search_params.ef_search,
+                probes=bot.search_params.probes,
+            )
+        return [_to_rows(rs) for rs in results]
+
+    cached = get_retrieval_cache().get_or_compute_many(keys, compute)
+    results = [_from_rows(query_results) for query_results in cached]
+    if bot.bedrock_knowledge_base is not None:
+        limit = bot.bedrock_knowledge_base.search_params.max_results
+    else:
+        limit = bot.search_params.max_results
+    return MultiSearchResult(results=results, fused=fuse_results(results, limit))
@@ -1,57 +1,55 @@
+# Must be imported first to profile the imports of this entry point
+from app import profiling  # isort: skip
+
 import json
 import logging
 import os
 import traceback
-import time
 from datetime import datetime
 from decimal import Decimal as decimal
+from typing import Callable
 
 import boto3
-from app.agents.agent import AgentExecutor, create_react_agent, format_log_to_str
-from app.agents.handlers.apigw_websocket import ApigwWebsocketCallbackHandler
-from app.agents.handlers.token_count import get_token_count_callback
-from app.agents.handlers.used_chunk import get_used_chunk_callback
-from app.agents.langchain import BedrockLLM
-from app.agents.tools.knowledge import AnswerWithKnowledgeTool
-from app.agents.utils import get_tool_by_name
 from app.auth import verify_token
-from app.bedrock import compose_args_for_converse_api, call_converse_api, ConverseApiRequest, ConverseApiResponse, get_model_id
+from app.bedrock import compose_args_for_converse_api, call_converse_api, get_model_id
+from app.context_selection import select_context
+from app.metrics import metrics
+from app.resilience import get_error_code
 from app.repositories.conversation import RecordNotFoundError, store_conversation
 from app.repositories.models.conversation import ChunkModel, ContentModel, MessageModel
+from app.retrieval_snapshot import get_retrieval_snapshots
 from app.routes.schemas.conversation import ChatInput
 from app.stream import ConverseApiStreamHandler, OnStopInput
 from app.usecases.bot import modify_bot_last_used_time
 from app.usecases.chat import insert_knowledge, prepare_conversation, trace_to_root
-from app.utils import get_current_time
+from app.utils import LazyClient, get_current_time
 from app.vector_search import filter_used_results, get_source_link, search_related_docs
+from app.websocket_payload import (
+    SUPPORTED_ENCODINGS,
+    PayloadDecoder,
+    PayloadIntegrityError,
+    compose_upload_key,
+    create_upload_url,
+    load_uploaded_payload,
+)
+from app.websocket_stream import (
+    CancellationMonitor,
+    FrameCoalescer,
+    WebsocketSender,
+)
 from boto3.dynamodb.conditions import Attr, Key
 from ulid import ULID
 
 WEBSOCKET_SESSION_TABLE_NAME = os.environ["WEBSOCKET_SESSION_TABLE_NAME"]
 
-dynamodb_client = boto3.resource("dynamodb")
-table = dynamodb_client.Table(WEBSOCKET_SESSION_TABLE_NAME)
+table = LazyClient(
+    lambda: boto3.resource("dynamodb").Table(WEBSOCKET_SESSION_TABLE_NAME)
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def invoke_bedrock_with_retries(args: ConverseApiRequest, try_count: int = 1) -> ConverseApiResponse:
-    """Invoke Bedrock with retries."""
-    max_retries: int = 3
-    try:
-        response = call_converse_api(args)
-    except Exception as e:
-        logger.error(f"Failed to invoke bedrock: {e}")
-        if try_count > max_retries:
-            raise e
-        if "throttling" in str(e):
-            time.sleep(try_count * 5)
-            return invoke_bedrock_with_retries(args, try_count=try_count + 1)
-        raise e
-    return response
-
-
 def get_rag_query(conversation, user_msg_id, chat_input, model=None):
     """Get query for RAG model."""
     query = ""
@@ -150,8 +148,8 @@ def get_rag_query(conversation, user_msg_id, chat_input, model=None):
         stream=False,
     )
     try:
-        # Invoke bedrock api
-        response = invoke_bedrock_with_retries(args)
+        # Invoke bedrock api (retries are handled by `call_converse_api`)
+        response = call_converse_api(args)
         # Use the product name returned by the LLM
         logger.info(f"Bedrock response: {response}")
         query = response['output']['message']['content'][0]['text']
@@ -193,6 +191,19 @@ def process_chat_input(
     logger.info(f"Found bot: {bot}")
     if bot and bot.is_agent_enabled():
         logger.info("Bot has agent tools. Using agent for response.")
+        # Imported here so that the agent stack (LangChain, tools) is loaded only when needed
+        from app.agents.agent import (
+            AgentExecutor,
+            create_react_agent,
+            format_log_to_str,
+        )
+        from app.agents.handlers.apigw_websocket import ApigwWebsocketCallbackHandler
+        from app.agents.handlers.token_count import get_token_count_callback
+        from app.agents.handlers.used_chunk import get_used_chunk_callback
+        from app.agents.langchain import BedrockLLM
+        from app.agents.tools.knowledge import AnswerWithKnowledgeTool
+        from app.agents.utils import get_tool_by_name
+
         llm = BedrockLLM.from_model(model=chat_input.message.model)
 
         tools = [get_tool_by_name(t.name) for t in bot.agent.tools]
@@ -310,6 +321,14 @@ def process_chat_input(
         logger.info(f"Query for RAG model: {query}")
         search_results = search_related_docs(bot=bot, query=query)
         logger.info(f"Search results from vector store: {search_results}")
+        search_results = select_context(
+            search_results, bot.search_params.max_context_tokens
+        ).results
+        if bot.display_retrieved_chunks and chat_input.message.message_id:
+            # Served by `fetch_related_documents`
+            get_retrieval_snapshots().save(
+                user_id, conversation.id, user_msg_id, search_results
+            )
 
         # Insert contexts to instruction
         conversation_with_context = insert_knowledge(
@@ -338,14 +357,43 @@ def process_chat_input(
         guardrail_config=(bot.guardrail_config if bot else None),
     )
 
-    def on_stream(token: str, **kwargs) -> None:
-        # Send completion
-        data_to_send = json.dumps(dict(status="STREAMING", completion=token)).encode(
-            "utf-8"
+    # Post frames from a separate thread so that reading the Bedrock stream is not
+    # blocked by API Gateway latency.
+    sender = WebsocketSender(
+        send=lambda data: gatewayapi.post_to_connection(
+            ConnectionId=connection_id, Data=data
         )
-        gatewayapi.post_to_connection(ConnectionId=connection_id, Data=data_to_send)
+    )
+    coalescer = FrameCoalescer(send=sender.post)
+    # The client cancels the generation with the `STOP` step or by disconnecting
+    cancellation = CancellationMonitor(
+        is_cancelled=lambda: is_session_cancelled(connection_id)
+    )
+
+    def send_frame(send: Callable[[], None]) -> None:
+        try:
+            send()
+        except Exception as e:
+            if get_error_code(e) != "GoneException":
+                raise
+            logger.info("Connection is gone. Cancelling the generation.")
+            cancellation.cancel(connection_gone=True)
+
+    def on_stream(token: str, **kwargs) -> None:
+        # Send completion. Tokens are buffered to reduce the number of API Gateway calls.
+        frames_sent = coalescer.frames_sent
+        send_frame(lambda: coalescer.add(token))
+        if coalescer.frames_sent != frames_sent:
+            # Check cancellation at frame boundaries only
+            cancellation.check()
 
     def on_stop(arg: OnStopInput, **kwargs) -> None:
+        # Send remaining tokens before the end of stream
+        send_frame(coalescer.close)
+        logger.info(
+            f"Sent {coalescer.tokens_received} tokens in {coalescer.frames_sent} frames."
+        )
+
         if chat_input.continue_generate:
             # For continue generate
             conversation.message_map[conversation.last_message_id].content[
@@ -402,18 +450,24 @@ def process_chat_input(
             logger.error(f"Guardrail intervened. {arg.trace}")
 
         # Store conversation before finish streaming so that front-end can avoid 404 issue
+        # NOTE: A cancelled generation is stored with the partial answer.
         store_conversation(user_id, conversation)
+        if cancellation.connection_gone:
+            # Nobody is listening anymore
+            sender.close(raise_error=False)
+            return
         last_data_to_send = json.dumps(
             dict(status="STREAMING_END", completion="", stop_reason=arg.stop_reason)
         ).encode("utf-8")
-        gatewayapi.post_to_connection(
-            ConnectionId=connection_id, Data=last_data_to_send
-        )
+        sender.post(last_data_to_send)
+        # Wait until all frames are delivered
+        sender.close()
 
     stream_handler = ConverseApiStreamHandler(
         model=chat_input.message.model,
         on_stream=on_stream,
         on_stop=on_stop,
+        should_cancel=lambda: cancellation.cancelled,
     )
     try:
         logger.info(f"Running stream handler with args: {args}")
@@ -422,6 +476,9 @@ def process_chat_input(
             ...
     except Exception as e:
         logger.error(f"Failed to run stream handler: {e}")
+        coalescer.close(flush=False)
+        # Deliver pending frames before the error is reported to the client
+        sender.close(raise_error=False)
         return {
             "statusCode": 500,
             "body": "Failed to run stream handler.",
@@ -435,6 +492,77 @@ def process_chat_input(
     return {"statusCode": 200, "body": "Message sent."}
 
 
+def mark_session_cancelled(connection_id: str):
+    """Record that the client cancelled the generation running for the connection."""
+    table.update_item(
+        Key={"ConnectionId": connection_id, "MessagePartId": decimal(0)},
+        UpdateExpression="SET Cancelled = :cancelled, expire = :expire",
+        ExpressionAttributeValues={
+            ":cancelled": True,
+            ":expire": int(datetime.now().timestamp()) + 60 * 2,
+        },
+    )
+
+
+def is_session_cancelled(connection_id: str) -> bool:
+    response = table.get_item(
+        Key={"ConnectionId": connection_id, "MessagePartId": decimal(0)},
+        ProjectionExpression="Cancelled",
+        ConsistentRead=True,
+    )
+    return bool(response.get("Item", {}).get("Cancelled", False))
+
+
+def concatenate_message_parts(
+    connection_id: str, decoder: PayloadDecoder | None = None
+) -> str:
+    """Concatenate the stored message parts in order.
+    If `decoder` is given, the parts are decompressed incrementally while being read.
+    """
+    message_parts = []
+    last_evaluated_key = None
+    next_part_id = 1
+
+    while True:
+        if last_evaluated_key:
+            response = table.query(
+                KeyConditionExpression=Key("ConnectionId").eq(connection_id)
+                # Zero is reserved for user id, so start from 1
+                & Key("MessagePartId").gte(1),
+                ExclusiveStartKey=last_evaluated_key,
+            )
+        else:
+            response = table.query(
+                KeyConditionExpression=Key("ConnectionId").eq(connection_id)
+                & Key("MessagePartId").gte(1),
+            )
+
+        if decoder is not None:
+            # Items are returned in the order of the sort key
+            for item in response["Items"]:
+                if item["MessagePartId"] != next_part_id:
+                    raise PayloadIntegrityError(
+                        f"Message part {next_part_id} is missing."
+                    )
+                decoder.update(item["MessagePart"])
+                next_part_id += 1
+        else:
+            message_parts.extend(response["Items"])
+
+        if "LastEvaluatedKey" in response:
+            last_evaluated_key = response["LastEvaluatedKey"]
+        else:
+            break
+
+    if decoder is not None:
+        logger.info(f"Number of compressed message chunks: {next_part_id - 1}")
+        return decoder.finish()
+
+    logger.info(f"Number of message chunks: {len(message_parts)}")
+    message_parts.sort(key=lambda x: x["MessagePartId"])
+    return "".join(item["MessagePart"] for item in message_parts)
+
+
 def handler(event, context):
     logger.info(f"Received event: {event}")
     route_key = event["requestContext"]["routeKey"]
@@ -442,6 +570,11 @@ def handler(event, context):
     if route_key == "$connect":
         return {"statusCode": 200, "body": "Connected."}
     elif route_key == "$disconnect":
+        # Stop the generation running for this connection, if any
+        try:
+            mark_session_cancelled(event["requestContext"]["connectionId"])
+        except Exception as e:
+            logger.error(f"Failed to mark session as cancelled: {e}")
         return {"statusCode": 200, "body": "Disconnected."}
 
     connection_id = event["requestContext"]["connectionId"]
@@ -466,6 +599,12 @@ def handler(event, context):
         # 4. This handler receives the message parts and appends them to the item in DynamoDB with index.
         # 5. Client sends `END` message to the WebSocket API.
         # 6. This handler receives the `END` message, concatenates the parts and sends the message to Bedrock.
+        # Alternatively, the client sends `START` with `upload: true` and receives a presigned URL
+        # (`UPLOAD_READY`). It uploads the full message to S3 and sends `END`, then the handler
+        # reads the message from S3 instead of the parts.
+        # The client may also send `START` with `encoding`, `size` and `checksum`, in which case the
+        # parts are slices of the base64 encoded compressed message and are decompressed in order.
+        # While streaming, the client can send `STOP` (or disconnect) to cancel the generation.
         if step == "START":
             token = body["token"]
             try:
@@ -477,55 +616,73 @@ def handler(event, context):
             user_id = decoded["sub"]
 
             # Store user id
-            response = table.put_item(
-                Item={
-                    "ConnectionId": connection_id,
-                    # Store as zero
-                    "MessagePartId": decimal(0),
-                    "UserId": user_id,
-                    "expire": expire,
+            item = {
+                "ConnectionId": connection_id,
+                # Store as zero
+                "MessagePartId": decimal(0),
+                "UserId": user_id,
+                "expire": expire,
+            }
+            encoding = body.get("encoding")
+            if encoding:
+                # Parts carry a compressed payload (see `PayloadDecoder`)
+                if encoding not in SUPPORTED_ENCODINGS:
+                    return {
+                        "statusCode": 400,
+                        "body": f"Unsupported encoding. Supported: {SUPPORTED_ENCODINGS}",
+                    }
+                item["Encoding"] = encoding
+                item["PayloadSize"] = decimal(int(body["size"]))
+                item["PayloadChecksum"] = body["checksum"]
+            elif body.get("upload"):
+                # The client uploads the full message to S3 instead of sending parts
+                upload_key = compose_upload_key(user_id, connection_id)
+                item["UploadKey"] = upload_key
+                table.put_item(Item=item)
+                return {
+                    "statusCode": 200,
+                    "body": json.dumps(
+                        dict(
+                            status="UPLOAD_READY",
+                            upload_url=create_upload_url(upload_key),
+                        )
+                    ),
                 }
-            )
+
+            response = table.put_item(Item=item)
             return {"statusCode": 200, "body": "Session started."}
+        elif step == "STOP":
+            # The generation is cancelled by the invocation processing `END`,
+            # which checks the flag while streaming.
+            mark_session_cancelled(connection_id)
+            return {"statusCode": 200, "body": "Stop requested."}
         elif step == "END":
             # Retrieve user id
             response = table.query(
                 KeyConditionExpression=Key("ConnectionId").eq(connection_id),
                 FilterExpression=Attr("UserId").exists(),
             )
-            user_id = response["Items"][0]["UserId"]
-
-            # Concatenate the message parts
-            message_parts = []
-            last_evaluated_key = None
-
-            while True:
-                if last_evaluated_key:
-                    response = table.query(
-                        KeyConditionExpression=Key("ConnectionId").eq(connection_id)
-                        # Zero is reserved for user id, so start from 1
-                        & Key("MessagePartId").gte(1),
-                        ExclusiveStartKey=last_evaluated_key,
-                    )
-                else:
-                    response = table.query(
-                        KeyConditionExpression=Key("ConnectionId").eq(connection_id)
-                        & Key("MessagePartId").gte(1),
-                    )
-
-                message_parts.extend(response["Items"])
-
-                if "LastEvaluatedKey" in response:
-                    last_evaluated_key = response["LastEvaluatedKey"]
-                else:
-                    break
-
-            logger.info(f"Number of message chunks: {len(message_parts)}")
-            message_parts.sort(key=lambda x: x["MessagePartId"])
-            full_message = "".join(item["MessagePart"] for item in message_parts)
-
-            # Process the concatenated full message
-            chat_input = ChatInput(**json.loads(full_message))
+            session = response["Items"][0]
+            user_id = session["UserId"]
+
+            if "UploadKey" in session:
+                # The full message was uploaded to S3 directly
+                chat_input = ChatInput(**load_uploaded_payload(session["UploadKey"]))
+            else:
+                # Process the concatenated full message
+                full_message = concatenate_message_parts(
+                    connection_id,
+                    decoder=(
+                        PayloadDecoder(
+                            encoding=session["Encoding"],
+                            size=int(session["PayloadSize"]),
+                            checksum=session["PayloadChecksum"],
+                        )
+                        if "Encoding" in session
+                        else None
+                    ),
+                )
+                chat_input = ChatInput(**json.loads(full_message))
             return process_chat_input(
                 user_id=user_id,
                 chat_input=chat_input,
@@ -557,3 +714,8 @@ def handler(event, context):
             Data=json.dumps({"status": "ERROR", "reason": str(e)}).encode("utf-8"),
         )
         return {"statusCode": 500, "body": str(e)}
+    finally:
+        metrics.flush()
+
+
+profiling.report_cold_start("app.websocket")
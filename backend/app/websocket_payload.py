@@ -0,0 +1,123 @@
+"""Transfer of chat payloads which exceed the websocket frame limit (32KB).
+Instead of sending the payload in parts over the websocket, the client can request a
+presigned URL at `START`, upload the payload to S3 once and send `END` afterwards.
+Alternatively, the parts can carry a compressed and base64 encoded payload, whose
+encoding, size and checksum are declared at `START`.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import zlib
+
+import boto3
+from app.utils import LazyClient, generate_presigned_url
+from ulid import ULID
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+LARGE_MESSAGE_BUCKET = os.environ.get("LARGE_MESSAGE_BUCKET", "")
+# Objects under this prefix are expired by the bucket lifecycle rule
+WEBSOCKET_UPLOAD_PREFIX = "_websocket_upload/"
+UPLOAD_URL_EXPIRATION = 5 * 60
+
+s3_client = LazyClient(lambda: boto3.client("s3"))
+
+
+def compose_upload_key(user_id: str, connection_id: str) -> str:
+    return f"{WEBSOCKET_UPLOAD_PREFIX}{user_id}/{connection_id}/{ULID()}.json"
+
+
+def create_upload_url(key: str) -> str:
+    """Return a presigned URL to upload the payload (JSON) to `key`."""
+    return generate_presigned_url(
+        LARGE_MESSAGE_BUCKET,
+        key,
+        content_type="application/json",
+        expiration=UPLOAD_URL_EXPIRATION,
+        client_method="put_object",
+    )
+
+
+def load_uploaded_payload(key: str) -> dict:
+    """Read the uploaded payload and delete the object."""
+    response = s3_client.get_object(Bucket=LARGE_MESSAGE_BUCKET, Key=key)
+    # Parse directly from the response stream
+    payload = json.load(response["Body"])
+    try:
+        s3_client.delete_object(Bucket=LARGE_MESSAGE_BUCKET, Key=key)
+    except Exception as e:
+        # Left for the lifecycle rule
+        logger.warning(f"Failed to delete uploaded payload {key}: {e}")
+    return payload
+
+
+SUPPORTED_ENCODINGS = ["gzip"] + (["zstd"] if zstandard is not None else [])
+
+
+class PayloadIntegrityError(Exception):
+    pass
+
+
+class PayloadDecoder:
+    """Decode a compressed payload part by part.
+    Each part is a slice of the base64 encoded compressed payload. Parts must be fed
+    in order; `finish` verifies the declared size and SHA-256 checksum of the
+    decompressed payload.
+    """
+
+    def __init__(self, encoding: str, size: int, checksum: str):
+        if encoding not in SUPPORTED_ENCODINGS:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+        self.encoding = encoding
+        self.size = size
+        self.checksum = checksum.lower()
+
+        if encoding == "gzip":
+            self._decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()  # type: ignore
+        self._hash = hashlib.sha256()
+        self._chunks: list[bytes] = []
+        self._decompressed_size = 0
+        # Base64 characters which do not form a complete quantum yet
+        self._pending = ""
+
+    def _append(self, data: bytes):
+        self._decompressed_size += len(data)
+        if self._decompressed_size > self.size:
+            # Stop early instead of inflating an unexpectedly large payload
+            raise PayloadIntegrityError("Payload is larger than the declared size.")
+        self._hash.update(data)
+        self._chunks.append(data)
+
+    def update(self, part: str):
+        encoded = self._pending + part
+        complete = len(encoded) - len(encoded) % 4
+        self._pending = encoded[complete:]
+        self._append(
+            self._decompressor.decompress(base64.b64decode(encoded[:complete]))
+        )
+
+    def finish(self) -> str:
+        if self._pending:
+            raise PayloadIntegrityError("Payload is truncated.")
+        if self.encoding == "gzip":
+            self._append(self._decompressor.flush())
+            if not self._decompressor.eof:
+                raise PayloadIntegrityError("Payload is truncated.")
+        if self._decompressed_size != self.size:
+            raise PayloadIntegrityError(
+                f"Payload size mismatch: expected {self.size}, got {self._decompressed_size}."
+            )
+        if self._hash.hexdigest() != self.checksum:
+            raise PayloadIntegrityError("Payload checksum mismatch.")
+        return b"".join(self._chunks).decode("utf-8")
@@ -0,0 +1,234 @@
+"""Helpers to stream the completion to a websocket connection efficiently."""
+
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Callable
+
+from app.config import DEFAULT_STREAMING_CONFIG, StreamingConfig
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def encode_streaming_frame(completion: str) -> bytes:
+    return json.dumps(dict(status="STREAMING", completion=completion)).encode("utf-8")
+
+
+class FrameCoalescer:
+    """Buffer streamed tokens and send them as a single `STREAMING` frame.
+    The first token is sent right away so that the time to first token is not delayed.
+    Later tokens are buffered, and the buffer is flushed when the oldest buffered token
+    has waited `flush_interval_ms` or when the buffered text reaches `max_frame_bytes`.
+    A timer thread flushes the buffer when no more tokens arrive, e.g. while the model
+    pauses. The caller must call `close` at the end of the stream so that no tokens are
+    left behind.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[bytes], None],
+        config: StreamingConfig = DEFAULT_STREAMING_CONFIG,
+        clock: Callable[[], float] = time.monotonic,
+        timer: bool = True,
+    ):
+        self.send = send
+        self.flush_interval = config["flush_interval_ms"] / 1000
+        self.max_frame_bytes = config["max_frame_bytes"]
+        self.clock = clock
+
+        self.tokens_received = 0
+        self.frames_sent = 0
+        self._buffer: list[str] = []
+        self._buffered_bytes = 0
+        self._first_buffered_at = 0.0
+        # Guards the buffer. Frames are sent while holding it to keep them in order.
+        self._cond = threading.Condition()
+        self._use_timer = timer and self.flush_interval > 0
+        self._timer: threading.Thread | None = None
+        self._closed = False
+
+    def add(self, token: str):
+        with self._cond:
+            self.tokens_received += 1
+            metrics.incr("websocket.tokens_received")
+            if not token:
+                return
+
+            token_bytes = len(token.encode("utf-8"))
+            if (
+                self._buffer
+                and self._buffered_bytes + token_bytes > self.max_frame_bytes
+            ):
+                self._flush()
+            if not self._buffer:
+                self._first_buffered_at = self.clock()
+            self._buffer.append(token)
+            self._buffered_bytes += token_bytes
+
+            if (
+                self.frames_sent == 0
+                or self._buffered_bytes >= self.max_frame_bytes
+                or self.clock() - self._first_buffered_at >= self.flush_interval
+            ):
+                self._flush()
+            elif self._use_timer and not self._closed:
+                if self._timer is None:
+                    self._timer = threading.Thread(target=self._run_timer, daemon=True)
+                    self._timer.start()
+                self._cond.notify()
+
+    def _run_timer(self):
+        with self._cond:
+            while not self._closed:
+                if not self._buffer:
+                    self._cond.wait()
+                    continue
+                remaining = self._first_buffered_at + self.flush_interval - self.clock()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                try:
+                    self._flush()
+                except Exception as e:
+                    # Later frames are flushed by `add` and `close`, which raise
+                    logger.warning(f"Failed to flush frame: {e}")
+                    return
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        completion = "".join(self._buffer)
+        self._buffer = []
+        self._buffered_bytes = 0
+        self.frames_sent += 1
+        metrics.incr("websocket.frames_sent")
+        self.send(encode_streaming_frame(completion))
+
+    def flush(self):
+        with self._cond:
+            self._flush()
+
+    def close(self, flush: bool = True):
+        """Stop the timer thread and send the remaining tokens unless `flush` is False."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._timer is not None:
+            self._timer.join()
+        if flush:
+            self.flush()
+
+
+class WebsocketSender:
+    """Post frames to the connection from a dedicated thread.
+    Frames are sent in the order they are posted. The queue is bounded, so `post` blocks
+    when the connection is slower than the producer (backpressure). `close` drains the
+    queue and must be called after the last frame (e.g. `STREAMING_END` or `ERROR`).
+    If sending fails, the error is raised from the next `post` or from `close`.
+    """
+
+    _CLOSE = object()
+
+    def __init__(
+        self,
+        send: Callable[[bytes], None],
+        config: StreamingConfig = DEFAULT_STREAMING_CONFIG,
+    ):
+        self.send = send
+        self._queue: queue.Queue = queue.Queue(maxsize=config["sender_queue_size"])
+        self._thread: threading.Thread | None = None
+        self._error: Exception | None = None
+        self._closed = False
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._CLOSE:
+                return
+            data, posted_at = item
+            if self._error is not None:
+                # Discard the remaining frames once the connection failed
+                continue
+            metrics.timing(
+                "websocket.sender_lag", (time.perf_counter() - posted_at) * 1000
+            )
+            try:
+                with metrics.timer("websocket.post_latency"):
+                    self.send(data)
+            except Exception as e:
+                logger.error(f"Failed to send frame: {e}")
+                self._error = e
+
+    def post(self, data: bytes):
+        if self._closed:
+            raise RuntimeError("Sender is already closed.")
+        if self._error is not None:
+            raise self._error
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        metrics.gauge("websocket.sender_queue_size", self._queue.qsize())
+        self._queue.put((data, time.perf_counter()))
+
+    def close(self, raise_error: bool = True):
+        """Wait until all posted frames are sent and stop the thread."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(self._CLOSE)
+            self._thread.join()
+        if raise_error and self._error is not None:
+            raise self._error
+
+
+class CancellationMonitor:
+    """Track whether the client cancelled the generation.
+    `check` polls `is_cancelled` (e.g. a flag in the session table) at most once per
+    `cancellation_check_interval_ms`. `cancel` is used when the cancellation is
+    detected otherwise, e.g. the connection is gone.
+    """
+
+    def __init__(
+        self,
+        is_cancelled: Callable[[], bool],
+        config: StreamingConfig = DEFAULT_STREAMING_CONFIG,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.is_cancelled = is_cancelled
+        self.interval = config["cancellation_check_interval_ms"] / 1000
+        self.clock = clock
+        self.cancelled = False
+        self.connection_gone = False
+        self._last_checked_at: float | None = None
+
+    def check(self) -> bool:
+        if self.cancelled:
+            return True
+        now = self.clock()
+        if (
+            self._last_checked_at is not None
+            and now - self._last_checked_at < self.interval
+        ):
+            return False
+        self._last_checked_at = now
+        try:
+            if self.is_cancelled():
+                self.cancel()
+        except Exception as e:
+            # Failing to check must not break the stream
+            logger.warning(f"Failed to check cancellation: {e}")
+        return self.cancelled
+
+    def cancel(self, connection_gone: bool = False):
+        if not self.cancelled:
+            metrics.incr(
+                "websocket.cancelled",
+                dimensions={"reason": "gone" if connection_gone else "stop"},
+            )
+        self.cancelled = True
+        self.connection_gone = self.connection_gone or connection_gone
@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+from app.bedrock import COHERE_MAX_TEXTS_PER_REQUEST, invoke_document_embeddings
+from app.metrics import metrics
+from app.resilience import backoff_delay, is_retryable_error, is_throttling_error
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Cohere embed v3 accepts up to 2048 characters per text
+MAX_TEXT_CHARS = 2048
+# Keep the request body well below the invoke_model payload limit
+MAX_BATCH_BYTES = 256 * 1024
+MAX_CONCURRENCY = 8
+MAX_ATTEMPTS = 6
+
+
+class AimdConcurrencyLimiter:
+    """Concurrency limit with additive increase / multiplicative decrease.
+    The limit grows by one for every `limit` successful requests (i.e. once per
+    "window") and halves on throttling.
+    """
+
+    def __init__(self, initial: int = 2, minimum: int = 1, maximum: int = 8):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *args):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(self.minimum, self.limit / 2)
+
+
+def pack_batches(
+    texts: list[str],
+    max_texts: int = COHERE_MAX_TEXTS_PER_REQUEST,
+    max_bytes: int = MAX_BATCH_BYTES,
+) -> list[tuple[int, int]]:
+    """Pack consecutive texts into batches respecting the text count and byte limits.
+    Returns a list of `(start, end)` index ranges so that output order is preserved.
+    """
+    batches: list[tuple[int, int]] = []
+    start = 0
+    size = 0
+    for i, text in enumerate(texts):
+        # Account for JSON quoting and separator
+        text_bytes = len(text.encode("utf-8")) + 4
+        if i > start and (i - start >= max_texts or size + text_bytes > max_bytes):
+            batches.append((start, i))
+            start = i
+            size = 0
+        size += text_bytes
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+class EmbeddingEngine:
+    """Calculate document embeddings with packed batches on a bounded thread pool.
+    Concurrency is controlled by `AimdConcurrencyLimiter`, so the engine slows down
+    when Bedrock throttles and speeds up again while requests succeed.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[list[str]], list[list[float]]] | None = None,
+        max_texts: int = COHERE_MAX_TEXTS_PER_REQUEST,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+        max_concurrency: int = MAX_CONCURRENCY,
+        max_attempts: int = MAX_ATTEMPTS,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        # Retries are handled here so that throttling is visible to the limiter
+        self.embed_fn = embed_fn or (
+            lambda texts: invoke_document_embeddings(texts, max_attempts=1)
+        )
+        self.max_texts = max_texts
+        self.max_batch_bytes = max_batch_bytes
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.sleep = sleep
+        self.limiter = AimdConcurrencyLimiter(
+            initial=min(2, max_concurrency), maximum=max_concurrency
+        )
+
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        for attempt in range(self.max_attempts):
+            with self.limiter:
+                try:
+                    embeddings = self.embed_fn(texts)
+                except Exception as e:
+                    if not is_retryable_error(e) or attempt + 1 >= self.max_attempts:
+                        raise
+                    throttled = is_throttling_error(e)
+                    if throttled:
+                        self.limiter.on_throttle()
+                    error = str(e)
+                else:
+                    self.limiter.on_success()
+                    return embeddings
+            delay = backoff_delay(attempt, 2.0 if throttled else 0.5, 20.0)
+            logger.warning(
+                f"Embedding batch failed: {error}. Retrying in {delay:.2f}s "
+                f"(concurrency limit: {int(self.limiter.limit)})"
+            )
+            self.sleep(delay)
+        raise RuntimeError("Unreachable")
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """Return embeddings as a float32 array of shape `(len(texts), dim)` in input order.
+        Texts longer than `MAX_TEXT_CHARS` are truncated, which is logged and counted as
+        `embedding.truncated_texts`.
+        """
+        truncated = sum(1 for t in texts if len(t) > MAX_TEXT_CHARS)
+        if truncated:
+            logger.warning(
+                f"Truncating {truncated} of {len(texts)} texts to {MAX_TEXT_CHARS} "
+                "characters. Consider a smaller chunk size."
+            )
+            metrics.incr("embedding.truncated_texts", truncated)
+            texts = [t[:MAX_TEXT_CHARS] for t in texts]
+        batches = pack_batches(texts, self.max_texts, self.max_batch_bytes)
+        logger.info(f"Embedding {len(texts)} texts in {len(batches)} batches.")
+        if not batches:
+            return np.empty((0, 0), dtype=np.float32)
+
+        result: np.ndarray | None = None
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [
+                executor.submit(self._embed_batch, texts[start:end])
+                for start, end in batches
+            ]
+            for (start, end), future in zip(batches, futures):
+                embeddings = future.result()
+                if result is None:
+                    result = np.empty(
+                        (len(texts), len(embeddings[0])), dtype=np.float32
+                    )
+                result[start:end] = np.asarray(embeddings, dtype=np.float32)
+
+        assert result is not None
+        return result
@@ -3,12 +3,29 @@ import json
 import logging
 import multiprocessing
 import os
-from multiprocessing.managers import ListProxy
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any
 
+import boto3
+import numpy as np
 import pg8000
 import requests
-from app.config import DEFAULT_EMBEDDING_CONFIG
+from app.config import (
+    DEFAULT_EMBEDDING_CONFIG,
+    DEFAULT_EMBEDDING_PIPELINE_CONFIG,
+    DEFAULT_LOCAL_INDEX_CONFIG,
+    EmbeddingPipelineConfig,
+)
+from app.local_index import delete_snapshots, write_snapshot
+from app.metrics import metrics
+from app.pgvector import (
+    BotItemsStaging,
+    count_bot_items,
+    drop_bot_items,
+    fetch_bot_items,
+    fetch_chunk_embeddings,
+    fetch_source_hashes,
+)
 from app.repositories.common import RecordNotFoundError, _get_table_client
 from app.repositories.custom_bot import (
     compose_bot_id,
@@ -16,13 +33,25 @@ from app.repositories.custom_bot import (
     find_private_bot_by_id,
 )
 from app.routes.schemas.bot import type_sync_status
-from app.utils import compose_upload_document_s3_path
+from app.utils import LazyClient, compose_upload_document_s3_path
 from aws_lambda_powertools.utilities import parameters
 from embedding.loaders import UrlLoader
-from embedding.loaders.base import BaseLoader
+from embedding.engine import EmbeddingEngine
+from embedding.loaders.base import Document
 from embedding.loaders.s3 import S3FileLoader
-from embedding.wrapper import DocumentSplitter, Embedder
+from embedding.pipeline import Pipeline, StageStats, type_emit
+from embedding.sync import (
+    SyncPlan,
+    SyncSummary,
+    compose_source_hash,
+    fingerprint_documents,
+    group_documents_by_source,
+    hash_text,
+    plan_sync,
+)
+from embedding.wrapper import DocumentSplitter
 from llama_index.core.node_parser import SentenceSplitter
+from pydantic import BaseModel
 from retry import retry
 from ulid import ULID
 
@@ -40,6 +69,12 @@ DOCUMENT_BUCKET = os.environ.get("DOCUMENT_BUCKET", "documents")
 
 METADATA_URI = os.environ.get("ECS_CONTAINER_METADATA_URI_V4")
 
+# "incremental" syncs only the changed sources (see `embedding/sync.py`), "full"
+# re-embeds every source
+SYNC_MODE = os.environ.get("SYNC_MODE", "incremental")
+
+s3_client = LazyClient(lambda: boto3.client("s3"))
+
 
 def get_exec_id() -> str:
     # Get task id from ECS metadata
@@ -51,14 +86,11 @@ def get_exec_id() -> str:
     return task_id
 
 
-@retry(tries=RETRIES_TO_INSERT_TO_POSTGRES, delay=RETRY_DELAY_TO_INSERT_TO_POSTGRES)
-def insert_to_postgres(
-    bot_id: str, contents: ListProxy, sources: ListProxy, embeddings: ListProxy
-):
+def connect_postgres() -> pg8000.Connection:
     secrets: Any = parameters.get_secret(DB_SECRETS_ARN)  # type: ignore
     db_info = json.loads(secrets)
 
-    conn = pg8000.connect(
+    return pg8000.connect(
         database=db_info["dbname"],
         host=db_info["host"],
         port=db_info["port"],
@@ -66,27 +98,296 @@ def insert_to_postgres(
         password=db_info["password"],
     )
 
+
+def fetch_stored_source_hashes(bot_id: str) -> dict[str, str]:
+    if SYNC_MODE == "full":
+        # Every source is treated as added
+        return {}
+    conn = connect_postgres()
     try:
-        with conn.cursor() as cursor:
-            delete_query = "DELETE FROM items WHERE botid = %s"
-            cursor.execute(delete_query, (bot_id,))
-
-            insert_query = f"INSERT INTO items (id, botid, content, source, embedding) VALUES (%s, %s, %s, %s, %s)"
-            values_to_insert = []
-            for i, (source, content, embedding) in enumerate(
-                zip(sources, contents, embeddings)
-            ):
-                id_ = str(ULID())
-                logger.info(f"Preview of content {i}: {content[:200]}")
-                values_to_insert.append(
-                    (id_, bot_id, content, source, json.dumps(embedding))
+        return fetch_source_hashes(conn, bot_id)
+    finally:
+        conn.close()
+
+
+def fetch_stored_embeddings(bot_id: str, source: str) -> dict[str, str]:
+    """Stored embeddings of the chunks of a changed source, keyed by chunk hash."""
+    conn = connect_postgres()
+    try:
+        return fetch_chunk_embeddings(conn, bot_id, [source]).get(source, {})
+    finally:
+        conn.close()
+
+
+class Chunk(BaseModel):
+    source: str
+    content: str
+    chunk_hash: str
+    # Stored embedding (vector text) reused for an unchanged chunk
+    embedding: str | None = None
+
+
+def load_file(key: str, enable_partition_pdf: bool) -> list[Document]:
+    # Runs in a worker process, since parsing files is CPU bound
+    return S3FileLoader(
+        bucket=DOCUMENT_BUCKET, key=key, enable_partition_pdf=enable_partition_pdf
+    ).load()
+
+
+def load_url(url: str) -> list[Document]:
+    # Runs in a worker process too, which isolates the browser of each page
+    return UrlLoader([url]).load()
+
+
+def split(
+    documents: list[Document], chunk_size: int, chunk_overlap: int
+) -> list[Document]:
+    splitter = DocumentSplitter(
+        splitter=SentenceSplitter(
+            paragraph_separator=r"\n\n\n",
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            # Use length of text as token count for cohere-multilingual-v3
+            tokenizer=lambda text: [0] * len(text),
+        )
+    )
+    return splitter.split_documents(documents)
+
+
+def embed(
+    engine: EmbeddingEngine,
+    bot_id: str,
+    chunks: list[Chunk],
+    source_hashes: dict[str, str],
+) -> list[tuple]:
+    """Embed the chunks without a stored embedding, and return the rows of all
+    `chunks` as values of `app.pgvector.COLUMNS`. New embeddings are float32 arrays,
+    which are written to pgvector in binary.
+    """
+    missing = [c for c in chunks if c.embedding is None]
+    new_embeddings = iter(engine.embed([c.content for c in missing]) if missing else [])
+    return [
+        (
+            str(ULID()),
+            bot_id,
+            chunk.content,
+            chunk.source,
+            (chunk.embedding if chunk.embedding is not None else next(new_embeddings)),
+            source_hashes[chunk.source],
+            chunk.chunk_hash,
+        )
+        for chunk in chunks
+    ]
+
+
+class SyncWriter:
+    """Last stage of the pipeline: copies the rows in batches of `batch_size` to the
+    staging table of the bot. A failed batch is retried on a new connection.
+    """
+
+    def __init__(self, bot_id: str, batch_size: int):
+        self.staging = BotItemsStaging(None, bot_id)
+        self.batch_size = batch_size
+        self.buffer: list[tuple] = []
+        self.chunks_embedded = 0
+        self.chunks_reused = 0
+
+    def _close(self):
+        if self.staging.conn is not None:
+            try:
+                self.staging.conn.close()
+            except Exception:
+                pass
+            self.staging.conn = None
+
+    @retry(tries=RETRIES_TO_INSERT_TO_POSTGRES, delay=RETRY_DELAY_TO_INSERT_TO_POSTGRES)
+    def _run(self, operation: str, *args) -> Any:
+        if self.staging.conn is None:
+            self.staging.conn = connect_postgres()
+        try:
+            return getattr(self.staging, operation)(*args)
+        except Exception:
+            self._close()
+            raise
+
+    def create(self):
+        self._run("create")
+
+    def write(self, item: tuple[list[tuple], int], emit: type_emit):
+        rows, embedded = item
+        self.chunks_embedded += embedded
+        self.chunks_reused += len(rows) - embedded
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_size:
+            self.flush(emit)
+
+    def flush(self, emit: type_emit):
+        if self.buffer:
+            self._run("write", self.buffer)
+            self.buffer = []
+
+    def apply(self, plan: SyncPlan) -> int:
+        """Apply the staged rows. Returns the number of deleted rows."""
+        try:
+            if plan.unchanged:
+                # Only the rows of the changed and removed sources are replaced
+                return self._run("merge", plan.to_delete)
+            # Nothing is kept, so swap in a new partition instead of deleting and
+            # reinserting the rows of the bot
+            deleted = count_chunks(self.staging.bot_id)
+            self._run("replace")
+            return deleted
+        finally:
+            self._close()
+
+    def discard(self):
+        try:
+            self._run("drop")
+        except Exception as e:
+            logger.warning(f"Failed to drop the staging table: {e}")
+        finally:
+            self._close()
+
+
+def run_pipeline(
+    bot_id: str,
+    sources: list[str],
+    file_keys: dict[str, str],
+    source_hashes: dict[str, str],
+    stored_hashes: dict[str, str],
+    chunk_size: int,
+    chunk_overlap: int,
+    enable_partition_pdf: bool,
+    config: EmbeddingPipelineConfig = DEFAULT_EMBEDDING_PIPELINE_CONFIG,
+) -> tuple[SyncWriter, list[StageStats]]:
+    """Load, split and embed `sources` (files and URLs), and stage their rows.
+    Stages are connected by bounded queues, so only a few documents and batches of
+    chunks are in memory at a time:
+        load (processes) -> split -> embed (Bedrock) -> write (staging table)
+    Files are passed only if added or changed. URLs are hashed once loaded: their hash
+    is added to `source_hashes`, and unchanged URLs go no further.
+    The stored embeddings of a changed source are fetched when it is split.
+    """
+    engine = EmbeddingEngine()
+    writer = SyncWriter(bot_id, config["write_batch_size"])
+    writer.create()
+
+    loader_workers = config["loader_workers"] or os.cpu_count() or 1
+    # Workers are spawned rather than forked, since the pipeline threads are running
+    with ProcessPoolExecutor(
+        max_workers=loader_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+
+        def load(source: str, emit: type_emit):
+            if source in file_keys:
+                key = file_keys[source]
+                emit(
+                    (
+                        source,
+                        executor.submit(load_file, key, enable_partition_pdf).result(),
+                    )
                 )
-            cursor.executemany(insert_query, values_to_insert)
-        conn.commit()
-        logger.info(f"Successfully inserted {len(values_to_insert)} records.")
+                return
+
+            # Grouped by the source of the stored rows, e.g. a YouTube URL by its id
+            groups = group_documents_by_source(
+                executor.submit(load_url, source).result()
+            )
+            for url_source, url_documents in groups.items():
+                source_hash = compose_source_hash(
+                    fingerprint_documents(url_documents),
+                    chunk_size,
+                    chunk_overlap,
+                    enable_partition_pdf,
+                )
+                source_hashes[url_source] = source_hash
+                if stored_hashes.get(url_source) != source_hash:
+                    emit((url_source, url_documents))
+
+        def split_documents(item: tuple[str, list[Document]], emit: type_emit):
+            source, documents = item
+            stored = (
+                fetch_stored_embeddings(bot_id, source)
+                if source in stored_hashes
+                else {}
+            )
+            batch: list[Chunk] = []
+            for document in split(documents, chunk_size, chunk_overlap):
+                chunk_hash = hash_text(document.page_content)
+                batch.append(
+                    Chunk(
+                        source=source,
+                        content=document.page_content,
+                        chunk_hash=chunk_hash,
+                        embedding=stored.get(chunk_hash),
+                    )
+                )
+                if len(batch) >= config["embedding_batch_size"]:
+                    emit(batch)
+                    batch = []
+            if batch:
+                emit(batch)
+
+        def embed_chunks(chunks: list[Chunk], emit: type_emit):
+            rows = embed(engine, bot_id, chunks, source_hashes)
+            emit((rows, sum(c.embedding is None for c in chunks)))
+
+        pipeline = (
+            Pipeline(config["queue_size"])
+            .add_stage("load", load, workers=loader_workers)
+            .add_stage("split", split_documents, workers=config["splitter_workers"])
+            .add_stage("embed", embed_chunks, workers=config["embedding_workers"])
+            .add_stage("write", writer.write, finish=writer.flush)
+        )
+        try:
+            stats = pipeline.run(sources)
+        except Exception:
+            writer.discard()
+            raise
+    return writer, stats
+
+
+def write_local_index(user_id: str, bot_id: str, exec_id: str, total_chunks: int):
+    """Write the local index snapshot of small bots. Larger bots are searched on
+    pgvector only, so their previous snapshots are removed.
+    The snapshot covers the unchanged chunks too, so it is read back from pgvector.
+    The snapshot is an optimization: on failure, chat falls back to pgvector.
+    """
+    try:
+        if 0 < total_chunks <= DEFAULT_LOCAL_INDEX_CONFIG["max_chunks"]:
+            conn = connect_postgres()
+            try:
+                items = fetch_bot_items(conn, bot_id)
+            finally:
+                conn.close()
+            write_snapshot(
+                DOCUMENT_BUCKET,
+                user_id,
+                bot_id,
+                exec_id,
+                np.asarray([json.loads(e) for _, _, e in items], dtype=np.float32),
+                [(content, source) for content, source, _ in items],
+            )
+            logger.info(f"Wrote local index snapshot of {len(items)} chunks.")
+        else:
+            delete_snapshots(DOCUMENT_BUCKET, user_id, bot_id)
     except Exception as e:
-        conn.rollback()
-        raise e
+        logger.error(f"[ERROR] Failed to write local index snapshot: {e}")
+
+
+@retry(tries=RETRIES_TO_INSERT_TO_POSTGRES, delay=RETRY_DELAY_TO_INSERT_TO_POSTGRES)
+def remove_from_postgres(bot_id: str):
+    conn = connect_postgres()
+    try:
+        drop_bot_items(conn, bot_id)
+    finally:
+        conn.close()
+
+
+def count_chunks(bot_id: str) -> int:
+    conn = connect_postgres()
+    try:
+        return count_bot_items(conn, bot_id)
     finally:
         conn.close()
 
@@ -99,44 +400,23 @@ def update_sync_status(
     sync_status_reason: str,
     last_exec_id: str,
 ):
+    update_expression = "SET SyncStatus = :sync_status, SyncStatusReason = :sync_status_reason, LastExecId = :last_exec_id"
+    expression_attribute_values = {
+        ":sync_status": sync_status,
+        ":sync_status_reason": sync_status_reason,
+        ":last_exec_id": last_exec_id,
+    }
+    if sync_status == "SUCCEEDED":
+        # Invalidates the cached retrieval results of the bot
+        update_expression += " ADD KnowledgeVersion :one"
+        expression_attribute_values[":one"] = 1
+
     table = _get_table_client(user_id)
     table.update_item(
         Key={"PK": user_id, "SK": compose_bot_id(user_id, bot_id)},
-        UpdateExpression="SET SyncStatus = :sync_status, SyncStatusReason = :sync_status_reason, LastExecId = :last_exec_id",
-        ExpressionAttributeValues={
-            ":sync_status": sync_status,
-            ":sync_status_reason": sync_status_reason,
-            ":last_exec_id": last_exec_id,
-        },
-    )
-
-
-def embed(
-    loader: BaseLoader,
-    contents: ListProxy,
-    sources: ListProxy,
-    embeddings: ListProxy,
-    chunk_size: int,
-    chunk_overlap: int,
-):
-    splitter = DocumentSplitter(
-        splitter=SentenceSplitter(
-            paragraph_separator=r"\n\n\n",
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            # Use length of text as token count for cohere-multilingual-v3
-            tokenizer=lambda text: [0] * len(text),
-        )
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_attribute_values,
     )
-    embedder = Embedder(verbose=True)
-
-    documents = loader.load()
-    splitted = splitter.split_documents(documents)
-    splitted_embeddings = embedder.embed_documents(splitted)
-
-    contents.extend([t.page_content for t in splitted])
-    sources.extend([t.metadata["source"] for t in splitted])
-    embeddings.extend(splitted_embeddings)
 
 
 def main(
@@ -168,6 +448,9 @@ def main(
     try:
         if len(sitemap_urls) + len(source_urls) + len(filenames) == 0:
             logger.info("No contents to embed. Skipping.")
+            # Chunks of the removed sources, if any
+            remove_from_postgres(bot_id)
+            write_local_index(user_id, bot_id, exec_id, 0)
             status_reason = "No contents to embed."
             update_sync_status(
                 user_id,
@@ -178,54 +461,66 @@ def main(
             )
             return
 
-        # Calculate embeddings using LangChain
-        with multiprocessing.Manager() as manager:
-            contents: ListProxy = manager.list()
-            sources: ListProxy = manager.list()
-            embeddings: ListProxy = manager.list()
-
-            if len(source_urls) > 0:
-                embed(
-                    UrlLoader(source_urls),
-                    contents,
-                    sources,
-                    embeddings,
-                    chunk_size,
-                    chunk_overlap,
+        if len(sitemap_urls) > 0:
+            for sitemap_url in sitemap_urls:
+                raise NotImplementedError()
+
+        # Files are hashed by their ETag, URLs once loaded by the pipeline
+        file_keys = {
+            f"s3://{DOCUMENT_BUCKET}/{key}": key
+            for key in (
+                compose_upload_document_s3_path(user_id, bot_id, filename)
+                for filename in filenames
+            )
+        }
+        source_hashes = {
+            source: compose_source_hash(
+                s3_client.head_object(Bucket=DOCUMENT_BUCKET, Key=key)["ETag"],
+                chunk_size,
+                chunk_overlap,
+                enable_partition_pdf,
+            )
+            for source, key in file_keys.items()
+        }
+        stored_hashes = fetch_stored_source_hashes(bot_id)
+        sources = [
+            source
+            for source in file_keys
+            if stored_hashes.get(source) != source_hashes[source]
+        ] + source_urls
+
+        summary = SyncSummary(plan=plan_sync(source_hashes, stored_hashes))
+        if sources or summary.plan.removed:
+            writer, stats = run_pipeline(
+                bot_id,
+                sources,
+                file_keys,
+                source_hashes,
+                stored_hashes,
+                chunk_size,
+                chunk_overlap,
+                enable_partition_pdf,
+            )
+            for stage in stats:
+                logger.info(f"Stage {stage}")
+                metrics.gauge(
+                    "embedding.throughput", stage.throughput, {"stage": stage.name}
                 )
-            if len(sitemap_urls) > 0:
-                for sitemap_url in sitemap_urls:
-                    raise NotImplementedError()
-            if len(filenames) > 0:
-                with multiprocessing.Pool(processes=None) as pool:
-                    futures = [
-                        pool.apply_async(
-                            embed,
-                            args=(
-                                S3FileLoader(
-                                    bucket=DOCUMENT_BUCKET,
-                                    key=compose_upload_document_s3_path(
-                                        user_id, bot_id, filename
-                                    ),
-                                    enable_partition_pdf=enable_partition_pdf,
-                                ),
-                                contents,
-                                sources,
-                                embeddings,
-                                chunk_size,
-                                chunk_overlap,
-                            ),
-                        )
-                        for filename in filenames
-                    ]
-                    for future in futures:
-                        future.get()
-
-            logger.info(f"Number of chunks: {len(contents)}")
-
-            # Insert records into postgres
-            insert_to_postgres(bot_id, contents, sources, embeddings)
-            status_reason = "Successfully inserted to vector store."
+            metrics.flush()
+            # Complete with the hashes of the loaded URLs
+            summary.plan = plan_sync(source_hashes, stored_hashes)
+            summary.chunks_embedded = writer.chunks_embedded
+            summary.chunks_reused = writer.chunks_reused
+            if summary.plan.to_embed or summary.plan.to_delete:
+                summary.chunks_deleted = writer.apply(summary.plan)
+            else:
+                writer.discard()
+        logger.info(f"Sync plan ({SYNC_MODE}): {summary.plan}")
+        summary.chunks_total = count_chunks(bot_id)
+        logger.info(f"Sync summary: {summary}")
+
+        write_local_index(user_id, bot_id, exec_id, summary.chunks_total)
+        status_reason = f"Successfully synced to vector store. {summary}"
     except Exception as e:
         logger.error("[ERROR] Failed to embed.")
         logger.error(e)
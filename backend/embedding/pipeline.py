@@ -0,0 +1,179 @@
+"""Streaming pipeline of worker threads connected by bounded queues.
+Each stage takes the items of its input queue and emits any number of items to the
+next stage. Queues are bounded, so a slow stage blocks the stages before it instead of
+letting items pile up: memory stays flat regardless of the number of items.
+The first error of any worker stops the pipeline and is raised by `run`.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Seconds between checks of the stop flag by blocked workers
+POLL_INTERVAL = 0.1
+
+type_emit = Callable[[Any], None]
+
+
+class _Stop:
+    """Marks the end of the items of a queue."""
+
+
+STOP = _Stop()
+
+
+class StageStats(BaseModel):
+    name: str
+    items_in: int = 0
+    items_out: int = 0
+    # Total time spent by the workers processing items, and wall time of the stage
+    busy_seconds: float = 0.0
+    elapsed_seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Input items per second of wall time."""
+        return self.items_in / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.items_in} in, {self.items_out} out, "
+            f"{self.throughput:.2f}/s over {self.elapsed_seconds:.1f}s "
+            f"({self.busy_seconds:.1f}s busy)"
+        )
+
+
+class _Stage:
+    def __init__(
+        self,
+        name: str,
+        process: Callable[[Any, type_emit], None],
+        workers: int,
+        finish: Callable[[type_emit], None] | None,
+    ):
+        self.name = name
+        self.process = process
+        self.workers = workers
+        self.finish = finish
+        self.stats = StageStats(name=name)
+        self.running = workers
+        self.lock = threading.Lock()
+
+
+class Pipeline:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.stages: list[_Stage] = []
+        self._stopped = threading.Event()
+        self._error: BaseException | None = None
+        self._start = 0.0
+
+    def add_stage(
+        self,
+        name: str,
+        process: Callable[[Any, type_emit], None],
+        workers: int = 1,
+        finish: Callable[[type_emit], None] | None = None,
+    ) -> "Pipeline":
+        """Add a stage. `process(item, emit)` is called for each input item, and
+        `finish(emit)` once all items were processed (e.g. to flush a batch).
+        Items emitted by the last stage are discarded.
+        """
+        self.stages.append(_Stage(name, process, max(1, workers), finish))
+        return self
+
+    def _put(self, q: queue.Queue | None, item: Any):
+        if q is None:
+            return
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stopped.is_set():
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return STOP
+
+    def _fail(self, e: BaseException):
+        if not self._stopped.is_set():
+            self._error = e
+            self._stopped.set()
+
+    def _work(self, stage: _Stage, inbox: queue.Queue, outbox: queue.Queue | None):
+        def emit(item: Any):
+            with stage.lock:
+                stage.stats.items_out += 1
+            self._put(outbox, item)
+
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is STOP:
+                    # Let the other workers of the stage see it too
+                    self._put(inbox, STOP)
+                    break
+                start = time.perf_counter()
+                stage.process(item, emit)
+                with stage.lock:
+                    stage.stats.items_in += 1
+                    stage.stats.busy_seconds += time.perf_counter() - start
+            with stage.lock:
+                stage.running -= 1
+                last = stage.running == 0
+            if last and not self._stopped.is_set():
+                if stage.finish:
+                    stage.finish(emit)
+                stage.stats.elapsed_seconds = time.perf_counter() - self._start
+                self._put(outbox, STOP)
+        except BaseException as e:
+            logger.error(f"Stage {stage.name} failed: {e}")
+            self._fail(e)
+
+    def run(self, items: Iterable[Any]) -> list[StageStats]:
+        """Feed `items` to the first stage and wait until every stage finished.
+        Returns the statistics of each stage.
+        """
+        queues: list[queue.Queue] = [
+            queue.Queue(maxsize=self.queue_size) for _ in self.stages
+        ]
+        self._start = time.perf_counter()
+        threads: list[threading.Thread] = []
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], outbox),
+                    name=f"{stage.name}-{n}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                if self._stopped.is_set():
+                    break
+                self._put(queues[0], item)
+            self._put(queues[0], STOP)
+        except BaseException as e:
+            self._fail(e)
+
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        return [stage.stats for stage in self.stages]
@@ -0,0 +1,93 @@
+"""Incremental sync of the knowledge of a bot.
+Every row of `items` records the hash of its source (`source_hash`) and of its own
+content (`chunk_hash`). A sync compares the hashes of the current sources with the
+stored ones: only added and changed sources are split and embedded, the rows of changed
+and removed sources are deleted, and the rows of unchanged sources are kept as they are.
+Chunks of a changed source whose content did not change reuse their stored embedding.
+The hash of a source covers the splitting parameters, so changing them re-embeds all
+sources.
+"""
+
+import hashlib
+import json
+from typing import TYPE_CHECKING
+
+from pydantic import BaseModel
+
+if TYPE_CHECKING:
+    # Importing the loaders requires their dependencies (e.g. unstructured)
+    from embedding.loaders.base import Document
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compose_source_hash(
+    fingerprint: str, chunk_size: int, chunk_overlap: int, enable_partition_pdf: bool
+) -> str:
+    """Hash of a source. `fingerprint` identifies its content, e.g. the ETag of an S3
+    object or the hash of the loaded text of a URL.
+    """
+    return hash_text(
+        json.dumps(
+            [fingerprint, chunk_size, chunk_overlap, enable_partition_pdf],
+            separators=(",", ":"),
+        )
+    )
+
+
+def fingerprint_documents(documents: list["Document"]) -> str:
+    return hash_text("\n\n".join(d.page_content for d in documents))
+
+
+def group_documents_by_source(
+    documents: list["Document"],
+) -> dict[str, list["Document"]]:
+    groups: dict[str, list["Document"]] = {}
+    for document in documents:
+        groups.setdefault(document.metadata["source"], []).append(document)
+    return groups
+
+
+class SyncPlan(BaseModel):
+    added: list[str]
+    changed: list[str]
+    removed: list[str]
+    unchanged: list[str]
+
+    @property
+    def to_embed(self) -> list[str]:
+        return self.added + self.changed
+
+    @property
+    def to_delete(self) -> list[str]:
+        return self.changed + self.removed
+
+
+def plan_sync(current: dict[str, str], stored: dict[str, str]) -> SyncPlan:
+    """Compare the hashes of the current sources with the stored ones (both keyed by
+    source).
+    """
+    return SyncPlan(
+        added=sorted(s for s in current if s not in stored),
+        changed=sorted(s for s in current if s in stored and stored[s] != current[s]),
+        removed=sorted(s for s in stored if s not in current),
+        unchanged=sorted(s for s in current if stored.get(s) == current[s]),
+    )
+
+
+class SyncSummary(BaseModel):
+    plan: SyncPlan
+    chunks_embedded: int = 0
+    chunks_reused: int = 0
+    chunks_deleted: int = 0
+    chunks_total: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"Sources: {len(self.plan.added)} added, {len(self.plan.changed)} changed, "
+            f"{len(self.plan.removed)} removed, {len(self.plan.unchanged)} unchanged. "
+            f"Chunks: {self.chunks_embedded} embedded, {self.chunks_reused} reused, "
+            f"{self.chunks_deleted} deleted, {self.chunks_total} total."
+        )
@@ -1,6 +1,7 @@
 import logging
 
-from app.bedrock import calculate_document_embeddings
+import numpy as np
+from embedding.engine import EmbeddingEngine
 from embedding.loaders.base import BaseLoader, Document
 from llama_index.core.node_parser import TextSplitter
 
@@ -25,8 +26,9 @@ class DocumentSplitter:
 class Embedder:
     """Thin wrapper class to calculate embeddings by Bedrock API."""
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, engine: EmbeddingEngine | None = None):
         self.verbose = verbose
+        self.engine = engine or EmbeddingEngine()
 
     def print_documents_summary(self, documents: list[Document]):
         for i, d in enumerate(documents):
@@ -34,11 +36,12 @@ class Embedder:
             logger.info(f"{i}th document content length: {len(d.page_content)}")
             logger.info(f"{i}th document head of content: {d.page_content[:30]}")
 
-    def embed_documents(self, documents: list[Document]) -> list[list[float]]:
+    def embed_documents(self, documents: list[Document]) -> np.ndarray:
+        """Return embeddings as a float32 array of shape `(len(documents), dim)`."""
         if self.verbose:
             logger.info(f"Embedding {len(documents)} documents.")
             self.print_documents_summary(documents)
-        embeddings = calculate_document_embeddings([d.page_content for d in documents])
+        embeddings = self.engine.embed([d.page_content for d in documents])
         if self.verbose:
             logger.info("Done embedding.")
         return embeddings
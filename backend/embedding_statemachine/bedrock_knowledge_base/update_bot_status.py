@@ -29,15 +29,22 @@ def update_sync_status(
     sync_status_reason: str,
     last_exec_id: str,
 ):
+    update_expression = "SET SyncStatus = :sync_status, SyncStatusReason = :sync_status_reason, LastExecId = :last_exec_id"
+    expression_attribute_values = {
+        ":sync_status": sync_status,
+        ":sync_status_reason": sync_status_reason,
+        ":last_exec_id": last_exec_id,
+    }
+    if sync_status == "SUCCEEDED":
+        # Invalidates the cached retrieval results of the bot
+        update_expression += " ADD KnowledgeVersion :one"
+        expression_attribute_values[":one"] = 1
+
     table = _get_table_client(user_id)
     table.update_item(
         Key={"PK": user_id, "SK": compose_bot_id(user_id, bot_id)},
-        UpdateExpression="SET SyncStatus = :sync_status, SyncStatusReason = :sync_status_reason, LastExecId = :last_exec_id",
-        ExpressionAttributeValues={
-            ":sync_status": sync_status,
-            ":sync_status_reason": sync_status_reason,
-            ":last_exec_id": last_exec_id,
-        },
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_attribute_values,
     )
 
 
@@ -0,0 +1,80 @@
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.auth import JwksCache, VerifiedTokenCache
+from jose.exceptions import JWTError
+from tests.utils.clock import FakeClock
+
+
+class TestJwksCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock(1000.0)
+        self.fetch_count = 0
+        self.keys = [{"kid": "key-1", "kty": "RSA"}]
+
+    def fetch(self) -> list[dict]:
+        self.fetch_count += 1
+        return list(self.keys)
+
+    def create_cache(self) -> JwksCache:
+        return JwksCache(
+            fetch=self.fetch, ttl=3600, min_refresh_interval=30, clock=self.clock
+        )
+
+    def test_cached_until_ttl(self):
+        cache = self.create_cache()
+        self.assertEqual(cache.get_key("key-1")["kid"], "key-1")
+        cache.get_key("key-1")
+        self.assertEqual(self.fetch_count, 1)
+        self.clock.now += 3600
+        cache.get_key("key-1")
+        self.assertEqual(self.fetch_count, 2)
+
+    def test_refresh_on_unknown_kid(self):
+        cache = self.create_cache()
+        cache.get_key("key-1")
+        # Keys are rotated
+        self.keys.append({"kid": "key-2", "kty": "RSA"})
+        self.clock.now += 60
+        self.assertEqual(cache.get_key("key-2")["kid"], "key-2")
+        self.assertEqual(self.fetch_count, 2)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        cache = self.create_cache()
+        cache.get_key("key-1")
+        self.clock.now += 60
+        with self.assertRaises(JWTError):
+            cache.get_key("unknown")
+        with self.assertRaises(JWTError):
+            cache.get_key("unknown")
+        self.assertEqual(self.fetch_count, 2)
+
+
+class TestVerifiedTokenCache(unittest.TestCase):
+    def test_valid_until_exp(self):
+        clock = FakeClock(1000.0)
+        cache = VerifiedTokenCache(max_entries=10, clock=clock)
+        cache.put("token", {"sub": "user", "exp": 1100})
+        self.assertEqual(cache.get("token"), {"sub": "user", "exp": 1100})
+        self.assertIsNone(cache.get("other"))
+        clock.now = 1100
+        self.assertIsNone(cache.get("token"))
+
+    def test_bounded(self):
+        cache = VerifiedTokenCache(max_entries=2, clock=FakeClock(1000.0))
+        for token in ["a", "b", "c"]:
+            cache.put(token, {"sub": token, "exp": 2000})
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+    def test_returns_copy(self):
+        cache = VerifiedTokenCache(clock=FakeClock(1000.0))
+        cache.put("token", {"sub": "user", "exp": 2000})
+        cache.get("token")["sub"] = "modified"  # type: ignore
+        self.assertEqual(cache.get("token")["sub"], "user")  # type: ignore
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,12 +6,19 @@ import unittest
 from pprint import pprint
 
 from app.bedrock import (
+    BEDROCK_PRICING,
+    BedrockRouter,
+    RouteTarget,
+    calculate_price,
     calculate_query_embedding,
     call_converse_api,
     compose_args_for_converse_api,
 )
 from app.repositories.models.conversation import ContentModel, MessageModel
+from app.resilience import reset_resilience_state
 from app.routes.schemas.conversation import type_model_name
+from botocore.exceptions import ClientError
+from tests.utils.clock import FakeClock
 
 MODEL: type_model_name = "claude-v3-haiku"
 
@@ -58,5 +65,167 @@ class TestCallConverseApi(unittest.TestCase):
         pprint(response)
 
 
+class StubBedrockClient:
+    """Stub for a regional bedrock-runtime endpoint."""
+
+    def __init__(
+        self, region: str, error_code: str | None = None, status_code: int = 429
+    ):
+        self.region = region
+        self.error_code = error_code
+        self.status_code = status_code
+        self.calls = 0
+
+    def converse(self, **kwargs):
+        self.calls += 1
+        if self.error_code:
+            raise ClientError(
+                {
+                    "Error": {"Code": self.error_code, "Message": "stub"},
+                    "ResponseMetadata": {"HTTPStatusCode": self.status_code},
+                },
+                "Converse",
+            )
+        return {"modelId": kwargs["modelId"], "region": self.region}
+
+
+class TestBedrockRouter(unittest.TestCase):
+    def setUp(self) -> None:
+        reset_resilience_state()
+        self.clock = FakeClock(1000.0)
+
+    def _router(self, clients: dict[str, StubBedrockClient]) -> BedrockRouter:
+        return BedrockRouter(
+            routes={
+                MODEL: [
+                    RouteTarget("ap-southeast-2", "model-id"),
+                    RouteTarget("us-west-2", "model-id"),
+                ]
+            },
+            client_factory=lambda target: clients[target.region],
+            clock=self.clock,
+        )
+
+    def _invoke(self, router: BedrockRouter):
+        return router.invoke(
+            MODEL, lambda client, target: client.converse(modelId=target.model_id)
+        )
+
+    def test_failover_on_throttling(self):
+        clients = {
+            "ap-southeast-2": StubBedrockClient(
+                "ap-southeast-2", error_code="ThrottlingException"
+            ),
+            "us-west-2": StubBedrockClient("us-west-2"),
+        }
+        router = self._router(clients)
+        response, target = router.invoke(
+            MODEL, lambda client, target: client.converse(modelId=target.model_id)
+        )
+        self.assertEqual(target.region, "us-west-2")
+        self.assertEqual(response["region"], "us-west-2")
+        # The primary target is only tried once before failing over
+        self.assertEqual(clients["ap-southeast-2"].calls, 1)
+
+        # The throttled target is deprioritized afterwards
+        ordered = router.ordered_targets(MODEL)
+        self.assertEqual(ordered[0].region, "us-west-2")
+
+    def test_throttled_target_recovers(self):
+        clients = {
+            "ap-southeast-2": StubBedrockClient(
+                "ap-southeast-2", error_code="ThrottlingException"
+            ),
+            "us-west-2": StubBedrockClient("us-west-2"),
+        }
+        router = self._router(clients)
+        self._invoke(router)
+        clients["ap-southeast-2"].error_code = None
+
+        # Within the probe interval, traffic stays on the fallback
+        self.clock.now += router.PROBE_INTERVAL_SECONDS / 2
+        _, target = self._invoke(router)
+        self.assertEqual(target.region, "us-west-2")
+
+        # A probe reaches the primary, which is preferred again once it succeeds
+        self.clock.now += router.PROBE_INTERVAL_SECONDS
+        _, target = self._invoke(router)
+        self.assertEqual(target.region, "ap-southeast-2")
+        self.assertEqual(target.throttled_until, 0.0)
+        for target in router.routes[MODEL]:
+            target.latency_ms = 100.0
+        self.assertEqual(router.ordered_targets(MODEL)[0].region, "ap-southeast-2")
+
+    def test_throttling_expires(self):
+        clients = {
+            "ap-southeast-2": StubBedrockClient(
+                "ap-southeast-2", error_code="ThrottlingException"
+            ),
+            "us-west-2": StubBedrockClient("us-west-2"),
+        }
+        router = self._router(clients)
+        self._invoke(router)
+        self.assertEqual(router.ordered_targets(MODEL)[0].region, "us-west-2")
+        # Only one probe per interval
+        self.clock.now += router.PROBE_INTERVAL_SECONDS
+        self.assertEqual(router.ordered_targets(MODEL)[0].region, "ap-southeast-2")
+        self.assertEqual(router.ordered_targets(MODEL)[0].region, "us-west-2")
+
+        self.clock.now += router.THROTTLE_COOLDOWN_SECONDS
+        self.assertEqual(router.ordered_targets(MODEL)[0].region, "ap-southeast-2")
+        self.assertEqual(router.ordered_targets(MODEL)[0].region, "ap-southeast-2")
+
+    def test_prefers_primary_without_observations(self):
+        clients = {
+            "ap-southeast-2": StubBedrockClient("ap-southeast-2"),
+            "us-west-2": StubBedrockClient("us-west-2"),
+        }
+        router = self._router(clients)
+        _, target = router.invoke(
+            MODEL, lambda client, target: client.converse(modelId=target.model_id)
+        )
+        self.assertEqual(target.region, "ap-southeast-2")
+        self.assertEqual(clients["us-west-2"].calls, 0)
+
+    def test_no_failover_on_client_error(self):
+        clients = {
+            "ap-southeast-2": StubBedrockClient(
+                "ap-southeast-2", error_code="ValidationException", status_code=400
+            ),
+            "us-west-2": StubBedrockClient("us-west-2"),
+        }
+        router = self._router(clients)
+        with self.assertRaises(ClientError):
+            router.invoke(
+                MODEL,
+                lambda client, target: client.converse(modelId=target.model_id),
+            )
+        self.assertEqual(clients["us-west-2"].calls, 0)
+
+
+class TestCalculatePrice(unittest.TestCase):
+    def setUp(self) -> None:
+        BEDROCK_PRICING["test-region"] = {
+            "claude-v3-haiku": {"input": 0.00050, "output": 0.00250}
+        }
+
+    def tearDown(self) -> None:
+        del BEDROCK_PRICING["test-region"]
+
+    def test_price_follows_region(self):
+        self.assertEqual(
+            calculate_price(MODEL, 1000, 1000, region="ap-southeast-2"), 0.0015
+        )
+        self.assertEqual(
+            calculate_price(MODEL, 1000, 1000, region="test-region"), 0.003
+        )
+
+    def test_unknown_region_uses_default(self):
+        self.assertEqual(
+            calculate_price(MODEL, 1000, 1000, region="eu-west-3"),
+            calculate_price(MODEL, 1000, 1000, region="default"),
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,106 @@
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.context_selection import estimate_tokens, select_context
+from app.vector_search import SearchResult
+
+CONFIG = {
+    "max_context_tokens": 10000,
+    "duplicate_threshold": 0.8,
+    "mmr_lambda": 0.7,
+    "min_score": None,
+}
+
+PARAGRAPHS = [
+    "Amazon S3 stores objects in buckets and offers eleven nines of durability.",
+    "Lambda functions scale automatically with the number of incoming requests.",
+    "DynamoDB tables are partitioned by the hash of their partition key.",
+    "CloudFront caches content at edge locations close to the viewers.",
+]
+
+
+def create_results(
+    contents: list[str], scores: list[float] | None = None
+) -> list[SearchResult]:
+    return [
+        SearchResult(
+            bot_id="bot",
+            content=content,
+            source=f"source_{i}",
+            rank=i,
+            score=scores[i] if scores else None,
+        )
+        for i, content in enumerate(contents)
+    ]
+
+
+class TestSelectContext(unittest.TestCase):
+    def test_drops_duplicates(self):
+        results = create_results(
+            [
+                PARAGRAPHS[0] + " " + PARAGRAPHS[1],
+                PARAGRAPHS[2],
+                # Contained in the first chunk
+                PARAGRAPHS[1],
+            ]
+        )
+        selection = select_context(results, config=CONFIG)  # type: ignore
+        self.assertEqual(
+            [r.content for r in selection.results],
+            [results[0].content, results[1].content],
+        )
+        self.assertEqual([r.rank for r in selection.results], [0, 1])
+        self.assertEqual(selection.tokens_saved, estimate_tokens(PARAGRAPHS[1]))
+
+    def test_diversifies(self):
+        similar = PARAGRAPHS[0] + " Buckets can be versioned."
+        results = create_results(
+            [PARAGRAPHS[0], similar, PARAGRAPHS[1]], scores=[0.9, 0.85, 0.8]
+        )
+        config = {**CONFIG, "duplicate_threshold": 1.1, "mmr_lambda": 0.5}
+        selection = select_context(results, config=config)  # type: ignore
+        self.assertEqual(
+            [r.content for r in selection.results],
+            [PARAGRAPHS[0], PARAGRAPHS[1], similar],
+        )
+
+    def test_relevance_only(self):
+        similar = PARAGRAPHS[0] + " Buckets can be versioned."
+        results = create_results([PARAGRAPHS[0], similar, PARAGRAPHS[1]])
+        config = {**CONFIG, "duplicate_threshold": 1.1, "mmr_lambda": 1.0}
+        selection = select_context(results, config=config)  # type: ignore
+        self.assertEqual(
+            [r.content for r in selection.results], [r.content for r in results]
+        )
+
+    def test_min_score(self):
+        results = create_results(PARAGRAPHS[:3], scores=[0.8, 0.5, 0.2])
+        config = {**CONFIG, "min_score": 0.4}
+        selection = select_context(results, config=config)  # type: ignore
+        self.assertEqual(len(selection.results), 2)
+
+    def test_token_budget(self):
+        long = "word " * 400
+        results = create_results([PARAGRAPHS[0], long, PARAGRAPHS[1]])
+        budget = estimate_tokens(PARAGRAPHS[0]) + estimate_tokens(PARAGRAPHS[1])
+        selection = select_context(results, budget, config=CONFIG)  # type: ignore
+        # The long chunk does not fit, but the next one does
+        self.assertEqual(
+            [r.content for r in selection.results], [PARAGRAPHS[0], PARAGRAPHS[1]]
+        )
+        self.assertLessEqual(selection.selected_tokens, budget)
+
+    def test_keeps_top_chunk_over_budget(self):
+        results = create_results(["word " * 400])
+        selection = select_context(results, 10, config=CONFIG)  # type: ignore
+        self.assertEqual(len(selection.results), 1)
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens("abcd" * 10), 11)
+        self.assertEqual(estimate_tokens("日本語"), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import sys
+import threading
+import unittest
+
+sys.path.append(".")
+
+from botocore.exceptions import ClientError
+from app.metrics import metrics
+from embedding.engine import (
+    MAX_TEXT_CHARS,
+    AimdConcurrencyLimiter,
+    EmbeddingEngine,
+    pack_batches,
+)
+
+
+def throttling_error() -> ClientError:
+    return ClientError(
+        {
+            "Error": {"Code": "ThrottlingException", "Message": "Too many requests"},
+            "ResponseMetadata": {"HTTPStatusCode": 429},
+        },
+        "InvokeModel",
+    )
+
+
+class TestPackBatches(unittest.TestCase):
+    def test_max_texts(self):
+        batches = pack_batches(["a"] * 10, max_texts=4, max_bytes=1024)
+        self.assertEqual(batches, [(0, 4), (4, 8), (8, 10)])
+
+    def test_max_bytes(self):
+        # Each text counts as 10 + 4 bytes
+        batches = pack_batches(["x" * 10] * 5, max_texts=96, max_bytes=30)
+        self.assertEqual(batches, [(0, 2), (2, 4), (4, 5)])
+
+    def test_oversized_text_gets_own_batch(self):
+        batches = pack_batches(["x" * 100, "y"], max_texts=96, max_bytes=30)
+        self.assertEqual(batches, [(0, 1), (1, 2)])
+
+    def test_empty(self):
+        self.assertEqual(pack_batches([]), [])
+
+
+class TestAimdConcurrencyLimiter(unittest.TestCase):
+    def test_increase_and_decrease(self):
+        limiter = AimdConcurrencyLimiter(initial=2, minimum=1, maximum=4)
+        limiter.on_success()
+        limiter.on_success()
+        self.assertAlmostEqual(limiter.limit, 2.0 + 0.5 + 1 / 2.5)
+        limiter.on_throttle()
+        self.assertAlmostEqual(limiter.limit, (2.0 + 0.5 + 1 / 2.5) / 2)
+        limiter.on_throttle()
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 1)
+
+
+class TestEmbeddingEngine(unittest.TestCase):
+    def test_preserves_order(self):
+        def embed_fn(texts: list[str]) -> list[list[float]]:
+            return [[float(t), 0.0] for t in texts]
+
+        engine = EmbeddingEngine(embed_fn=embed_fn, max_texts=3, max_concurrency=4)
+        texts = [str(i) for i in range(20)]
+        embeddings = engine.embed(texts)
+        self.assertEqual(embeddings.shape, (20, 2))
+        self.assertEqual(str(embeddings.dtype), "float32")
+        self.assertEqual(embeddings[:, 0].tolist(), list(range(20)))
+
+    def test_retries_throttled_batches(self):
+        lock = threading.Lock()
+        calls = {"count": 0}
+
+        def embed_fn(texts: list[str]) -> list[list[float]]:
+            with lock:
+                calls["count"] += 1
+                if calls["count"] <= 2:
+                    raise throttling_error()
+            return [[1.0] for _ in texts]
+
+        engine = EmbeddingEngine(
+            embed_fn=embed_fn, max_texts=2, max_concurrency=2, sleep=lambda _: None
+        )
+        embeddings = engine.embed(["a", "b", "c", "d"])
+        self.assertEqual(embeddings.shape, (4, 1))
+        self.assertEqual(calls["count"], 4)
+
+    def test_counts_truncated_texts(self):
+        metrics.reset()
+        received: list[str] = []
+
+        def embed_fn(texts: list[str]) -> list[list[float]]:
+            received.extend(texts)
+            return [[1.0] for _ in texts]
+
+        engine = EmbeddingEngine(embed_fn=embed_fn, max_concurrency=1)
+        engine.embed(["a", "b" * (MAX_TEXT_CHARS + 1)])
+        self.assertEqual(received, ["a", "b" * MAX_TEXT_CHARS])
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["embedding.truncated_texts"], 1)
+
+    def test_raises_non_retryable_error(self):
+        def embed_fn(texts: list[str]) -> list[list[float]]:
+            raise ValueError("invalid input")
+
+        engine = EmbeddingEngine(embed_fn=embed_fn, sleep=lambda _: None)
+        with self.assertRaises(ValueError):
+            engine.embed(["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
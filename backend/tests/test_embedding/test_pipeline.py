@@ -0,0 +1,81 @@
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(".")
+
+from embedding.pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def test_stages(self):
+        written: list[int] = []
+        batch: list[int] = []
+
+        def split(item: int, emit):
+            for i in range(item):
+                emit(i)
+
+        def write(item: int, emit):
+            batch.append(item)
+            if len(batch) >= 4:
+                flush(emit)
+
+        def flush(emit):
+            written.extend(batch)
+            batch.clear()
+
+        stats = (
+            Pipeline(queue_size=2)
+            .add_stage("split", split, workers=3)
+            .add_stage("double", lambda item, emit: emit(item * 2), workers=2)
+            .add_stage("write", write, finish=flush)
+            .run([3, 4, 5])
+        )
+        self.assertEqual(sorted(written), sorted([0, 2, 4, 0, 2, 4, 6, 0, 2, 4, 6, 8]))
+        self.assertEqual(
+            [(s.name, s.items_in, s.items_out) for s in stats],
+            [("split", 3, 12), ("double", 12, 12), ("write", 12, 0)],
+        )
+
+    def test_bounded_queues(self):
+        lock = threading.Lock()
+        produced = [0]
+        consumed = [0]
+        in_flight: list[int] = []
+
+        def produce(item: int, emit):
+            with lock:
+                produced[0] += 1
+                in_flight.append(produced[0] - consumed[0])
+            emit(item)
+
+        def consume(item: int, emit):
+            time.sleep(0.001)
+            with lock:
+                consumed[0] += 1
+
+        Pipeline(queue_size=2).add_stage("produce", produce).add_stage(
+            "consume", consume
+        ).run(range(50))
+        self.assertEqual(consumed[0], 50)
+        # Items in the queue, held by each worker and being produced
+        self.assertLessEqual(max(in_flight), 2 + 2 + 1)
+
+    def test_error_stops_pipeline(self):
+        def fail(item: int, emit):
+            if item == 3:
+                raise ValueError("broken")
+            emit(item)
+
+        processed: list[int] = []
+        with self.assertRaises(ValueError):
+            Pipeline(queue_size=1).add_stage("fail", fail).add_stage(
+                "sink", lambda item, emit: processed.append(item)
+            ).run(range(1000))
+        self.assertLess(len(processed), 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
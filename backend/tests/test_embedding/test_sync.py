@@ -0,0 +1,51 @@
+import sys
+import unittest
+
+sys.path.append(".")
+
+from embedding.sync import SyncSummary, compose_source_hash, plan_sync
+
+
+class TestPlanSync(unittest.TestCase):
+    def test_plan(self):
+        plan = plan_sync(
+            {"a": "1", "b": "2", "c": "3"},
+            {"b": "2", "c": "old", "d": "4"},
+        )
+        self.assertEqual(plan.added, ["a"])
+        self.assertEqual(plan.changed, ["c"])
+        self.assertEqual(plan.removed, ["d"])
+        self.assertEqual(plan.unchanged, ["b"])
+        self.assertEqual(plan.to_embed, ["a", "c"])
+        self.assertEqual(plan.to_delete, ["c", "d"])
+
+    def test_first_sync(self):
+        plan = plan_sync({"a": "1"}, {})
+        self.assertEqual(plan.to_embed, ["a"])
+        self.assertEqual(plan.to_delete, [])
+        self.assertEqual(plan.unchanged, [])
+
+    def test_source_hash_covers_parameters(self):
+        base = compose_source_hash("etag", 1000, 200, False)
+        self.assertEqual(base, compose_source_hash("etag", 1000, 200, False))
+        self.assertNotEqual(base, compose_source_hash("etag2", 1000, 200, False))
+        self.assertNotEqual(base, compose_source_hash("etag", 500, 200, False))
+        self.assertNotEqual(base, compose_source_hash("etag", 1000, 200, True))
+
+    def test_summary(self):
+        summary = SyncSummary(
+            plan=plan_sync({"a": "1", "b": "2"}, {"b": "2", "c": "3"}),
+            chunks_embedded=4,
+            chunks_reused=1,
+            chunks_deleted=6,
+            chunks_total=10,
+        )
+        self.assertEqual(
+            str(summary),
+            "Sources: 1 added, 0 changed, 1 removed, 1 unchanged. "
+            "Chunks: 4 embedded, 1 reused, 6 deleted, 10 total.",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.embedding_cache import (
+    EmbeddingCache,
+    compose_cache_key,
+    decode_embedding,
+    encode_embedding,
+    normalize_query,
+)
+from app.metrics import metrics
+
+
+class InMemoryStore:
+    def __init__(self):
+        self.items: dict[str, bytes] = {}
+
+    def get(self, key: str) -> list[float] | None:
+        data = self.items.get(key)
+        return decode_embedding(data) if data is not None else None
+
+    def put(self, key: str, embedding: list[float]):
+        self.items[key] = encode_embedding(embedding)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    config = {"max_entries": 2, "ttl_seconds": 60}
+
+    def setUp(self) -> None:
+        metrics.reset()
+        self.calls: list[str] = []
+
+    def compute(self, text: str) -> list[float]:
+        self.calls.append(text)
+        return [float(len(self.calls)), 0.5]
+
+    def test_normalize(self):
+        self.assertEqual(normalize_query("  What   is\nＡＷＳ? "), "What is AWS?")
+        self.assertEqual(
+            compose_cache_key("model", "Hello  World"),
+            compose_cache_key("model", "Hello World"),
+        )
+        self.assertNotEqual(
+            compose_cache_key("model", "Hello"), compose_cache_key("model", "hello")
+        )
+        self.assertNotEqual(
+            compose_cache_key("model-a", "hello"), compose_cache_key("model-b", "hello")
+        )
+
+    def test_encode_decode(self):
+        data = encode_embedding([0.25, -1.5, 3.0])
+        self.assertEqual(len(data), 12)
+        self.assertEqual(decode_embedding(data), [0.25, -1.5, 3.0])
+
+    def test_memory_hit(self):
+        cache = EmbeddingCache(config=self.config)  # type: ignore
+        first = cache.get_or_compute("model", "Hello", self.compute)
+        second = cache.get_or_compute("model", " Hello\n", self.compute)
+        self.assertEqual(first, second)
+        self.assertEqual(self.calls, ["Hello"])
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["embedding_cache.hit[tier=memory]"], 1)
+        self.assertEqual(counters["embedding_cache.miss"], 1)
+
+    def test_lru_eviction(self):
+        cache = EmbeddingCache(config=self.config)  # type: ignore
+        cache.get_or_compute("model", "a", self.compute)
+        cache.get_or_compute("model", "b", self.compute)
+        # Touch "a" so that "b" is the least recently used
+        cache.get_or_compute("model", "a", self.compute)
+        cache.get_or_compute("model", "c", self.compute)
+        cache.get_or_compute("model", "a", self.compute)
+        self.assertEqual(self.calls, ["a", "b", "c"])
+        cache.get_or_compute("model", "b", self.compute)
+        self.assertEqual(self.calls, ["a", "b", "c", "b"])
+
+    def test_store_hit(self):
+        store = InMemoryStore()
+        EmbeddingCache(config=self.config, store=store).get_or_compute(  # type: ignore
+            "model", "query", self.compute
+        )
+        # Another process shares the persistent tier
+        cache = EmbeddingCache(config=self.config, store=store)  # type: ignore
+        embedding = cache.get_or_compute("model", "query", self.compute)
+        self.assertEqual(embedding, [1.0, 0.5])
+        self.assertEqual(len(self.calls), 1)
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["embedding_cache.hit[tier=store]"], 1)
+
+    def test_get_or_compute_many(self):
+        cache = EmbeddingCache(config={"max_entries": 10, "ttl_seconds": 60})  # type: ignore
+        cache.get_or_compute("model", "a", self.compute)
+        batches = []
+
+        def compute_many(texts: list[str]) -> list[list[float]]:
+            batches.append(texts)
+            return [[float(len(t)), 0.0] for t in texts]
+
+        embeddings = cache.get_or_compute_many(
+            "model", ["a", "bb", " ccc ", "bb "], compute_many
+        )
+        # Only the missing queries are computed in normalized form, with a single call
+        self.assertEqual(batches, [["bb", "ccc"]])
+        self.assertEqual(embeddings, [[1.0, 0.5], [2.0, 0.0], [3.0, 0.0], [2.0, 0.0]])
+
+    def test_store_error_is_miss(self):
+        class BrokenStore:
+            def get(self, key):
+                raise RuntimeError("unavailable")
+
+            def put(self, key, embedding):
+                raise RuntimeError("unavailable")
+
+        cache = EmbeddingCache(config=self.config, store=BrokenStore())  # type: ignore
+        self.assertEqual(
+            cache.get_or_compute("model", "query", self.compute), [1.0, 0.5]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(".")
+
+import numpy as np
+from app.local_index import LocalIndex, LocalIndexCache, decode_chunks, encode_chunks
+from tests.utils.clock import FakeClock
+
+
+def save_embeddings(directory: str, name: str, embeddings: np.ndarray) -> str:
+    path = os.path.join(directory, name)
+    np.save(path, embeddings.astype(np.float32))
+    return path
+
+
+class TestLocalIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_search_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        embeddings = rng.normal(size=(200, 16)).astype(np.float32)
+        chunks = [(f"content_{i}", f"source_{i}") for i in range(200)]
+        index = LocalIndex(
+            "bot", save_embeddings(self.tmp.name, "a.npy", embeddings), chunks
+        )
+
+        queries = rng.normal(size=(3, 16)).astype(np.float32)
+        results = index.search_many(queries.tolist(), 5)
+        for query, query_results in zip(queries, results):
+            expected = np.argsort(np.linalg.norm(embeddings - query, axis=1))[:5]
+            self.assertEqual(
+                [r[1] for r in query_results], [f"content_{i}" for i in expected]
+            )
+            self.assertTrue(all(r[0] == "bot" for r in query_results))
+
+    def test_limit_larger_than_index(self):
+        embeddings = np.array([[0.0, 0.0], [1.0, 0.0]])
+        index = LocalIndex(
+            "bot",
+            save_embeddings(self.tmp.name, "a.npy", embeddings),
+            [("far", "s"), ("near", "s")],
+        )
+        results = index.search([0.9, 0.0], 10)
+        self.assertEqual([r[1] for r in results], ["near", "far"])
+        # Scores are 1 - |x - q|^2 / 2
+        self.assertAlmostEqual(results[0][3], 1 - 0.01 / 2, places=5)
+        self.assertAlmostEqual(results[1][3], 1 - 0.81 / 2, places=5)
+
+    def test_mismatched_chunks(self):
+        path = save_embeddings(self.tmp.name, "a.npy", np.zeros((2, 4)))
+        with self.assertRaises(ValueError):
+            LocalIndex("bot", path, [("only", "one")])
+
+    def test_searchable_after_file_removed(self):
+        path = save_embeddings(self.tmp.name, "a.npy", np.eye(2))
+        index = LocalIndex("bot", path, [("x", "s"), ("y", "s")])
+        index.remove_file()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual([r[1] for r in index.search([0.0, 1.0], 1)], ["y"])
+
+    def test_encode_decode_chunks(self):
+        chunks = [("content", "s3://bucket/key"), ("日本語", "https://example.com")]
+        self.assertEqual(decode_chunks(encode_chunks(chunks)), chunks)
+
+
+class TestLocalIndexCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.loads: list[str] = []
+        self.missing: set[str] = set()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def load(self, bot_id: str, prefix: str) -> LocalIndex | None:
+        self.loads.append(prefix)
+        if bot_id in self.missing:
+            return None
+        path = save_embeddings(self.tmp.name, f"{bot_id}.npy", np.zeros((64, 16)))
+        return LocalIndex(bot_id, path, [("c", "s")] * 64)
+
+    def create_cache(self, max_cache_bytes: int = 1024 * 1024) -> LocalIndexCache:
+        return LocalIndexCache(
+            {
+                "max_chunks": 1000,
+                "max_cache_bytes": max_cache_bytes,
+                "absent_ttl_seconds": 60,
+            },
+            load=self.load,
+            clock=self.clock,
+        )
+
+    def test_loads_once(self):
+        cache = self.create_cache()
+        first = cache.get("user", "bot", "exec", 1)
+        second = cache.get("user", "bot", "exec", 1)
+        self.assertIs(first, second)
+        self.assertEqual(self.loads, ["user/bot/vector_index/exec/"])
+
+    def test_evicts_least_recently_used(self):
+        cache = self.create_cache()
+        size = cache.get("user", "a", "exec", 1).nbytes  # type: ignore
+        cache.max_cache_bytes = size * 2
+        cache.get("user", "b", "exec", 1)
+        cache.get("user", "a", "exec", 1)
+        cache.get("user", "c", "exec", 1)
+
+        self.assertEqual(cache.size, size * 2)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "b.npy")))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "a.npy")))
+        cache.get("user", "a", "exec", 1)
+        self.assertEqual(len(self.loads), 3)
+
+    def test_absent_is_remembered(self):
+        self.missing.add("bot")
+        cache = self.create_cache()
+        self.assertIsNone(cache.get("user", "bot", "exec", 1))
+        self.assertIsNone(cache.get("user", "bot", "exec", 1))
+        self.assertEqual(len(self.loads), 1)
+
+        self.clock.now = 61
+        self.assertIsNone(cache.get("user", "bot", "exec", 1))
+        self.assertEqual(len(self.loads), 2)
+
+    def test_absent_is_not_remembered_across_versions(self):
+        # Looked up while the sync is running, then again once it succeeded
+        self.missing.add("bot")
+        cache = self.create_cache()
+        self.assertIsNone(cache.get("user", "bot", "exec", 1))
+        self.missing.clear()
+        self.assertIsNotNone(cache.get("user", "bot", "exec", 2))
+
+    def test_evicted_index_stays_searchable(self):
+        cache = self.create_cache()
+        held = cache.get("user", "a", "exec", 1)
+        cache.max_cache_bytes = held.nbytes  # type: ignore
+        cache.get("user", "b", "exec", 1)
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "a.npy")))
+        self.assertEqual(len(held.search([0.0] * 16, 3)), 3)  # type: ignore
+
+    def test_loads_without_blocking_other_bots(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def load(bot_id: str, prefix: str) -> LocalIndex | None:
+            if bot_id == "slow":
+                started.set()
+                # Times out if the other bot waits for this download
+                if not release.wait(5):
+                    raise TimeoutError()
+            return self.load(bot_id, prefix)
+
+        cache = LocalIndexCache(load=load, clock=self.clock)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            slow = [
+                executor.submit(cache.get, "user", "slow", "exec", 1) for _ in range(2)
+            ]
+            self.assertTrue(started.wait(5))
+            # Served while the snapshot of the other bot is being downloaded
+            self.assertIsNotNone(cache.get("user", "fast", "exec", 1))
+            release.set()
+            first, second = [future.result(5) for future in slow]
+
+        self.assertIs(first, second)
+        self.assertEqual(
+            sorted(self.loads),
+            ["user/fast/vector_index/exec/", "user/slow/vector_index/exec/"],
+        )
+
+    def test_load_error_falls_back(self):
+        def load(bot_id: str, prefix: str) -> LocalIndex | None:
+            raise RuntimeError("S3 unavailable")
+
+        cache = LocalIndexCache(load=load, clock=self.clock)
+        self.assertIsNone(cache.get("user", "bot", "exec", 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
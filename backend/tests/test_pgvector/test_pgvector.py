@@ -0,0 +1,339 @@
+import struct
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.pgvector import (
+    COLUMNS,
+    BotItemsStaging,
+    compose_index_ddl,
+    compose_multi_search_query,
+    compose_search_query,
+    count_candidates,
+    drop_bot_items,
+    encode_copy_rows,
+    ensure_index,
+    fetch_source_hashes,
+    format_vector,
+    partition_name,
+    percentile,
+    recall_at_k,
+    replace_bot_items,
+    search_settings,
+)
+
+BOT_ID = "01HZX5G8Q3V6N2B7C4D9E0F1GH"
+
+
+def decode_copy_rows(data: bytes) -> list[tuple]:
+    """Decode the binary `COPY` data of `encode_copy_rows`, with the embedding as a
+    list of floats.
+    """
+    assert data.startswith(b"PGCOPY\n\xff\r\n\x00")
+    offset = 19
+    rows = []
+    while True:
+        (fields,) = struct.unpack_from(">h", data, offset)
+        offset += 2
+        if fields == -1:
+            return rows
+        row: list = []
+        for _ in range(fields):
+            (length,) = struct.unpack_from(">i", data, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+                continue
+            value = data[offset : offset + length]
+            offset += length
+            if len(row) == COLUMNS.index("embedding"):
+                dimensions, _ = struct.unpack_from(">hh", value)
+                row.append(list(struct.unpack_from(f">{dimensions}f", value, 4)))
+            else:
+                row.append(value.decode("utf-8"))
+        rows.append(tuple(row))
+
+
+class FakeConnection:
+    def __init__(
+        self,
+        indexes: list[str] | None = None,
+        fail_on_insert: bool = False,
+        rows: tuple = tuple(),
+    ):
+        self.indexes = indexes or []
+        self.fail_on_insert = fail_on_insert
+        self.rows = rows
+        self.statements: list[str] = []
+        self.inserted: list[tuple] = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def run(self, sql: str, stream=None, **params):
+        params["stream"] = stream
+        self.statements.append(sql)
+        if "pg_indexes" in sql:
+            return tuple((name,) for name in self.indexes)
+        if sql.startswith(("SELECT", "WITH")):
+            return self.rows
+        if sql.startswith("COPY"):
+            if self.fail_on_insert:
+                raise RuntimeError("insert failed")
+            self.inserted.extend(decode_copy_rows(params["stream"].read()))
+        return tuple()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class TestPgvector(unittest.TestCase):
+    config = {
+        "method": "hnsw",
+        "m": 16,
+        "ef_construction": 64,
+        "lists": 100,
+        "dimensions": 1024,
+        "quantization": "none",
+        "rerank_factor": 4,
+        "ef_search": 40,
+        "probes": 10,
+    }
+
+    def test_compose_index_ddl(self):
+        ddl = compose_index_ddl(self.config, name="idx_items_embedding_hnsw")  # type: ignore
+        self.assertIn("IF NOT EXISTS idx_items_embedding_hnsw ON items", ddl)
+        self.assertIn("USING hnsw (embedding vector_l2_ops)", ddl)
+        self.assertIn("m = 16, ef_construction = 64", ddl)
+
+        ddl = compose_index_ddl({**self.config, "method": "ivfflat"})  # type: ignore
+        self.assertIn("WITH (lists = 100)", ddl)
+
+        # Partitions use generated index names
+        ddl = compose_index_ddl(self.config, table="items_x_staging")  # type: ignore
+        self.assertTrue(ddl.startswith("CREATE INDEX ON items_x_staging USING hnsw"))
+
+    def test_search_settings(self):
+        self.assertEqual(
+            search_settings(10, config=self.config), {"hnsw.ef_search": 40}  # type: ignore
+        )
+        # ef_search must not be smaller than the number of results
+        self.assertEqual(
+            search_settings(60, ef_search=20, config=self.config),  # type: ignore
+            {"hnsw.ef_search": 60},
+        )
+        self.assertEqual(
+            search_settings(10, probes=3, config={**self.config, "method": "ivfflat"}),  # type: ignore
+            {"ivfflat.probes": 3},
+        )
+
+    def test_quantized_index_ddl(self):
+        ddl = compose_index_ddl({**self.config, "quantization": "halfvec"})  # type: ignore
+        self.assertIn("((embedding::halfvec(1024)) halfvec_l2_ops)", ddl)
+        ddl = compose_index_ddl({**self.config, "quantization": "binary"})  # type: ignore
+        self.assertIn("((binary_quantize(embedding)::bit(1024)) bit_hamming_ops)", ddl)
+
+    def test_search_query(self):
+        query = compose_search_query(self.config)  # type: ignore
+        self.assertIn("embedding <-> CAST(:embedding AS vector) AS distance", query)
+        self.assertNotIn(":candidates", query)
+        self.assertEqual(count_candidates(10, self.config), 10)  # type: ignore
+
+        # Binary quantized candidates are re-ranked by full precision distance
+        config = {**self.config, "quantization": "binary"}
+        query = compose_search_query(config)  # type: ignore
+        self.assertIn(
+            "ORDER BY (binary_quantize(embedding)::bit(1024)) <~> "
+            "binary_quantize(CAST(:embedding AS vector))",
+            query,
+        )
+        self.assertIn("LIMIT :candidates", query)
+        self.assertIn(
+            "SELECT id, botid, content, source, "
+            "embedding <-> CAST(:embedding AS vector) AS distance\nFROM (",
+            query,
+        )
+        self.assertEqual(count_candidates(10, config), 40)  # type: ignore
+        # ef_search covers all the candidates
+        self.assertEqual(
+            search_settings(10, config=config), {"hnsw.ef_search": 40}  # type: ignore
+        )
+
+        query = compose_search_query({**config, "rerank_factor": 1})  # type: ignore
+        self.assertNotIn(":candidates", query)
+
+    def test_multi_search_query(self):
+        query = compose_multi_search_query(self.config)  # type: ignore
+        self.assertIn("unnest(CAST(:embeddings AS text[])) WITH ORDINALITY", query)
+        self.assertIn("CROSS JOIN LATERAL", query)
+        self.assertIn(
+            "embedding <-> CAST(queries.query_vector AS vector) AS distance", query
+        )
+        self.assertNotIn(":embedding ", query)
+
+    def test_format_vector(self):
+        values = [0.1, -1.5e-05, 3.0]
+        self.assertEqual(format_vector(values), "[0.1,-1.5e-05,3]")
+
+    def test_ensure_index_replaces_other_method(self):
+        conn = FakeConnection(indexes=["idx_items_embedding_ivfflat"])
+        self.assertTrue(ensure_index(conn, self.config))  # type: ignore
+        self.assertIn("idx_items_embedding_hnsw", conn.statements[1])
+        self.assertEqual(
+            conn.statements[2], "DROP INDEX IF EXISTS idx_items_embedding_ivfflat"
+        )
+
+        conn = FakeConnection(indexes=["idx_items_embedding_hnsw"])
+        self.assertFalse(ensure_index(conn, self.config))  # type: ignore
+        self.assertEqual(len(conn.statements), 1)
+
+    def test_partition_name(self):
+        self.assertEqual(partition_name(BOT_ID), f"items_{BOT_ID.lower()}")
+        with self.assertRaises(ValueError):
+            partition_name("x'; DROP TABLE items; --")
+
+    def test_replace_bot_items(self):
+        conn = FakeConnection()
+        rows = [("id1", BOT_ID, "content", "a", "[0.5,0.25]", "hash_a", "hash_1")]
+        replace_bot_items(conn, BOT_ID, rows, self.config)  # type: ignore
+        self.assertEqual(
+            conn.inserted,
+            [("id1", BOT_ID, "content", "a", [0.5, 0.25], "hash_a", "hash_1")],
+        )
+        self.assertEqual(conn.commits, 1)
+
+        partition = partition_name(BOT_ID)
+        statements = conn.statements
+        # Rows are loaded and indexed before the partition is swapped
+        insert = next(i for i, s in enumerate(statements) if s.startswith("COPY"))
+        drop = statements.index(f"DROP TABLE IF EXISTS {partition}")
+        self.assertLess(insert, drop)
+        self.assertTrue(
+            any(
+                s.startswith(f"CREATE INDEX ON {partition}_staging") for s in statements
+            )
+        )
+        self.assertEqual(
+            statements[-1],
+            f"ALTER TABLE items ATTACH PARTITION {partition} FOR VALUES IN ('{BOT_ID}')",
+        )
+
+    def test_replace_bot_items_rolls_back(self):
+        conn = FakeConnection(fail_on_insert=True)
+        with self.assertRaises(RuntimeError):
+            replace_bot_items(conn, BOT_ID, [], self.config)  # type: ignore
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(conn.commits, 0)
+        self.assertNotIn(
+            f"DROP TABLE IF EXISTS {partition_name(BOT_ID)}", conn.statements
+        )
+
+    def test_drop_bot_items(self):
+        partition = partition_name(BOT_ID)
+        conn = FakeConnection(rows=((f"{partition}_staging_0a1b2c3d",),))
+        drop_bot_items(conn, BOT_ID)
+        self.assertEqual(
+            conn.statements[1:],
+            [
+                f"DROP TABLE IF EXISTS {partition}_staging_0a1b2c3d",
+                f"DROP TABLE IF EXISTS {partition}",
+            ],
+        )
+        self.assertEqual(conn.commits, 1)
+
+    def test_encode_copy_rows(self):
+        rows = [
+            ("id1", BOT_ID, "日本語", "s3://bucket/key", "[0.5,-2,1e-05]", None, "h"),
+            ("id2", BOT_ID, "", "a", (1.0, 0.0, 0.0), "hash_a", "h"),
+        ]
+        decoded = decode_copy_rows(encode_copy_rows(rows))
+        self.assertEqual(decoded[0][:4], rows[0][:4])
+        self.assertEqual(decoded[0][4][:2], [0.5, -2.0])
+        self.assertAlmostEqual(decoded[0][4][2], 1e-05)
+        self.assertIsNone(decoded[0][5])
+        self.assertEqual(
+            decoded[1], ("id2", BOT_ID, "", "a", [1.0, 0.0, 0.0], "hash_a", "h")
+        )
+
+    def test_staging_replace(self):
+        conn = FakeConnection()
+        staging = BotItemsStaging(conn, BOT_ID, self.config)  # type: ignore
+        staging.create()
+        rows = [("id1", BOT_ID, "content", "a", [0.5, 0.25], "hash_a", "hash_1")]
+        staging.write(rows)
+        staging.write(rows)
+        self.assertEqual(conn.inserted, rows * 2)
+        self.assertTrue(
+            conn.statements[-1].startswith(f"COPY {staging.table} (id, botid, content")
+        )
+        # Every batch is committed
+        self.assertEqual(conn.commits, 3)
+
+        staging.replace()
+        partition = partition_name(BOT_ID)
+        self.assertEqual(
+            conn.statements[-1],
+            f"ALTER TABLE items ATTACH PARTITION {partition} FOR VALUES IN ('{BOT_ID}')",
+        )
+        self.assertEqual(conn.commits, 4)
+
+    def test_staging_merge(self):
+        conn = FakeConnection(rows=((3,),))
+        staging = BotItemsStaging(conn, BOT_ID, self.config)  # type: ignore
+        staging.create()
+        staging.write([])
+        self.assertEqual(staging.merge(["a", "b"]), 3)
+        merge = conn.statements[-3:]
+        self.assertIn("DELETE FROM items WHERE botid = :bot_id", merge[0])
+        self.assertTrue(
+            merge[1].startswith("INSERT INTO items (")
+            and merge[1].endswith(f"FROM {staging.table}")
+        )
+        self.assertEqual(merge[2], f"DROP TABLE {staging.table}")
+        # The partition is updated in place
+        self.assertNotIn(f"DROP TABLE IF EXISTS {partition_name(BOT_ID)}", merge)
+
+    def test_staging_tables_are_unique_per_sync(self):
+        conn = FakeConnection()
+        first = BotItemsStaging(conn, BOT_ID, self.config)  # type: ignore
+        second = BotItemsStaging(conn, BOT_ID, self.config)  # type: ignore
+        self.assertNotEqual(first.table, second.table)
+        self.assertTrue(first.table.startswith(f"{partition_name(BOT_ID)}_staging_"))
+        # Identifiers are truncated beyond 63 bytes
+        self.assertLessEqual(len(f"{first.table}_botid"), 63)
+
+        first.create()
+        second.create()
+        # Creating a staging table does not touch the one of an overlapping sync
+        self.assertFalse(any(first.table in s for s in conn.statements[2:]))
+
+    def test_staging_write_rolls_back(self):
+        conn = FakeConnection(fail_on_insert=True)
+        staging = BotItemsStaging(conn, BOT_ID, self.config)  # type: ignore
+        with self.assertRaises(RuntimeError):
+            staging.write([("id1", BOT_ID, "content", "a", "[0.1]", "h", "h")])
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(staging.rows, 0)
+
+    def test_fetch_source_hashes(self):
+        conn = FakeConnection(
+            rows=(("a", "hash_a"), ("b", None), ("c", "hash_c1"), ("c", "hash_c2"))
+        )
+        # Sources without a hash, or with several, are synced again
+        self.assertEqual(
+            fetch_source_hashes(conn, BOT_ID), {"a": "hash_a", "b": "", "c": ""}
+        )
+
+    def test_recall_and_percentile(self):
+        self.assertEqual(recall_at_k(["a", "b", "c", "d"], ["a", "c", "x", "y"]), 0.5)
+        self.assertEqual(recall_at_k([], []), 1.0)
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 50.0)
+        self.assertEqual(percentile(values, 95), 95.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.postgres import ConnectionPool, is_authentication_error
+from tests.utils.clock import FakeClock
+
+
+class FakeStatement:
+    def __init__(self, sql: str):
+        self.sql = sql
+
+    def run(self, **params):
+        return ((self.sql, params),)
+
+
+class FakeConnection:
+    def __init__(self, healthy: bool = True):
+        self.healthy = healthy
+        self.closed = False
+        self.rollbacks = 0
+        self.prepared: list[str] = []
+
+    def run(self, sql: str):
+        if not self.healthy:
+            raise ConnectionError("connection reset")
+        return ((1,),)
+
+    def prepare(self, sql: str) -> FakeStatement:
+        self.prepared.append(sql)
+        return FakeStatement(sql)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(unittest.TestCase):
+    config = {
+        "max_connections": 2,
+        "max_idle_seconds": 300,
+        "health_check_interval_seconds": 30,
+        "secret_max_age_seconds": 300,
+    }
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.connections: list[FakeConnection] = []
+
+    def connect(self) -> FakeConnection:
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    def create_pool(self) -> ConnectionPool:
+        return ConnectionPool(connect=self.connect, config=self.config, clock=self.clock)  # type: ignore
+
+    def test_reuse(self):
+        pool = self.create_pool()
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.connections[0].rollbacks, 2)
+
+    def test_max_idle_eviction(self):
+        pool = self.create_pool()
+        with pool.connection():
+            pass
+        self.clock.now = 301
+        with pool.connection():
+            pass
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+
+    def test_health_check(self):
+        pool = self.create_pool()
+        with pool.connection():
+            pass
+        self.connections[0].healthy = False
+        # Recently used connections are reused without a health check
+        self.clock.now = 10
+        with pool.connection():
+            pass
+        self.assertEqual(len(self.connections), 1)
+        self.clock.now = 50
+        with pool.connection():
+            pass
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+
+    def test_error_discards_connection(self):
+        pool = self.create_pool()
+        with self.assertRaises(ValueError):
+            with pool.connection():
+                raise ValueError("query failed")
+        self.assertTrue(self.connections[0].closed)
+        with pool.connection():
+            pass
+        self.assertEqual(len(self.connections), 2)
+
+    def test_prepared_statements_are_cached(self):
+        pool = self.create_pool()
+        for _ in range(3):
+            with pool.connection() as pooled:
+                rows = pooled.prepare("SELECT :a").run(a=1)
+        self.assertEqual(rows, (("SELECT :a", {"a": 1}),))
+        self.assertEqual(self.connections[0].prepared, ["SELECT :a"])
+
+    def test_is_authentication_error(self):
+        self.assertTrue(is_authentication_error(Exception({"C": "28P01"})))
+        self.assertFalse(is_authentication_error(Exception({"C": "42P01"})))
+        self.assertFalse(is_authentication_error(Exception("error")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.metrics import metrics
+from app.resilience import (
+    AdaptiveRateLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    backoff_delay,
+    call_with_retries,
+    get_circuit_breaker,
+    is_retryable_error,
+    is_throttling_error,
+    reset_resilience_state,
+)
+from botocore.exceptions import ClientError
+from tests.utils.clock import FakeClock
+
+
+def client_error(code: str, status_code: int = 400) -> ClientError:
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": code},
+            "ResponseMetadata": {"HTTPStatusCode": status_code},
+        },
+        "Converse",
+    )
+
+
+class TestErrorClassification(unittest.TestCase):
+    def test_throttling(self):
+        e = client_error("ThrottlingException", 429)
+        self.assertTrue(is_throttling_error(e))
+        self.assertTrue(is_retryable_error(e))
+
+    def test_server_error(self):
+        e = client_error("InternalServerException", 500)
+        self.assertFalse(is_throttling_error(e))
+        self.assertTrue(is_retryable_error(e))
+
+    def test_validation_error(self):
+        e = client_error("ValidationException", 400)
+        self.assertFalse(is_retryable_error(e))
+        self.assertFalse(is_retryable_error(ValueError("throttling")))
+
+    def test_backoff_delay_is_capped(self):
+        self.assertEqual(backoff_delay(10, 1.0, 20.0, rand=lambda: 1.0), 20.0)
+        self.assertEqual(backoff_delay(1, 1.0, 20.0, rand=lambda: 0.5), 1.0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_open_and_recover(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10, clock=clock)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "OPEN")
+        self.assertFalse(breaker.allow_request())
+
+        clock.now = 11
+        # Only one probe is allowed while half open
+        self.assertTrue(breaker.allow_request())
+        self.assertEqual(breaker.state, "HALF_OPEN")
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "CLOSED")
+
+    def test_failed_probe_reopens(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=5, clock=clock)
+        breaker.record_failure()
+        clock.now = 6
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "OPEN")
+        self.assertFalse(breaker.allow_request())
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    def test_learns_from_throttling(self):
+        clock = FakeClock()
+        limiter = AdaptiveRateLimiter(
+            min_rate=1.0,
+            max_rate=10.0,
+            initial_rate=2.0,
+            beta=0.5,
+            clock=clock,
+            sleep=clock.sleep,
+        )
+        # Disabled until the first throttle
+        limiter.acquire()
+        self.assertFalse(limiter.enabled)
+
+        limiter.on_throttle()
+        self.assertTrue(limiter.enabled)
+        self.assertEqual(limiter.rate, 1.0)
+
+        # With a rate of 1 token/sec, acquiring 3 tokens takes about 3 seconds
+        start = clock.now
+        for _ in range(3):
+            limiter.acquire()
+        self.assertAlmostEqual(clock.now - start, 3.0, places=5)
+
+    def test_recovers_and_disables(self):
+        limiter = AdaptiveRateLimiter(min_rate=1.0, max_rate=2.0, growth=1.5)
+        limiter.on_throttle()
+        limiter.on_success()
+        limiter.on_success()
+        self.assertFalse(limiter.enabled)
+
+    def test_starts_from_initial_rate(self):
+        limiter = AdaptiveRateLimiter(initial_rate=10.0, beta=0.5)
+        # Nothing was measured yet
+        limiter.on_throttle()
+        self.assertEqual(limiter.rate, 5.0)
+
+    def test_recovers_multiplicatively(self):
+        limiter = AdaptiveRateLimiter(min_rate=0.5, max_rate=50.0, growth=1.05)
+        for _ in range(20):
+            limiter.on_throttle()
+        self.assertEqual(limiter.rate, 0.5)
+        successes = 0
+        while limiter.enabled:
+            limiter.on_success()
+            successes += 1
+        self.assertLess(successes, 100)
+
+
+class TestCallWithRetries(unittest.TestCase):
+    config = {
+        "max_attempts": 3,
+        "base_delay": 0.1,
+        "throttling_base_delay": 1.0,
+        "max_delay": 5.0,
+        "failure_threshold": 2,
+        "recovery_timeout": 30.0,
+    }
+
+    def setUp(self) -> None:
+        reset_resilience_state()
+        metrics.reset()
+
+    def test_retry_on_throttling(self):
+        calls = []
+        clock = FakeClock()
+
+        def fn():
+            calls.append(1)
+            if len(calls) < 3:
+                raise client_error("ThrottlingException", 429)
+            return "ok"
+
+        result = call_with_retries(
+            fn,
+            key="model-a",
+            config=self.config,  # type: ignore
+            sleep=clock.sleep,
+            clock=clock,
+        )
+        self.assertEqual(result, "ok")
+        self.assertEqual(len(calls), 3)
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(
+            counters["bedrock.retries[code=ThrottlingException,key=model-a]"], 2
+        )
+        self.assertEqual(counters["bedrock.throttled[key=model-a]"], 2)
+
+    def test_no_retry_on_client_error(self):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            raise client_error("ValidationException", 400)
+
+        with self.assertRaises(ClientError):
+            call_with_retries(fn, key="model-b", config=self.config, sleep=lambda _: None)  # type: ignore
+        self.assertEqual(len(calls), 1)
+
+    def test_circuit_opens(self):
+        def fn():
+            raise client_error("ServiceUnavailableException", 503)
+
+        # The circuit opens after the second failure, so the third attempt is rejected
+        with self.assertRaises(CircuitOpenError):
+            call_with_retries(fn, key="model-c", config=self.config, sleep=lambda _: None)  # type: ignore
+        self.assertEqual(get_circuit_breaker("model-c").state, "OPEN")
+        with self.assertRaises(CircuitOpenError):
+            call_with_retries(lambda: "ok", key="model-c", config=self.config)  # type: ignore
+        self.assertEqual(
+            metrics.snapshot()["gauges"]["bedrock.circuit_state[key=model-c]"], 2
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
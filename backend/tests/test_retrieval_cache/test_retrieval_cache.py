@@ -0,0 +1,106 @@
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.metrics import metrics
+from app.retrieval_cache import (
+    RetrievalCache,
+    compose_cache_key,
+    decode_results,
+    encode_results,
+)
+from tests.utils.clock import FakeClock
+
+
+class InMemoryStore:
+    def __init__(self):
+        self.items: dict[str, bytes] = {}
+
+    def get(self, key: str) -> bytes | None:
+        return self.items.get(key)
+
+    def put(self, key: str, data: bytes):
+        self.items[key] = data
+
+
+class TestRetrievalCache(unittest.TestCase):
+    config = {"max_entries": 2, "ttl_seconds": 60}
+    search_params = {"max_results": 5, "ef_search": None, "probes": None}
+
+    def setUp(self) -> None:
+        metrics.reset()
+        self.calls = 0
+
+    def compute(self) -> list[tuple[str, str, str]]:
+        self.calls += 1
+        return [("bot", f"content {self.calls}", "s3://bucket/doc.pdf")]
+
+    def test_compose_cache_key(self):
+        key = compose_cache_key("bot", 1, self.search_params, "What is  AWS?")
+        self.assertEqual(
+            key, compose_cache_key("bot", 1, self.search_params, "What is AWS? ")
+        )
+        self.assertTrue(key.startswith("bot#1#"))
+        # A new knowledge version or different search params never share entries
+        self.assertNotEqual(
+            key, compose_cache_key("bot", 2, self.search_params, "What is AWS? ")
+        )
+        self.assertNotEqual(
+            key,
+            compose_cache_key(
+                "bot", 1, {**self.search_params, "max_results": 10}, "What is AWS? "
+            ),
+        )
+
+    def test_encode_decode(self):
+        results = [("bot", "content " * 100, "https://example.com")]
+        data = encode_results(results)
+        self.assertLess(len(data), len(results[0][1]))
+        self.assertEqual(decode_results(data), results)
+
+    def test_memory_hit_and_expiry(self):
+        clock = FakeClock()
+        cache = RetrievalCache(config=self.config, clock=clock)  # type: ignore
+        first = cache.get_or_compute("key", self.compute)
+        second = cache.get_or_compute("key", self.compute)
+        self.assertEqual(first, second)
+        self.assertEqual(self.calls, 1)
+
+        clock.now = 61
+        cache.get_or_compute("key", self.compute)
+        self.assertEqual(self.calls, 2)
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["retrieval_cache.hit[tier=memory]"], 1)
+        self.assertEqual(counters["retrieval_cache.miss"], 2)
+
+    def test_store_hit(self):
+        store = InMemoryStore()
+        RetrievalCache(config=self.config, store=store).get_or_compute(  # type: ignore
+            "key", self.compute
+        )
+        # Another process shares the persistent tier
+        cache = RetrievalCache(config=self.config, store=store)  # type: ignore
+        results = cache.get_or_compute("key", self.compute)
+        self.assertEqual(results, [("bot", "content 1", "s3://bucket/doc.pdf")])
+        self.assertEqual(self.calls, 1)
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["retrieval_cache.hit[tier=store]"], 1)
+
+    def test_get_or_compute_many(self):
+        cache = RetrievalCache(config=self.config)  # type: ignore
+        cache.get_or_compute("a", self.compute)
+        missing_indices = []
+
+        def compute_many(missing: list[int]) -> list[list[tuple[str, str, str]]]:
+            missing_indices.append(missing)
+            return [[("bot", f"computed {i}", "source")] for i in missing]
+
+        results = cache.get_or_compute_many(["a", "b"], compute_many)
+        self.assertEqual(missing_indices, [[1]])
+        self.assertEqual(results[0], [("bot", "content 1", "s3://bucket/doc.pdf")])
+        self.assertEqual(results[1], [("bot", "computed 1", "source")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.retrieval_snapshot import RetrievalSnapshots, compose_snapshot_key
+from app.vector_search import SearchResult
+from tests.utils.clock import FakeClock
+
+CONFIG = {"ttl_seconds": 60, "wait_seconds": 2.0, "poll_interval_seconds": 0.5}
+
+
+class InMemoryStore:
+    def __init__(self):
+        self.items: dict[str, bytes] = {}
+        self.gets = 0
+
+    def get(self, key: str) -> bytes | None:
+        self.gets += 1
+        return self.items.get(key)
+
+    def put(self, key: str, data: bytes):
+        self.items[key] = data
+
+
+RESULTS = [
+    SearchResult(bot_id="bot", content="content_0", source="s3://b/k", rank=0),
+    SearchResult(
+        bot_id="bot", content="日本語", source="https://example.com", rank=1, score=0.5
+    ),
+]
+
+
+class TestRetrievalSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.store = InMemoryStore()
+        self.clock = FakeClock()
+        self.snapshots = RetrievalSnapshots(
+            self.store, CONFIG, sleep=self.clock.sleep, clock=self.clock  # type: ignore
+        )
+
+    def test_save_load(self):
+        self.snapshots.save("user", "conversation", "message", RESULTS)
+        self.assertIn(
+            compose_snapshot_key("user", "conversation", "message"), self.store.items
+        )
+        self.assertEqual(
+            self.snapshots.load("user", "conversation", "message"), RESULTS
+        )
+
+    def test_miss_without_wait(self):
+        self.assertIsNone(self.snapshots.load("user", "conversation", "message"))
+        self.assertEqual(self.store.gets, 1)
+        self.assertEqual(self.clock.now, 0)
+
+    def test_waits_for_snapshot(self):
+        def save():
+            if self.clock.now >= 1.0:
+                self.snapshots.save("user", "conversation", "message", RESULTS)
+
+        self.clock.on_sleep = save
+        self.assertEqual(
+            self.snapshots.load("user", "conversation", "message", wait=True), RESULTS
+        )
+        self.assertEqual(self.clock.now, 1.0)
+
+    def test_gives_up_after_wait_seconds(self):
+        self.assertIsNone(
+            self.snapshots.load("user", "conversation", "message", wait=True)
+        )
+        self.assertLessEqual(self.clock.now, CONFIG["wait_seconds"])
+        self.assertEqual(self.store.gets, 5)
+
+    def test_disabled(self):
+        snapshots = RetrievalSnapshots(None)
+        snapshots.save("user", "conversation", "message", RESULTS)
+        self.assertIsNone(snapshots.load("user", "conversation", "message", wait=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,10 +5,10 @@ sys.path.append(".")
 
 import unittest
 
-from app.bedrock import compose_args_for_converse_api
+from app.bedrock import RouteTarget, calculate_price, compose_args_for_converse_api
 from app.repositories.models.conversation import ContentModel, MessageModel
 from app.repositories.models.custom_bot import GenerationParamsModel
-from app.stream import ConverseApiStreamHandler, OnStopInput
+from app.stream import ConverseApiStreamHandler, OnStopInput, estimate_input_tokens
 from get_aws_logo import get_aws_logo, get_cdk_logo
 from get_pdf import get_aws_overview, get_test_markdown
 
@@ -184,5 +184,51 @@ class TestConverseApiStreamHandler(unittest.TestCase):
         self._run(message)
 
 
+class TestCancelledGeneration(unittest.TestCase):
+    MODEL = "claude-v3-haiku"
+
+    def test_usage_is_estimated(self):
+        message = MessageModel(
+            role="user",
+            content=[
+                ContentModel(
+                    content_type="text",
+                    media_type=None,
+                    body="a" * 400,
+                    file_name=None,
+                )
+            ],
+            model=self.MODEL,
+            children=[],
+            parent=None,
+            create_time=0,
+            feedback=None,
+            used_chunks=None,
+            thinking_log=None,
+        )
+        args = compose_args_for_converse_api(
+            [message],
+            self.MODEL,
+            instruction="b" * 40,
+            stream=True,
+            generation_params=None,
+        )
+        self.assertEqual(estimate_input_tokens(args), 101 + 11)
+
+        stopped: list[OnStopInput] = []
+        handler = ConverseApiStreamHandler(
+            model=self.MODEL, on_stream=on_stream, on_stop=stopped.append  # type: ignore
+        )
+        handler._cancel(["c" * 20, "c" * 20], args, RouteTarget("us-east-1", "id"))
+        self.assertEqual(stopped[0].stop_reason, "cancelled")
+        self.assertEqual(stopped[0].input_token_count, 112)
+        self.assertEqual(stopped[0].output_token_count, 11)
+        self.assertEqual(
+            stopped[0].price,
+            calculate_price(self.MODEL, 112, 11, region="us-east-1"),
+        )
+        self.assertGreater(stopped[0].price, 0)
+
+
 if __name__ == "__main__":
     unittest.main()
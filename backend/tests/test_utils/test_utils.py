@@ -39,6 +39,73 @@ class TestUtils(unittest.TestCase):
 
         assert reg == "us-west-2"
 
+    def test_lazy_client(self):
+        from app.utils import LazyClient
+
+        created = []
+
+        class FakeClient:
+            def list_buckets(self):
+                return ["bucket"]
+
+        def factory():
+            created.append(1)
+            return FakeClient()
+
+        client = LazyClient(factory)
+        assert created == []
+        assert client.list_buckets() == ["bucket"]
+        assert client.list_buckets() == ["bucket"]
+        assert created == [1]
+
+
+class TestPresignedUrlCache(unittest.TestCase):
+    def setUp(self):
+        from app.utils import PresignedUrlCache
+
+        self.now = 0.0
+        self.signed: list[tuple[str, str]] = []
+
+        def presign(bucket: str, key: str, expiration: int) -> str:
+            self.signed.append((bucket, key))
+            return f"https://{bucket}/{key}?signed={len(self.signed)}"
+
+        self.cache = PresignedUrlCache(
+            {
+                "max_entries": 2,
+                "expiration_seconds": 3600,
+                "refresh_margin_seconds": 300,
+            },
+            presign=presign,
+            clock=lambda: self.now,
+        )
+
+    def test_reuses_url_until_shortly_before_expiry(self):
+        url = self.cache.get("bucket", "a.pdf")
+        self.now = 3299
+        self.assertEqual(self.cache.get("bucket", "a.pdf"), url)
+        self.now = 3300
+        self.assertNotEqual(self.cache.get("bucket", "a.pdf"), url)
+        self.assertEqual(len(self.signed), 2)
+
+    def test_keyed_by_bucket_and_key(self):
+        self.cache.get("bucket", "a.pdf")
+        self.cache.get("other", "a.pdf")
+        self.cache.get("bucket", "b.pdf")
+        self.assertEqual(len(self.signed), 3)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.get("bucket", "a.pdf")
+        self.cache.get("bucket", "b.pdf")
+        self.cache.get("bucket", "a.pdf")
+        self.cache.get("bucket", "c.pdf")
+        self.cache.get("bucket", "a.pdf")
+        self.cache.get("bucket", "b.pdf")
+        # "b.pdf" was evicted by "c.pdf"
+        self.assertEqual(
+            [key for _, key in self.signed], ["a.pdf", "b.pdf", "c.pdf", "b.pdf"]
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,49 @@
 import sys
+import threading
 import unittest
 
 sys.path.append(".")
 
-from app.vector_search import SearchResult, filter_used_results
+from app.repositories.models.custom_bot import BotModel
+from app.repositories.models.custom_bot import SearchParamsModel as BotSearchParams
+from app.repositories.models.custom_bot_kb import (
+    BedrockKnowledgeBaseModel,
+    OpenSearchParamsModel,
+    SearchParamsModel,
+)
+from app.vector_search import (
+    RetrievalSource,
+    SearchResult,
+    compose_retrieval_sources,
+    federated_search,
+    filter_used_results,
+    fuse_results,
+)
+
+
+def create_bot(bedrock_knowledge_base: BedrockKnowledgeBaseModel | None = None):
+    # Only the fields used by the search
+    return BotModel.model_construct(
+        id="bot",
+        search_params=BotSearchParams(max_results=3),
+        bedrock_knowledge_base=bedrock_knowledge_base,
+    )
+
+
+def create_federated_bot(
+    federated_knowledge_base_ids: list[str], include_vector_store: bool = False
+):
+    return create_bot(
+        BedrockKnowledgeBaseModel(
+            embeddings_model="cohere_multilingual_v3",
+            open_search=OpenSearchParamsModel(analyzer=None),
+            chunking_strategy="default",
+            search_params=SearchParamsModel(max_results=3, search_type="hybrid"),
+            knowledge_base_id="kb1",
+            federated_knowledge_base_ids=federated_knowledge_base_ids,
+            include_vector_store=include_vector_store,
+        ),
+    )
 
 
 class TestVectorSearch(unittest.TestCase):
@@ -47,6 +87,123 @@ class TestVectorSearch(unittest.TestCase):
         used_results = filter_used_results(generated_text, search_results)
         self.assertEqual(len(used_results), 0)
 
+    def test_fuse_results(self):
+        def result(content: str, rank: int) -> SearchResult:
+            return SearchResult(bot_id="1", content=content, source="s", rank=rank)
+
+        results = [
+            [result("a", 0), result("b", 1), result("c", 2)],
+            [result("c", 0), result("d", 1)],
+        ]
+        fused = fuse_results(results, limit=3)
+        # "c" is found by both queries
+        self.assertEqual([r.content for r in fused], ["c", "a", "b"])
+        self.assertEqual([r.rank for r in fused], [0, 1, 2])
+
+
+class TestFederatedSearch(unittest.TestCase):
+    def test_compose_retrieval_sources(self):
+        bot = create_federated_bot(["kb2", "kb1"], include_vector_store=True)
+        self.assertEqual(
+            [source.label for source in compose_retrieval_sources(bot)],
+            ["knowledge_base:kb1", "knowledge_base:kb2", "pgvector:bot"],
+        )
+
+    def test_compose_retrieval_sources_without_knowledge_base(self):
+        bot = create_bot()
+        self.assertEqual(
+            compose_retrieval_sources(bot), [RetrievalSource(type="pgvector", id="bot")]
+        )
+
+    def test_fuses_sources(self):
+        def search(bot, source: RetrievalSource, query: str) -> list[SearchResult]:
+            return [
+                SearchResult(bot_id=bot.id, content=c, source=source.id, rank=i)
+                for i, c in enumerate(["a", "b"])
+            ]
+
+        result = federated_search(
+            create_federated_bot(["kb2"]), "query", search_source=search
+        )
+        self.assertEqual(
+            [(r.source, r.content) for r in result.results],
+            [("kb1", "a"), ("kb2", "a"), ("kb1", "b")],
+        )
+        self.assertEqual(
+            set(result.latencies), {"knowledge_base:kb1", "knowledge_base:kb2"}
+        )
+        self.assertEqual(result.missing_sources, [])
+
+    def test_partial_results_on_deadline(self):
+        release = threading.Event()
+
+        def search(bot, source: RetrievalSource, query: str) -> list[SearchResult]:
+            if source.id == "kb2":
+                release.wait(5)
+            return [SearchResult(bot_id=bot.id, content="a", source=source.id, rank=0)]
+
+        try:
+            result = federated_search(
+                create_federated_bot(["kb2"]),
+                "query",
+                deadline_seconds=0.1,
+                search_source=search,
+            )
+        finally:
+            release.set()
+        self.assertEqual([r.source for r in result.results], ["kb1"])
+        self.assertEqual(result.missing_sources, ["knowledge_base:kb2"])
+
+    def test_skips_source_with_stragglers(self):
+        release = threading.Event()
+        calls: list[str] = []
+
+        def search(bot, source: RetrievalSource, query: str) -> list[SearchResult]:
+            calls.append(source.id)
+            if source.id == "kb-slow":
+                release.wait(5)
+            return [SearchResult(bot_id=bot.id, content="a", source=source.id, rank=0)]
+
+        bot = create_federated_bot(["kb-slow"])
+        try:
+            for _ in range(2):
+                result = federated_search(
+                    bot,
+                    "query",
+                    deadline_seconds=0.1,
+                    search_source=search,
+                    max_stragglers_per_source=1,
+                )
+                self.assertEqual(result.missing_sources, ["knowledge_base:kb-slow"])
+        finally:
+            release.set()
+        # The second search did not wait for the source which was still busy
+        self.assertEqual(calls.count("kb-slow"), 1)
+        self.assertEqual(calls.count("kb1"), 2)
+
+    def test_partial_results_on_error(self):
+        def search(bot, source: RetrievalSource, query: str) -> list[SearchResult]:
+            if source.type == "pgvector":
+                raise RuntimeError("connection refused")
+            return [SearchResult(bot_id=bot.id, content="a", source=source.id, rank=0)]
+
+        result = federated_search(
+            create_federated_bot([], include_vector_store=True),
+            "query",
+            search_source=search,
+        )
+        self.assertEqual(len(result.results), 1)
+        self.assertEqual(result.missing_sources, ["pgvector:bot"])
+
+    def test_raises_if_all_sources_fail(self):
+        def search(bot, source: RetrievalSource, query: str) -> list[SearchResult]:
+            raise RuntimeError("unavailable")
+
+        with self.assertRaises(RuntimeError):
+            federated_search(
+                create_federated_bot(["kb2"]), "query", search_source=search
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,61 @@
+import base64
+import gzip
+import hashlib
+import json
+import sys
+import unittest
+
+sys.path.append(".")
+
+from app.websocket_payload import PayloadDecoder, PayloadIntegrityError
+
+
+def encode(payload: str, part_size: int) -> tuple[list[str], int, str]:
+    raw = payload.encode("utf-8")
+    encoded = base64.b64encode(gzip.compress(raw)).decode("ascii")
+    parts = [encoded[i : i + part_size] for i in range(0, len(encoded), part_size)]
+    return parts, len(raw), hashlib.sha256(raw).hexdigest()
+
+
+class TestPayloadDecoder(unittest.TestCase):
+    payload = json.dumps({"message": {"content": ["こんにちは " * 5000]}})
+
+    def test_decode(self):
+        # Part size is deliberately not a multiple of 4
+        parts, size, checksum = encode(self.payload, 101)
+        self.assertGreater(len(parts), 1)
+        decoder = PayloadDecoder("gzip", size, checksum)
+        for part in parts:
+            decoder.update(part)
+        self.assertEqual(decoder.finish(), self.payload)
+
+    def test_checksum_mismatch(self):
+        parts, size, _ = encode(self.payload, 4096)
+        decoder = PayloadDecoder("gzip", size, "0" * 64)
+        for part in parts:
+            decoder.update(part)
+        with self.assertRaises(PayloadIntegrityError):
+            decoder.finish()
+
+    def test_truncated(self):
+        parts, size, checksum = encode(self.payload, 64)
+        decoder = PayloadDecoder("gzip", size, checksum)
+        for part in parts[:-1]:
+            decoder.update(part)
+        with self.assertRaises(PayloadIntegrityError):
+            decoder.finish()
+
+    def test_larger_than_declared(self):
+        parts, _, checksum = encode(self.payload, 4096)
+        decoder = PayloadDecoder("gzip", 100, checksum)
+        with self.assertRaises(PayloadIntegrityError):
+            for part in parts:
+                decoder.update(part)
+
+    def test_unsupported_encoding(self):
+        with self.assertRaises(ValueError):
+            PayloadDecoder("br", 1, "")
+
+
+if __name__ == "__main__":
+    unittest.main()
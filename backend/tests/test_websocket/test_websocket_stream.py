@@ -0,0 +1,205 @@
+import json
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(".")
+
+from app.metrics import metrics
+from app.websocket_stream import CancellationMonitor, FrameCoalescer, WebsocketSender
+from tests.utils.clock import FakeClock
+
+
+class TestFrameCoalescer(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+        self.frames: list[dict] = []
+        self.clock = FakeClock()
+
+    def send(self, data: bytes):
+        self.frames.append(json.loads(data))
+
+    def test_flush_on_time_window(self):
+        coalescer = FrameCoalescer(
+            self.send,
+            config={"flush_interval_ms": 50, "max_frame_bytes": 1024},
+            clock=self.clock,
+            timer=False,
+        )
+        # The first token is sent right away
+        coalescer.add("Hello")
+        self.assertEqual(len(self.frames), 1)
+        self.clock.now = 0.02
+        coalescer.add(", ")
+        self.clock.now = 0.08
+        coalescer.add("world")
+        self.clock.now = 0.09
+        coalescer.add("!")
+        coalescer.close()
+        self.assertEqual(
+            self.frames,
+            [
+                {"status": "STREAMING", "completion": "Hello"},
+                {"status": "STREAMING", "completion": ", world"},
+                {"status": "STREAMING", "completion": "!"},
+            ],
+        )
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["websocket.tokens_received"], 4)
+        self.assertEqual(counters["websocket.frames_sent"], 3)
+
+    def test_flush_on_timer(self):
+        flushed = threading.Event()
+
+        def send(data: bytes):
+            self.send(data)
+            if len(self.frames) == 2:
+                flushed.set()
+
+        coalescer = FrameCoalescer(
+            send, config={"flush_interval_ms": 20, "max_frame_bytes": 1024}
+        )
+        coalescer.add("Hello")
+        coalescer.add(", world")
+        # Flushed without waiting for another token
+        self.assertTrue(flushed.wait(timeout=5))
+        coalescer.close()
+        self.assertEqual([f["completion"] for f in self.frames], ["Hello", ", world"])
+
+    def test_flush_on_size(self):
+        coalescer = FrameCoalescer(
+            self.send,
+            config={"flush_interval_ms": 1000, "max_frame_bytes": 8},
+            clock=self.clock,
+            timer=False,
+        )
+        for token in ["a", "bc", "def", "ghi", "j"]:
+            coalescer.add(token)
+        coalescer.close()
+        # A frame never exceeds the limit unless a single token does
+        self.assertEqual([f["completion"] for f in self.frames], ["a", "bcdefghi", "j"])
+
+    def test_disabled(self):
+        coalescer = FrameCoalescer(
+            self.send,
+            config={"flush_interval_ms": 0, "max_frame_bytes": 4096},
+            clock=self.clock,
+        )
+        coalescer.add("a")
+        coalescer.add("b")
+        self.assertEqual([f["completion"] for f in self.frames], ["a", "b"])
+        self.assertEqual(coalescer.frames_sent, 2)
+
+    def test_flush_empty(self):
+        coalescer = FrameCoalescer(self.send, clock=self.clock)
+        coalescer.flush()
+        coalescer.add("")
+        coalescer.close()
+        coalescer.close()
+        self.assertEqual(self.frames, [])
+
+
+class TestWebsocketSender(unittest.TestCase):
+    config = {"flush_interval_ms": 50, "max_frame_bytes": 4096, "sender_queue_size": 2}
+
+    def setUp(self) -> None:
+        metrics.reset()
+
+    def test_order_and_drain(self):
+        sent: list[bytes] = []
+
+        def send(data: bytes):
+            time.sleep(0.001)
+            sent.append(data)
+
+        sender = WebsocketSender(send, config=self.config)  # type: ignore
+        frames = [str(i).encode() for i in range(20)]
+        for frame in frames:
+            sender.post(frame)
+        sender.close()
+        self.assertEqual(sent, frames)
+        self.assertEqual(
+            metrics.snapshot()["timings"]["websocket.sender_lag"]["count"], 20
+        )
+
+    def test_backpressure(self):
+        release = threading.Event()
+        sent: list[bytes] = []
+
+        def send(data: bytes):
+            release.wait()
+            sent.append(data)
+
+        sender = WebsocketSender(send, config=self.config)  # type: ignore
+        posted = []
+
+        def produce():
+            for i in range(5):
+                sender.post(str(i).encode())
+                posted.append(i)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        time.sleep(0.1)
+        # One frame is being sent and two are queued, so the producer is blocked
+        self.assertEqual(len(posted), 3)
+        release.set()
+        producer.join()
+        sender.close()
+        self.assertEqual(len(sent), 5)
+
+    def test_error_is_raised(self):
+        def send(data: bytes):
+            raise RuntimeError("gone")
+
+        sender = WebsocketSender(send, config=self.config)  # type: ignore
+        sender.post(b"a")
+        with self.assertRaises(RuntimeError):
+            sender.close()
+
+    def test_close_without_post(self):
+        sender = WebsocketSender(lambda data: None, config=self.config)  # type: ignore
+        sender.close()
+        sender.close()
+
+
+class TestCancellationMonitor(unittest.TestCase):
+    config = {"cancellation_check_interval_ms": 1000}
+
+    def test_check_is_rate_limited(self):
+        clock = FakeClock()
+        checks = []
+        flag = {"cancelled": False}
+
+        def is_cancelled() -> bool:
+            checks.append(clock.now)
+            return flag["cancelled"]
+
+        monitor = CancellationMonitor(is_cancelled, config=self.config, clock=clock)  # type: ignore
+        self.assertFalse(monitor.check())
+        flag["cancelled"] = True
+        clock.now = 0.5
+        self.assertFalse(monitor.check())
+        clock.now = 1.0
+        self.assertTrue(monitor.check())
+        self.assertTrue(monitor.check())
+        self.assertEqual(checks, [0.0, 1.0])
+        self.assertFalse(monitor.connection_gone)
+
+    def test_connection_gone(self):
+        monitor = CancellationMonitor(lambda: False, config=self.config)  # type: ignore
+        monitor.cancel(connection_gone=True)
+        self.assertTrue(monitor.check())
+        self.assertTrue(monitor.connection_gone)
+
+    def test_check_error_is_ignored(self):
+        def is_cancelled() -> bool:
+            raise RuntimeError("unavailable")
+
+        monitor = CancellationMonitor(is_cancelled, config=self.config)  # type: ignore
+        self.assertFalse(monitor.check())
+
+
+if __name__ == "__main__":
+    unittest.main()
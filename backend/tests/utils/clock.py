@@ -0,0 +1,19 @@
+from typing import Callable
+
+
+class FakeClock:
+    """Monotonic clock for tests. `sleep` advances the time and then calls `on_sleep`,
+    if set, e.g. to simulate work done by another process while waiting.
+    """
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+        self.on_sleep: Callable[[], None] | None = None
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+        if self.on_sleep:
+            self.on_sleep()
@@ -1,6 +1,97 @@
 const { Client } = require("pg");
 const { getSecret } = require("@aws-lambda-powertools/parameters/secrets");
 
+// Bot ids are ULIDs. They are validated since they are interpolated into DDL.
+const BOT_ID_PATTERN = /^[0-9A-Za-z]{26}$/;
+
+// NOTE: Cohere multi lingual embedding dimension is 1024
+// Ref: https://txt.cohere.com/introducing-embed-v3/
+// The table is list-partitioned by bot, with one partition per bot which is
+// created (and swapped on re-sync) by the embedding job and dropped with the bot.
+// See: backend/app/pgvector.py
+// `source_hash` and `chunk_hash` (SHA-256) let the embedding job sync only the
+// changed sources. See: backend/embedding/sync.py
+const createItemsTable = async (client) => {
+  await client.query(`CREATE TABLE IF NOT EXISTS items(
+                       id CHAR(26) NOT NULL,
+                       botid CHAR(26) NOT NULL,
+                       content text,
+                       source text,
+                       embedding vector(1024),
+                       source_hash CHAR(64),
+                       chunk_hash CHAR(64),
+                       PRIMARY KEY (botid, id))
+                       PARTITION BY LIST (botid);`);
+};
+
+const createEmbeddingIndex = async (client) => {
+  // HNSW has a better recall-latency trade-off than IVFFlat and, unlike IVFFlat,
+  // does not need existing rows to choose its clusters.
+  // Also it's important to choose the same index method as the one used in the query.
+  // Here we use L2 distance for the index method.
+  // The index is inherited by every partition.
+  // Keep the name and parameters in sync with `DEFAULT_VECTOR_INDEX_CONFIG` (backend/app/config.py).
+  // The embedding job may have replaced it with another configured index, which is kept.
+  // See: https://github.com/pgvector/pgvector#hnsw
+  const { rows } = await client.query(
+    "SELECT 1 FROM pg_indexes WHERE tablename = 'items' AND indexname LIKE 'idx_items_embedding%';"
+  );
+  if (rows.length === 0) {
+    await client.query(`CREATE INDEX idx_items_embedding_hnsw ON items
+                         USING hnsw (embedding vector_l2_ops) WITH (m = 16, ef_construction = 64);`);
+  }
+};
+
+// Move the rows of the flat `items` table of earlier versions into one partition per
+// bot of the partitioned table. Runs in a single transaction, so a failed migration
+// leaves the flat table as it was.
+const migrateFlatItemsTable = async (client) => {
+  console.log("Migrating the flat items table to a partitioned table.");
+  await client.query("BEGIN;");
+  try {
+    await client.query("ALTER TABLE items RENAME TO items_flat;");
+    // Its primary key and indexes keep their names (e.g. `items_pkey`), which the
+    // partitioned table must not reuse
+    await client.query("ALTER TABLE items_flat DROP CONSTRAINT IF EXISTS items_pkey;");
+    const { rows: indexes } = await client.query(
+      "SELECT indexname FROM pg_indexes WHERE tablename = 'items_flat';"
+    );
+    for (const { indexname } of indexes) {
+      await client.query(`DROP INDEX IF EXISTS "${indexname}";`);
+    }
+    await createItemsTable(client);
+
+    const { rows: bots } = await client.query(
+      "SELECT DISTINCT botid FROM items_flat WHERE botid IS NOT NULL;"
+    );
+    for (const { botid } of bots) {
+      if (!BOT_ID_PATTERN.test(botid)) {
+        console.warn(`Skipping rows of invalid bot id: ${botid}`);
+        continue;
+      }
+      await client.query(
+        `CREATE TABLE items_${botid.toLowerCase()} PARTITION OF items FOR VALUES IN ('${botid}');`
+      );
+    }
+    // Rows are routed to the partition of their bot. They have no hashes, so the next
+    // sync of each bot embeds all of its sources again.
+    const { rowCount } = await client.query(
+      `INSERT INTO items (id, botid, content, source, embedding)
+       SELECT id, botid, content, source, embedding FROM items_flat
+       WHERE botid = ANY($1::text[]);`,
+      [bots.map((b) => b.botid).filter((botid) => BOT_ID_PATTERN.test(botid))]
+    );
+    await client.query("DROP TABLE items_flat;");
+    // Built once over the migrated rows rather than row by row
+    await createEmbeddingIndex(client);
+    await client.query("COMMIT;");
+    console.log(`Migrated ${rowCount} rows of ${bots.length} bots.`);
+  } catch (err) {
+    await client.query("ROLLBACK;");
+    throw err;
+  }
+};
+
 const setUp = async (dbConfig) => {
   const client = new Client(dbConfig);
   try {
@@ -11,22 +102,20 @@ const setUp = async (dbConfig) => {
     // Ref: https://github.com/pgvector/pgvector
     await client.query("CREATE EXTENSION IF NOT EXISTS pgcrypto;");
     await client.query("CREATE EXTENSION IF NOT EXISTS vector;");
-    await client.query("DROP TABLE IF EXISTS items;");
-    // NOTE: Cohere multi lingual embedding dimension is 1024
-    // Ref: https://txt.cohere.com/introducing-embed-v3/
-    await client.query(`CREATE TABLE IF NOT EXISTS items(
-                         id CHAR(26) primary key,
-                         botid CHAR(26),
-                         content text,
-                         source text,
-                         embedding vector(1024));`);
-    // `lists` parameter controls the nubmer of clusters created during index building.
-    // Also it's important to choose the same index method as the one used in the query.
-    // Here we use L2 distance for the index method.
-    // See: https://txt.cohere.com/introducing-embed-v3/
-    await client.query(`CREATE INDEX idx_items_embedding ON items 
-                         USING ivfflat (embedding vector_l2_ops) WITH (lists = 100);`);
-    await client.query(`CREATE INDEX idx_items_botid ON items (botid);`);
+    // Runs again on stack updates (see `schemaVersion` in cdk/lib/constructs/vectorstore.ts),
+    // so existing rows are kept and migrated
+    const { rows } = await client.query(
+      "SELECT relkind FROM pg_class WHERE relname = 'items' AND relnamespace = 'public'::regnamespace;"
+    );
+    if (rows.length > 0 && rows[0].relkind === "r") {
+      await migrateFlatItemsTable(client);
+    } else {
+      await createItemsTable(client);
+      await createEmbeddingIndex(client);
+    }
+    await client.query(`ALTER TABLE items
+                         ADD COLUMN IF NOT EXISTS source_hash CHAR(64),
+                         ADD COLUMN IF NOT EXISTS chunk_hash CHAR(64);`);
 
     console.log("SQL execution successful.");
   } catch (err) {
@@ -154,6 +154,13 @@ export class BedrockChatStack extends cdk.Stack {
       autoDeleteObjects: true,
       serverAccessLogsBucket: accessLogBucket,
       serverAccessLogsPrefix: "LargeMessageBucket",
+      lifecycleRules: [
+        {
+          // Chat payloads uploaded directly by the websocket client
+          prefix: "_websocket_upload/",
+          expiration: cdk.Duration.days(1),
+        },
+      ],
     });
 
     const database = new Database(this, "Database", {
@@ -258,6 +265,7 @@ export class BedrockChatStack extends cdk.Stack {
     const backendApi = new Api(this, "BackendApi", {
       vpc,
       database: database.table,
+      retrievalSnapshotTable: database.retrievalSnapshotTable,
       auth,
       bedrockRegion: props.bedrockRegion,
       tableAccessRole: database.tableAccessRole,
@@ -280,6 +288,7 @@ export class BedrockChatStack extends cdk.Stack {
       database: database.table,
       tableAccessRole: database.tableAccessRole,
       websocketSessionTable: database.websocketSessionTable,
+      retrievalSnapshotTable: database.retrievalSnapshotTable,
       auth,
       bedrockRegion: props.bedrockRegion,
       largeMessageBucket,
@@ -296,6 +305,13 @@ export class BedrockChatStack extends cdk.Stack {
       idp,
     });
 
+    largeMessageBucket.addCorsRule({
+      allowedMethods: [HttpMethods.PUT],
+      allowedOrigins: [frontend.getOrigin(), "http://localhost:5173", "*"],
+      allowedHeaders: ["*"],
+      maxAge: 3000,
+    });
+
     documentBucket.addCorsRule({
       allowedMethods: [HttpMethods.PUT],
       allowedOrigins: [frontend.getOrigin(), "http://localhost:5173", "*"],
@@ -314,7 +330,8 @@ export class BedrockChatStack extends cdk.Stack {
       embeddingContainerMemory: props.embeddingContainerMemory,
       bedrockKnowledgeBaseProject: bedrockKnowledgeBaseCodebuild.project,
     });
-    documentBucket.grantRead(embedding.container.taskDefinition.taskRole);
+    // Write access for the local vector index snapshots of small bots
+    documentBucket.grantReadWrite(embedding.container.taskDefinition.taskRole);
 
     vectorStore.allowFrom(embedding.taskSecurityGroup);
     vectorStore.allowFrom(embedding.removalHandler);
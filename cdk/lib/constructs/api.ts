@@ -27,6 +27,7 @@ import { Guardrail } from "./guardrail";
 export interface ApiProps {
   readonly vpc: ec2.IVpc;
   readonly database: ITable;
+  readonly retrievalSnapshotTable: ITable;
   readonly dbSecrets: ISecret;
   readonly corsAllowOrigins?: string[];
   readonly auth: Auth;
@@ -173,6 +174,7 @@ export class Api extends Construct {
     props.usageAnalysis?.resultOutputBucket.grantReadWrite(handlerRole);
     props.usageAnalysis?.ddbBucket.grantRead(handlerRole);
     props.largeMessageBucket.grantReadWrite(handlerRole);
+    props.retrievalSnapshotTable.grantReadWriteData(handlerRole);
 
     const handler = new DockerImageFunction(this, "Handler", {
       code: DockerImageCode.fromImageAsset(
@@ -198,6 +200,7 @@ export class Api extends Construct {
         DB_SECRETS_ARN: props.dbSecrets.secretArn,
         DOCUMENT_BUCKET: props.documentBucket.bucketName,
         LARGE_MESSAGE_BUCKET: props.largeMessageBucket.bucketName,
+        RETRIEVAL_SNAPSHOT_TABLE_NAME: props.retrievalSnapshotTable.tableName,
         PUBLISH_API_CODEBUILD_PROJECT_NAME: props.apiPublishProject.projectName,
         KNOWLEDGE_BASE_CODEBUILD_PROJECT_NAME:
           props.bedrockKnowledgeBaseProject.projectName,
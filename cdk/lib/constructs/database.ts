@@ -17,6 +17,7 @@ export class Database extends Construct {
   readonly table: Table;
   readonly tableAccessRole: Role;
   readonly websocketSessionTable: Table;
+  readonly retrievalSnapshotTable: Table;
 
   constructor(scope: Construct, id: string, props?: DatabaseProps) {
     super(scope, id);
@@ -67,9 +68,20 @@ export class Database extends Construct {
       timeToLiveAttribute: "expire",
     });
 
+    // Retrieval snapshot table.
+    // Search results of chat turns, served by the related documents API without searching again.
+    const retrievalSnapshotTable = new Table(this, "RetrievalSnapshotTable", {
+      // CacheKey: UserId#ConversationId#MessageId
+      partitionKey: { name: "CacheKey", type: AttributeType.STRING },
+      billingMode: BillingMode.PAY_PER_REQUEST,
+      removalPolicy: RemovalPolicy.DESTROY,
+      timeToLiveAttribute: "expire",
+    });
+
     this.table = table;
     this.tableAccessRole = tableAccessRole;
     this.websocketSessionTable = websocketSessionTable;
+    this.retrievalSnapshotTable = retrievalSnapshotTable;
 
     new CfnOutput(this, "ConversationTableName", {
       value: table.tableName,
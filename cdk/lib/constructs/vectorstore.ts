@@ -121,7 +121,8 @@ export class VectorStore extends Construct {
         "../../custom-resources/setup-pgvector/index.js"
       ),
       handler: "handler",
-      timeout: Duration.minutes(5),
+      // Migrating the rows of existing bots can take a while
+      timeout: Duration.minutes(15),
       environment: {
         DB_CLUSTER_IDENTIFIER: dbClusterIdentifier,
         DB_SECRETS_ARN: cluster.secret!.secretFullArn!,
@@ -140,6 +141,9 @@ export class VectorStore extends Construct {
       properties: {
         // Dummy property to trigger
         id: cluster.clusterEndpoint.hostname,
+        // Bump when the schema created by setup-pgvector changes, so that existing
+        // clusters are migrated on update
+        schemaVersion: "2",
       },
     });
     cr.node.addDependency(cluster);
@@ -30,6 +30,7 @@ export interface WebSocketProps {
   readonly tableAccessRole: iam.IRole;
   readonly documentBucket: s3.IBucket;
   readonly websocketSessionTable: ITable;
+  readonly retrievalSnapshotTable: ITable;
   readonly largeMessageBucket: s3.IBucket;
   readonly accessLogBucket?: s3.Bucket;
   readonly enableMistral: boolean;
@@ -86,6 +87,7 @@ export class WebSocket extends Construct {
     );
     largePayloadSupportBucket.grantRead(handlerRole);
     props.websocketSessionTable.grantReadWriteData(handlerRole);
+    props.retrievalSnapshotTable.grantReadWriteData(handlerRole);
     props.largeMessageBucket.grantReadWrite(handlerRole);
     props.documentBucket.grantRead(handlerRole);
 
@@ -110,9 +112,11 @@ export class WebSocket extends Construct {
         TABLE_NAME: database.tableName,
         TABLE_ACCESS_ROLE_ARN: tableAccessRole.roleArn,
         LARGE_MESSAGE_BUCKET: props.largeMessageBucket.bucketName,
+        DOCUMENT_BUCKET: props.documentBucket.bucketName,
         DB_SECRETS_ARN: props.dbSecrets.secretArn,
         LARGE_PAYLOAD_SUPPORT_BUCKET: largePayloadSupportBucket.bucketName,
         WEBSOCKET_SESSION_TABLE_NAME: props.websocketSessionTable.tableName,
+        RETRIEVAL_SNAPSHOT_TABLE_NAME: props.retrievalSnapshotTable.tableName,
         ENABLE_MISTRAL: props.enableMistral.toString(),
         GUARDRAIL_ID: props.guardrail.guardrail.attrGuardrailId,
         GUARDRAIL_VERSION: props.guardrail.version.attrVersion,
@@ -130,6 +134,13 @@ export class WebSocket extends Construct {
           handler
         ),
       },
+      // Used to cancel the generation when the client goes away
+      disconnectRouteOptions: {
+        integration: new WebSocketLambdaIntegration(
+          "DisconnectIntegration",
+          handler
+        ),
+      },
     });
     const route = webSocketApi.addRoute("$default", {
       integration: new WebSocketLambdaIntegration(
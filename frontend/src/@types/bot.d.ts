@@ -57,6 +57,9 @@ export type GenerationParams = {
 
 export type SearchParams = {
   maxResults: number;
+  efSearch?: number;
+  probes?: number;
+  maxContextTokens?: number;
 };
 
 export type BotDetails = BotMeta & {
@@ -49,6 +49,7 @@ export type PostMessageRequest = {
   conversationId?: string;
   message: MessageContent & {
     parentMessageId: null | string;
+    messageId?: string;
   };
   botId?: string;
   continueGenerate?: bool;
@@ -64,6 +65,7 @@ export type GetRelatedDocumentsRequest = {
   conversationId: string;
   message: MessageContent & {
     parentMessageId: null | string;
+    messageId?: string;
   };
   botId: string;
 };
@@ -111,6 +111,7 @@ export type Direction =
 export const PostStreamingStatus = {
   START: 'START',
   BODY: 'BODY',
+  UPLOAD_READY: 'UPLOAD_READY',
   FETCHING_KNOWLEDGE: 'FETCHING_KNOWLEDGE',
   THINKING: 'THINKING',
   STREAMING: 'STREAMING',
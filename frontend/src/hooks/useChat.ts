@@ -427,6 +427,8 @@ const useChat = () => {
       message: {
         ...messageContent,
         parentMessageId: parentMessageId,
+        // Also identifies the search results of the turn for `getRelatedDocuments`
+        messageId: ulid(),
       },
       botId: bot?.botId,
     };
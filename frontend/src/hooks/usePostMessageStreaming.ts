@@ -1,3 +1,4 @@
+import axios from 'axios';
 import { fetchAuthSession } from 'aws-amplify/auth';
 import { PostMessageRequest } from '../@types/conversation';
 import { create } from 'zustand';
@@ -7,6 +8,30 @@ import { PostStreamingStatus } from '../constants';
 
 const WS_ENDPOINT: string = import.meta.env.VITE_APP_WS_ENDPOINT;
 const CHUNK_SIZE = 32 * 1024; //32KB
+// Compressed payloads up to this number of chunks are sent over the websocket.
+// Larger payloads are uploaded to S3 directly.
+const MAX_COMPRESSED_CHUNKS = 8;
+
+const compressPayload = async (
+  payload: string
+): Promise<{ encoded: string; size: number; checksum: string }> => {
+  const bytes = new TextEncoder().encode(payload);
+  const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', bytes));
+  const checksum = Array.from(digest)
+    .map((b) => b.toString(16).padStart(2, '0'))
+    .join('');
+
+  const compressed = new Uint8Array(
+    await new Response(
+      new Blob([bytes]).stream().pipeThrough(new CompressionStream('gzip'))
+    ).arrayBuffer()
+  );
+  let binary = '';
+  for (let i = 0; i < compressed.length; i += 0x8000) {
+    binary += String.fromCharCode(...compressed.subarray(i, i + 0x8000));
+  }
+  return { encoded: btoa(binary), size: bytes.length, checksum };
+};
 
 const usePostMessageStreaming = create<{
   post: (params: {
@@ -31,13 +56,31 @@ const usePostMessageStreaming = create<{
         token,
       });
 
+      // Payloads larger than a single websocket frame are compressed, and if they
+      // are still too large, uploaded to S3 directly
+      let body = payloadString;
+      let encoding: { encoding: string; size: number; checksum: string } | null =
+        null;
+      let upload = false;
+      if (payloadString.length > CHUNK_SIZE) {
+        if (typeof CompressionStream !== 'undefined') {
+          const { encoded, size, checksum } =
+            await compressPayload(payloadString);
+          if (encoded.length <= CHUNK_SIZE * MAX_COMPRESSED_CHUNKS) {
+            body = encoded;
+            encoding = { encoding: 'gzip', size, checksum };
+          }
+        }
+        upload = encoding === null;
+      }
+
       // chunking
       const chunkedPayloads: string[] = [];
-      const chunkCount = Math.ceil(payloadString.length / CHUNK_SIZE);
+      const chunkCount = Math.ceil(body.length / CHUNK_SIZE);
       for (let i = 0; i < chunkCount; i++) {
         const start = i * CHUNK_SIZE;
-        const end = Math.min(start + CHUNK_SIZE, payloadString.length);
-        chunkedPayloads.push(payloadString.substring(start, end));
+        const end = Math.min(start + CHUNK_SIZE, body.length);
+        chunkedPayloads.push(body.substring(start, end));
       }
 
       let receivedCount = 0;
@@ -50,6 +93,8 @@ const usePostMessageStreaming = create<{
             JSON.stringify({
               step: PostStreamingStatus.START,
               token: token,
+              upload,
+              ...encoding,
             })
           );
         };
@@ -92,6 +137,27 @@ const usePostMessageStreaming = create<{
 
             if (data.status) {
               switch (data.status) {
+                case PostStreamingStatus.UPLOAD_READY:
+                  // presignedURL contains credential.
+                  axios
+                    .put(data.upload_url, payloadString, {
+                      headers: {
+                        'Content-Type': 'application/json',
+                      },
+                    })
+                    .then(() => {
+                      ws.send(
+                        JSON.stringify({
+                          step: PostStreamingStatus.END,
+                        })
+                      );
+                    })
+                    .catch((e) => {
+                      ws.close();
+                      console.error(e);
+                      reject(i18next.t('error.predict.general'));
+                    });
+                  break;
                 case PostStreamingStatus.FETCHING_KNOWLEDGE:
                   dispatch(i18next.t('bot.label.retrievingKnowledge'));
                   break;